@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+## end to end: N clients against a DaemonProx that talks to the fake
+## NNTP server, everything on this machine.  reports requests/sec,
+## p50/p99 latency and MB/s for GETGROUP and GETHEADER.
+##
+##   python bench/bench_daemon.py [--clients 8] [--requests 200]
+##                                [--span 1000] [--latency 0.01] ...
+##
+## the fake server, the daemon and every client get a process of
+## their own so none of them queue up behind another's GIL.  the
+## overview and header caches are off unless --cache is given,
+## otherwise the second pass over a range never leaves the daemon.
+## the article picked for each request comes from a seeded random,
+## so runs with the same arguments ask for the same things.
+import os
+import sys
+import time
+import random
+import socket
+import logging
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pynntpprox import settings, protocol, fakenntp
+
+
+COMMANDS = ('GETGROUP', 'GETHEADER')
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_fake(port, opts):
+    logging.disable(logging.INFO)
+    server = fakenntp.FakeNNTPServer(('127.0.0.1', port), groups=opts.groups,
+                                     articles=opts.articles, latency=opts.latency)
+    server.serve_forever()
+
+
+def run_daemon(port, nntp_port, opts):
+    logging.disable(logging.INFO)
+    settings.OVERVIEW_CACHE = opts.cache
+    if not opts.cache:
+        settings.HEADER_CACHE_BYTES = 0
+    if opts.cache:
+        settings.CACHE_DIR = opts.cache_dir
+    ## imported late so the settings above are what it sees
+    from pynntpprox.daemonprox import DaemonProx
+    config = {'HOST': '127.0.0.1', 'PORT': nntp_port, 'SECURE': 'PLAIN',
+              'CONNECTIONS': opts.connections, 'COMPRESSION': None}
+    DaemonProx(host='127.0.0.1', port=port, config=config, metrics_port=None).serve_forever()
+
+
+def make_request(cmd, rand, opts):
+    group = 'alt.binaries.fake.%d' % rand.randrange(opts.groups)
+    if cmd == 'GETGROUP':
+        first = rand.randint(1, max(opts.articles - opts.span + 1, 1))
+        return {'CMD': 'GETGROUP',
+                'ARG': {'message_spec': (first, first + opts.span - 1),
+                        'group_name': group}}
+    number = rand.randint(1, opts.articles)
+    return {'CMD': 'GETHEADER',
+            'ARG': {'message_spec': '<%d.%s@fake.invalid>' % (number, group)}}
+
+
+def run_client(args):
+    ## one client: its requests back to back on one connection.
+    ## returns (command, seconds, response bytes, ok) per request
+    n, port, opts = args
+    rand = random.Random(opts.seed + n)
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = protocol.FrameReader()
+    results = []
+    for i in range(opts.requests):
+        cmd = COMMANDS[i % len(COMMANDS)] if opts.command == 'MIXED' else opts.command
+        message = make_request(cmd, rand, opts)
+        start = time.perf_counter()
+        sock.sendall(protocol.encode(message, protocol.V2))
+        response = None
+        while response is None:
+            if not reader.recv_from(sock):
+                raise EOFError('daemon hung up')
+            for version, frame in reader.frames():
+                size = len(frame) + protocol.HEADER.size
+                response = protocol.decode(frame)
+                break
+        results.append((cmd, time.perf_counter() - start, size, response['RSP'] == 'OK'))
+    sock.close()
+    return results
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(results, elapsed, out=sys.stdout):
+    out.write('%-10s %8s %7s %10s %9s %9s %9s\n' % (
+        'command', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'MB/s'))
+    for cmd in COMMANDS + ('ALL', ):
+        rows = [r for r in results if cmd in (r[0], 'ALL')]
+        if not rows:
+            continue
+        latencies = sorted(r[1] for r in rows)
+        size = sum(r[2] for r in rows)
+        errors = sum(1 for r in rows if not r[3])
+        out.write('%-10s %8d %7d %10.1f %9.2f %9.2f %9.2f\n' % (
+            cmd, len(rows), errors, len(rows) / elapsed,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            size / elapsed / 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='end to end daemon benchmark')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per client')
+    parser.add_argument('--command', default='MIXED',
+                        choices=COMMANDS + ('MIXED', ))
+    parser.add_argument('--span', type=int, default=1000,
+                        help='articles per GETGROUP')
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--articles', type=int, default=100000,
+                        help='articles per group')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the fake server adds to every command')
+    parser.add_argument('--connections', type=int, default=6,
+                        help='NNTP connections the daemon may open')
+    parser.add_argument('--cache', action='store_true',
+                        help='leave the overview and header caches on')
+    parser.add_argument('--cache-dir', default=None,
+                        help='where --cache keeps its files (a fresh temp dir)')
+    parser.add_argument('--seed', type=int, default=1)
+    opts = parser.parse_args(argv)
+    if opts.cache and opts.cache_dir is None:
+        import tempfile
+        opts.cache_dir = tempfile.mkdtemp(prefix='pynntpprox-bench-')
+
+    nntp_port, daemon_port = free_port(), free_port()
+    servers = [multiprocessing.Process(target=run_fake, args=(nntp_port, opts)),
+               multiprocessing.Process(target=run_daemon, args=(daemon_port, nntp_port, opts))]
+    for p in servers:
+        p.daemon = True
+        p.start()
+    try:
+        wait_for(nntp_port)
+        wait_for(daemon_port)
+        ## one request to open a connection and learn the overview format
+        run_client((-1, daemon_port, argparse.Namespace(**dict(vars(opts), requests=2))))
+
+        sys.stdout.write('%d clients x %d requests, %d article GETGROUPs, '
+                         '%.1fms NNTP latency, %d connections%s\n' % (
+                             opts.clients, opts.requests, opts.span,
+                             opts.latency * 1000, opts.connections,
+                             ', cached' if opts.cache else ''))
+        pool = multiprocessing.Pool(opts.clients)
+        start = time.perf_counter()
+        per_client = pool.map(run_client, [(n, daemon_port, opts) for n in range(opts.clients)])
+        elapsed = time.perf_counter() - start
+        pool.close()
+        results = [r for rows in per_client for r in rows]
+        report(results, elapsed)
+    finally:
+        for p in servers:
+            p.terminate()
+
+
+if __name__ == '__main__':
+    main()
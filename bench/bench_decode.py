@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+## overview decoding throughput: the old get_group loop against
+## OverviewDecoder, on synthetic XOVER lines.
+##
+##   python bench/bench_decode.py [articles]
+import os
+import sys
+import time
+import nntplib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pynntpprox.nntp import OverviewDecoder, log
+
+
+FMT = ['subject', 'from', 'date', 'message-id', 'references',
+       ':bytes', ':lines', 'xref']
+
+
+def make_lines(n):
+    lines = []
+    for i in range(n):
+        if i % 20:
+            subject = '[%s/40] - "some.release.name.part%02d.rar" yEnc (1/137)' % (i % 40, i % 40)
+        else:
+            ## the odd encoded subject, as seen in the wild
+            subject = '=?UTF-8?Q?caf=C3=A9_au_lait?= (1/1)'
+        lines.append('\t'.join([
+            str(100000 + i),
+            subject,
+            'poster@example.com (Poster)',
+            'Mon, 01 Jan 2024 00:00:%02d +0000' % (i % 60),
+            '<part%s.abc%s@example.com>' % (i, i),
+            '',
+            str(700000 + i),
+            '5400',
+            'Xref: news.example.com alt.binaries.test:%s' % (100000 + i),
+        ]))
+    return lines
+
+
+def old_decode(lines):
+    ## get_group as it was: nntplib's parser, then a decode_header
+    ## and lstrip per field and two log formats per article
+    h = []
+    for article_id, ovr in nntplib._parse_overview(lines, FMT):
+        d = {}
+        log.debug(u'BEFORE %s' % ovr['subject'])
+        for k, v in ovr.items():
+            k = k.lstrip(':')
+            d[k] = nntplib.decode_header(v)
+        log.debug('AFTER %s' % d['subject'])
+        h.append((article_id, d))
+    return h
+
+
+def new_decode(lines, raw=False):
+    decoder = OverviewDecoder(FMT)
+    if raw:
+        return [decoder.parse(line) for line in lines]
+    return [decoder(line) for line in lines]
+
+
+def bench(name, func, lines, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(lines) / best
+    sys.stdout.write('%-10s %10.0f articles/sec\n' % (name, rate))
+    return rate
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = make_lines(n)
+    assert old_decode(lines[:100]) == new_decode(lines[:100])
+
+    old = bench('old', old_decode, lines)
+    new = bench('decoder', new_decode, lines)
+    raw = bench('raw', lambda l: new_decode(l, raw=True), lines)
+    sys.stdout.write('decoder is %.1fx, raw is %.1fx the old loop\n' % (new / old, raw / old))
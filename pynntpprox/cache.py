@@ -0,0 +1,377 @@
+# local stores that save us a trip to the NNTP server
+import os
+import time
+import bisect
+import fnmatch
+import logging
+import sqlite3
+import threading
+import email.utils
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+class OverviewCache(object):
+    ## overview lines keyed by (group, article number), kept in sqlite.
+    ##
+    ## alongside the articles we keep the article ranges we have
+    ## asked the server for, so a gap in the numbering (a cancelled
+    ## or never posted article) is known to be a gap and not
+    ## fetched again.  articles are stored as the raw fields from
+    ## the overview, decoding happens on the way out.
+    ##
+    ## articles older than retention days are dropped, the
+    ## provider won't have them either.
+    page = 1000
+    ## seconds between expiry runs
+    expire_interval = 3600
+
+    def __init__(self, path, retention=None):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS overview ('
+                             'grp TEXT, article INTEGER, posted REAL, data BLOB, '
+                             'PRIMARY KEY (grp, article)) WITHOUT ROWID')
+            self._db.execute('CREATE INDEX IF NOT EXISTS overview_posted '
+                             'ON overview (posted)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS coverage ('
+                             'grp TEXT, first INTEGER, last INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS coverage_grp '
+                             'ON coverage (grp, first)')
+        self._expired = 0
+        self.expire()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @staticmethod
+    def _posted(ovr):
+        try:
+            return email.utils.parsedate_to_datetime(ovr['date']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return time.time()
+
+    def missing(self, group, first, last):
+        ## the sub ranges of first..last we have never fetched
+        with self._lock:
+            rows = self._db.execute('SELECT first, last FROM coverage '
+                                    'WHERE grp = ? AND first <= ? AND last >= ? '
+                                    'ORDER BY first', (group, last, first)).fetchall()
+        gaps = []
+        pos = first
+        for f, l in rows:
+            if f > pos:
+                gaps.append((pos, f - 1))
+            pos = max(pos, l + 1)
+        if pos <= last:
+            gaps.append((pos, last))
+        return gaps
+
+    def iter_range(self, group, first, last):
+        ## pages through the range so the lock is
+        ## never held while the caller works
+        pos = first
+        while pos <= last:
+            with self._lock:
+                rows = self._db.execute('SELECT article, data FROM overview '
+                                        'WHERE grp = ? AND article BETWEEN ? AND ? '
+                                        'ORDER BY article LIMIT ?',
+                                        (group, pos, last, self.page)).fetchall()
+            for article_id, data in rows:
+                yield article_id, pickle.loads(data)
+            if len(rows) < self.page:
+                break
+            pos = rows[-1][0] + 1
+
+    def store(self, group, overviews):
+        rows = [(group, article_id, self._posted(ovr),
+                 pickle.dumps(ovr, protocol=pickle.HIGHEST_PROTOCOL))
+                for article_id, ovr in overviews]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO overview '
+                                 'VALUES (?, ?, ?, ?)', rows)
+
+    def cover(self, group, first, last):
+        ## record first..last as fetched, merged with its neighbours
+        if last < first:
+            return
+        with self._lock, self._db:
+            rows = self._db.execute('SELECT rowid, first, last FROM coverage '
+                                    'WHERE grp = ? AND first <= ? AND last >= ?',
+                                    (group, last + 1, first - 1)).fetchall()
+            for rowid, f, l in rows:
+                first, last = min(first, f), max(last, l)
+            self._db.executemany('DELETE FROM coverage WHERE rowid = ?',
+                                 [(r[0], ) for r in rows])
+            self._db.execute('INSERT INTO coverage VALUES (?, ?, ?)',
+                             (group, first, last))
+        if time.time() - self._expired > self.expire_interval:
+            self.expire()
+
+    def expire(self):
+        self._expired = time.time()
+        if not self.retention:
+            return
+        cutoff = time.time() - self.retention * 86400
+        with self._lock, self._db:
+            n = self._db.execute('DELETE FROM overview WHERE posted < ?',
+                                 (cutoff, )).rowcount
+        if n:
+            log.info('Expired %s cached overviews' % n)
+
+
+class SyncMarks(object):
+    ## how far SYNC has got in each group, per consumer name: every
+    ## article from low to high has been handed out.  marks only
+    ## ever widen, and each advance is a single statement, so two
+    ## SYNCs racing on the same group can't move a mark backwards
+    ## (at worst both hand out the same articles).
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS marks ('
+                             'name TEXT, grp TEXT, low INTEGER, high INTEGER, '
+                             'PRIMARY KEY (name, grp)) WITHOUT ROWID')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, name, group):
+        ## (low, high), or None if group was never synced
+        with self._lock:
+            return self._db.execute('SELECT low, high FROM marks '
+                                    'WHERE name = ? AND grp = ?',
+                                    (name, group)).fetchone()
+
+    def advance(self, name, group, low, high):
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO marks VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (name, grp) DO UPDATE SET '
+                             'low = MIN(low, excluded.low), '
+                             'high = MAX(high, excluded.high)',
+                             (name, group, low, high))
+
+    def forget(self, name, group):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM marks WHERE name = ? AND grp = ?',
+                             (name, group))
+
+
+def _literal_prefix(pattern):
+    ## the part of a wildmat before its first wildcard
+    for i, c in enumerate(pattern):
+        if c in '*?[\\':
+            return pattern[:i]
+    return pattern
+
+
+def wildmat(name, patterns):
+    ## RFC 3977 wildmat: comma separated patterns, '!' negates,
+    ## the last one that matches decides
+    matched = False
+    for pattern in patterns:
+        negate = pattern.startswith('!')
+        if fnmatch.fnmatchcase(name, pattern[1:] if negate else pattern):
+            matched = not negate
+    return matched
+
+
+class GroupList(object):
+    ## the server's active list, kept sorted by group name so a
+    ## prefix or wildmat only looks at the slice of names that could
+    ## match.  saved to disk (pickled) after every change so a restart
+    ## doesn't have to LIST ACTIVE again.
+    ##
+    ## listed is when the last full LIST ACTIVE was, refreshed when
+    ## we last asked for NEWGROUPS (or listed).  both local time.
+    ## replaced by the caller, never edited in place, so reads need
+    ## no lock.
+    def __init__(self, path=None):
+        self.path = path
+        self.names = []
+        self.groups = {}
+        self.listed = None
+        self.refreshed = None
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.names, self.groups, self.listed, self.refreshed = pickle.load(f)
+            except Exception as e:
+                log.info('Ignoring unreadable group list %s: %s' % (path, e))
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self):
+        if self.path is None:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((self.names, self.groups, self.listed, self.refreshed), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    @classmethod
+    def listing(kls, path, groups, when):
+        ## a new list from a full LIST ACTIVE
+        new = kls()
+        new.path = path
+        new.groups = dict((g['group'], g) for g in groups)
+        new.names = sorted(new.groups)
+        new.listed = new.refreshed = when
+        return new
+
+    def added(self, groups, when):
+        ## a copy with NEWGROUPS' answer merged in
+        new = GroupList()
+        new.path = self.path
+        new.groups = dict(self.groups)
+        new.groups.update((g['group'], g) for g in groups)
+        new.names = self.names
+        if len(new.groups) != len(self.groups):
+            new.names = sorted(new.groups)
+        new.listed = self.listed
+        new.refreshed = when
+        return new
+
+    def _slice(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = len(self.names)
+        if prefix:
+            ## everything starting with prefix sorts before
+            ## prefix with its last character bumped by one
+            hi = bisect.bisect_left(self.names, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+        return self.names[lo:hi]
+
+    def match(self, pattern=None):
+        ## groups as get_groups returns them, in name order.
+        ## pattern is a wildmat (or None for all of them)
+        if not pattern:
+            return [self.groups[name] for name in self.names]
+        patterns = pattern.split(',')
+        positive = [p for p in patterns if not p.startswith('!')]
+        if len(positive) == 1:
+            candidates = self._slice(_literal_prefix(positive[0]))
+        else:
+            candidates = sorted(set(name for p in positive
+                                    for name in self._slice(_literal_prefix(p))))
+        return [self.groups[name] for name in candidates if wildmat(name, patterns)]
+
+
+class HeaderCache(object):
+    ## parsed headers by message-id, least recently used goes first
+    ## once the (approximate) size passes max_bytes.  an article
+    ## fetched by message-id never changes so nothing here goes stale.
+    ## shared by every session, so it locks.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _sizeof(message_id, header):
+        ## close enough: the text plus a little per entry
+        return 64 + len(message_id) + sum(len(k) + len(v) for k, v in header.items())
+
+    def get(self, message_id):
+        with self._lock:
+            try:
+                header, size = self._items[message_id]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items.move_to_end(message_id)
+            self.hits += 1
+            return header
+
+    def put(self, message_id, header):
+        size = self._sizeof(message_id, header)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(message_id, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._items[message_id] = (header, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.bytes -= evicted
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class DatePoints(object):
+    ## article number -> posting time (epoch seconds, server clock)
+    ## points per group, as found by GETGROUPSINCE's probes, so the
+    ## next search for a date starts from a narrower range.  article
+    ## numbers only go up, so a point stays good after it expires.
+    ## in memory, shared by every session, so it locks.
+    def __init__(self, max_points=4096):
+        ## per group, past that the oldest found half is dropped
+        self.max_points = max_points
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def add(self, group_name, number, posted):
+        with self._lock:
+            points = self._groups.setdefault(group_name, {})
+            points[number] = posted
+            if len(points) > self.max_points:
+                for k in list(points)[:len(points) // 2]:
+                    del points[k]
+
+    def bounds(self, group_name, posted):
+        ## (newest number known older than posted, oldest number
+        ## known at or after it), either None if there's none.
+        ## Date headers aren't always in order, points that
+        ## contradict each other are no help and give (None, None)
+        with self._lock:
+            points = list(self._groups.get(group_name, {}).items())
+        below = max((n for n, t in points if t < posted), default=None)
+        above = min((n for n, t in points if t >= posted), default=None)
+        if below is not None and above is not None and below >= above:
+            return None, None
+        return below, above
+
+    def forget(self, group_name):
+        with self._lock:
+            self._groups.pop(group_name, None)
@@ -0,0 +1,501 @@
+# clients for the daemon: Client for threads, AsyncClient for asyncio
+##
+## both keep a few connections to the daemon and tag every request
+## with an ID, so any number of requests can be outstanding on one
+## connection and finish in whatever order the daemon gets them done.
+## each request goes down the connection with the fewest outstanding.
+##
+##     c = Client('localhost', 1701)
+##     groups = c.get_groups('alt.binaries.*')
+##     pending = [c.submit('GETHEADER', {'message_spec': m}) for m in ids]
+##     headers = [p.result() for p in pending]
+##     for article_id, ovr in c.iter_group(group, (first, last)):
+##         ...
+##
+## iter_ methods stream, results are handed over a chunk at a time as
+## the daemon sends them.  overviews travel in the COLUMNAR format
+## and are turned back into the usual list here.  connections are
+## made lazily and a broken one is replaced on the next request.
+##
+## requests are spread over connections, and the daemon's GROUP
+## state is per connection, so always pass group_name.
+import queue
+import socket
+import asyncio
+import logging
+import itertools
+import threading
+
+from pynntpprox import settings, protocol
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+## articles per streamed chunk asked of the daemon
+STREAM_CHUNK = 1000
+## responses that end a request
+_FINAL = ('OK', 'END', 'ERR', 'NO')
+
+
+class ResponseError(Exception):
+    ## the daemon answered ERR (an NNTP error, code is the NNTP
+    ## response code) or NO (anything else, code is None)
+    def __init__(self, code, msg):
+        self.code = code
+        self.msg = msg
+        super(ResponseError, self).__init__('%s %s' % (code, msg) if code else msg)
+
+
+class ClientConnectionError(Exception):
+    ## the connection to the daemon went away mid request
+    pass
+
+
+def _message(request_id, cmd, arg, stream=None, fmt=None):
+    message = {'CMD': cmd, 'ARG': arg or {}, 'ID': request_id}
+    if stream:
+        message['STREAM'] = stream
+    if fmt:
+        message['FORMAT'] = fmt
+    return message
+
+
+def _check(response):
+    if response['RSP'] == 'ERR':
+        raise ResponseError(response['ARG']['code'], response['ARG']['message'])
+    if response['RSP'] == 'NO':
+        raise ResponseError(None, response['ARG'])
+    return response
+
+
+def _data(response, fmt):
+    ## the ARG of an OK or MORE, back in the usual shape
+    if fmt == protocol.COLUMNAR:
+        return protocol.decode_columnar(response['ARG'])
+    return response['ARG']
+
+
+class _Connection(object):
+    ## one socket to the daemon, a thread reading it hands each
+    ## response to the queue of the request it answers
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        ## request id: queue, or None once nobody is listening
+        self._waiting = {}
+        self._reader = threading.Thread(target=self._read_forever)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def send(self, request_id, message):
+        replies = queue.Queue()
+        with self._lock:
+            if self.closed:
+                raise ClientConnectionError('Connection closed')
+            self._waiting[request_id] = replies
+        data = protocol.encode(message, protocol.V2)
+        try:
+            with self._send_lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            self._fail(e)
+        return replies
+
+    def forget(self, request_id):
+        ## drop whatever is still to come for request_id
+        with self._lock:
+            if request_id in self._waiting:
+                self._waiting[request_id] = None
+
+    def _read_forever(self):
+        reader = protocol.FrameReader()
+        try:
+            while reader.recv_from(self.sock):
+                for version, frame in reader.frames():
+                    self._deliver(protocol.decode(frame))
+            error = ClientConnectionError('Connection closed by the daemon')
+        except Exception as e:
+            error = e
+        self._fail(error)
+
+    def _deliver(self, response):
+        request_id = response.get('ID')
+        with self._lock:
+            replies = self._waiting.get(request_id)
+            if response['RSP'] in _FINAL:
+                self._waiting.pop(request_id, None)
+        if replies is not None:
+            replies.put(response)
+        elif request_id is None:
+            ## only a message we couldn't even parse
+            ## comes back without an ID
+            log.error('Unmatched response: %s' % response)
+
+    def _fail(self, error):
+        with self._lock:
+            if not isinstance(error, ClientConnectionError):
+                error = ClientConnectionError(str(error))
+            self.closed = True
+            waiting, self._waiting = self._waiting, {}
+        for replies in waiting.values():
+            if replies is not None:
+                replies.put(error)
+        self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Pending(object):
+    ## a request on its way, see Client.submit
+    def __init__(self, connection, request_id, replies, fmt=None, timeout=None):
+        self._connection = connection
+        self._id = request_id
+        self._replies = replies
+        self._fmt = fmt
+        self._timeout = timeout
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def _next(self, timeout):
+        try:
+            response = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            self._connection.forget(self._id)
+            raise TimeoutError('No response in %s seconds' % timeout)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def result(self, timeout=None):
+        if not self._done:
+            try:
+                self._result = _data(_check(self._next(timeout or self._timeout)), self._fmt)
+            except ResponseError as e:
+                self._error = e
+            self._done = True
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def __iter__(self):
+        ## the items of a streamed request as they arrive
+        done = False
+        try:
+            while True:
+                response = _check(self._next(self._timeout))
+                if response['RSP'] != 'MORE':
+                    done = True
+                    return
+                for item in _data(response, self._fmt):
+                    yield item
+        finally:
+            if not done:
+                self._connection.forget(self._id)
+
+
+class _Commands(object):
+    ## the daemon's commands in terms of request and stream, shared
+    ## by Client and AsyncClient (whose methods are coroutines)
+    def get_groups(self, prefix=None):
+        return self.request('GETGROUPS', {'prefix': prefix})
+
+    def group(self, group_name):
+        return self.request('GROUP', {'group_name': group_name})
+
+    def get_group(self, group_name, message_spec, raw=False, fields=None, where=None):
+        return self.request('GETGROUP', {'message_spec': message_spec,
+                                         'group_name': group_name,
+                                         'raw': raw,
+                                         'fields': fields,
+                                         'where': where}, fmt=protocol.COLUMNAR)
+
+    def iter_group(self, group_name, message_spec, raw=False, fields=None, where=None,
+                   chunk_size=STREAM_CHUNK):
+        return self.stream('GETGROUP', {'message_spec': message_spec,
+                                        'group_name': group_name,
+                                        'raw': raw,
+                                        'fields': fields,
+                                        'where': where}, chunk_size, fmt=protocol.COLUMNAR)
+
+    def get_group_since(self, group_name, since, raw=False, fields=None, where=None):
+        return self.request('GETGROUPSINCE', {'group_name': group_name,
+                                              'since': since,
+                                              'raw': raw,
+                                              'fields': fields,
+                                              'where': where}, fmt=protocol.COLUMNAR)
+
+    def iter_group_since(self, group_name, since, raw=False, fields=None, where=None,
+                         chunk_size=STREAM_CHUNK):
+        return self.stream('GETGROUPSINCE', {'group_name': group_name,
+                                             'since': since,
+                                             'raw': raw,
+                                             'fields': fields,
+                                             'where': where}, chunk_size, fmt=protocol.COLUMNAR)
+
+    def get_hdr(self, group_name, header, message_spec, pattern=None, raw=False):
+        return self.request('GETHDR', {'header': header,
+                                       'message_spec': message_spec,
+                                       'group_name': group_name,
+                                       'pattern': pattern,
+                                       'raw': raw})
+
+    def iter_hdr(self, group_name, header, message_spec, pattern=None, raw=False,
+                 chunk_size=STREAM_CHUNK):
+        return self.stream('GETHDR', {'header': header,
+                                      'message_spec': message_spec,
+                                      'group_name': group_name,
+                                      'pattern': pattern,
+                                      'raw': raw}, chunk_size)
+
+    def get_header(self, message_spec, group_name=None):
+        return self.request('GETHEADER', {'message_spec': message_spec,
+                                          'group_name': group_name})
+
+    def get_headers(self, message_specs, group_name=None):
+        return self.request('GETHEADERS', {'message_specs': list(message_specs),
+                                           'group_name': group_name})
+
+    def iter_headers(self, message_specs, group_name=None, chunk_size=STREAM_CHUNK):
+        return self.stream('GETHEADERS', {'message_specs': list(message_specs),
+                                          'group_name': group_name}, chunk_size)
+
+    def get_body(self, message_spec, group_name=None, path=None, decode=True):
+        ## the daemon writes the file, this is where and what it said
+        return self.request('GETBODY', {'message_spec': message_spec,
+                                        'group_name': group_name,
+                                        'path': path,
+                                        'decode': decode})
+
+    def get_article(self, message_spec, group_name=None, path=None, decode=True):
+        return self.request('GETARTICLE', {'message_spec': message_spec,
+                                           'group_name': group_name,
+                                           'path': path,
+                                           'decode': decode})
+
+    def iter_body(self, message_spec, group_name=None, decode=True):
+        ## blocks of the body's data instead
+        return self.stream('GETBODY', {'message_spec': message_spec,
+                                       'group_name': group_name,
+                                       'decode': decode}, True)
+
+    def stats(self):
+        return self.request('STATS')
+
+
+class Client(_Commands):
+    def __init__(self, host='localhost', port=settings.LISTEN_PORT,
+                 connections=2, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = connections
+        ## seconds to wait for a connection or a response, None for ever
+        self.timeout = timeout
+        self._connections = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def _connection(self):
+        ## the least busy connection, opening another while
+        ## we are under size and every open one is busy
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.closed]
+            idle = min(self._connections, key=len, default=None)
+            if idle is not None and (not len(idle) or len(self._connections) >= self.size):
+                return idle
+            connection = _Connection(self.host, self.port, self.timeout)
+            self._connections.append(connection)
+            return connection
+
+    def submit(self, cmd, arg=None, stream=None, fmt=None):
+        ## sends the request and returns straight away.  the Pending's
+        ## result() waits for the answer, or iterate it when streaming
+        request_id = next(self._ids)
+        connection = self._connection()
+        replies = connection.send(request_id, _message(request_id, cmd, arg, stream, fmt))
+        return Pending(connection, request_id, replies, fmt, self.timeout)
+
+    def request(self, cmd, arg=None, fmt=None):
+        return self.submit(cmd, arg, fmt=fmt).result()
+
+    def stream(self, cmd, arg=None, chunk_size=STREAM_CHUNK, fmt=None):
+        return iter(self.submit(cmd, arg, stream=chunk_size, fmt=fmt))
+
+
+class _AsyncConnection(object):
+    ## _Connection for asyncio, a task reads instead of a thread
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._waiting = {}
+        self._task = asyncio.ensure_future(self._read_forever())
+
+    @classmethod
+    async def open(kls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return kls(reader, writer)
+
+    def __len__(self):
+        return len(self._waiting)
+
+    async def send(self, request_id, message):
+        if self.closed:
+            raise ClientConnectionError('Connection closed')
+        replies = asyncio.Queue()
+        self._waiting[request_id] = replies
+        self.writer.write(protocol.encode(message, protocol.V2))
+        try:
+            await self.writer.drain()
+        except OSError as e:
+            self._fail(e)
+        return replies
+
+    def forget(self, request_id):
+        if request_id in self._waiting:
+            self._waiting[request_id] = None
+
+    async def _read_forever(self):
+        frames = protocol.FrameReader()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                frames.feed(data)
+                for version, frame in frames.frames():
+                    self._deliver(protocol.decode(frame))
+            error = ClientConnectionError('Connection closed by the daemon')
+        except asyncio.CancelledError:
+            error = ClientConnectionError('Connection closed')
+        except Exception as e:
+            error = e
+        self._fail(error)
+
+    def _deliver(self, response):
+        request_id = response.get('ID')
+        replies = self._waiting.get(request_id)
+        if response['RSP'] in _FINAL:
+            self._waiting.pop(request_id, None)
+        if replies is not None:
+            replies.put_nowait(response)
+        elif request_id is None:
+            log.error('Unmatched response: %s' % response)
+
+    def _fail(self, error):
+        if not isinstance(error, ClientConnectionError):
+            error = ClientConnectionError(str(error))
+        self.closed = True
+        waiting, self._waiting = self._waiting, {}
+        for replies in waiting.values():
+            if replies is not None:
+                replies.put_nowait(error)
+        self.writer.close()
+
+    def close(self):
+        if not self.closed:
+            self._task.cancel()
+        self.closed = True
+        self.writer.close()
+
+
+class AsyncClient(_Commands):
+    ## Client for asyncio: request and the get_ methods are
+    ## coroutines, stream and the iter_ methods async iterators
+    ##
+    ##     async with AsyncClient('localhost', 1701) as c:
+    ##         header = await c.get_header(message_id)
+    ##         async for article_id, ovr in c.iter_group(group, (first, last)):
+    ##             ...
+    def __init__(self, host='localhost', port=settings.LISTEN_PORT,
+                 connections=2, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = connections
+        self.timeout = timeout
+        self._connections = []
+        self._ids = itertools.count(1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    async def _connection(self):
+        self._connections = [c for c in self._connections if not c.closed]
+        idle = min(self._connections, key=len, default=None)
+        if idle is not None and (not len(idle) or len(self._connections) >= self.size):
+            return idle
+        connection = await asyncio.wait_for(_AsyncConnection.open(self.host, self.port),
+                                            self.timeout)
+        self._connections.append(connection)
+        return connection
+
+    async def _send(self, cmd, arg, stream=None, fmt=None):
+        request_id = next(self._ids)
+        connection = await self._connection()
+        replies = await connection.send(request_id, _message(request_id, cmd, arg, stream, fmt))
+        return connection, request_id, replies
+
+    async def _next(self, connection, request_id, replies):
+        try:
+            response = await asyncio.wait_for(replies.get(), self.timeout)
+        except asyncio.TimeoutError:
+            connection.forget(request_id)
+            raise
+        if isinstance(response, Exception):
+            raise response
+        return _check(response)
+
+    async def request(self, cmd, arg=None, fmt=None):
+        pending = await self._send(cmd, arg, fmt=fmt)
+        return _data(await self._next(*pending), fmt)
+
+    async def stream(self, cmd, arg=None, chunk_size=STREAM_CHUNK, fmt=None):
+        pending = await self._send(cmd, arg, chunk_size, fmt)
+        done = False
+        try:
+            while True:
+                response = await self._next(*pending)
+                if response['RSP'] != 'MORE':
+                    done = True
+                    return
+                for item in _data(response, fmt):
+                    yield item
+        finally:
+            if not done:
+                pending[0].forget(pending[1])
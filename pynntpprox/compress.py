@@ -0,0 +1,165 @@
+# compressed transfers: RFC 8054 COMPRESS DEFLATE, XFEATURE
+# COMPRESS GZIP and XZVER.  all of them end up as plain
+# lines of text, these turn the compressed bytes back into those.
+import zlib
+
+from . import yenc
+
+
+class DeflateFile(object):
+    ## stands in for nntplib's socket file once COMPRESS DEFLATE
+    ## is on.  everything written is deflated and sync flushed on
+    ## flush(), everything read is inflated on the way in.  only
+    ## the bits of the file interface nntplib uses are here.
+    chunk = 65536
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                         zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._buf = b''
+        self._pos = 0
+        # bytes off the wire / bytes after inflating
+        self.wire_bytes = 0
+        self.bytes = 0
+
+    def readline(self, limit=-1):
+        while 1:
+            end = self._buf.find(b'\n', self._pos)
+            if end >= 0:
+                end += 1
+                break
+            if 0 < limit <= len(self._buf) - self._pos:
+                end = self._pos + limit
+                break
+            data = self._raw.read1(self.chunk)
+            if not data:
+                end = len(self._buf)
+                break
+            self.wire_bytes += len(data)
+            data = self._inflate.decompress(data)
+            self.bytes += len(data)
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+        if 0 < limit < end - self._pos:
+            end = self._pos + limit
+        line = self._buf[self._pos:end]
+        self._pos = end
+        return line
+
+    def write(self, data):
+        self._raw.write(self._deflate.compress(data))
+
+    def flush(self):
+        self._raw.write(self._deflate.flush(zlib.Z_SYNC_FLUSH))
+        self._raw.flush()
+
+    def close(self):
+        self._raw.close()
+
+
+class PushbackFile(object):
+    ## stands in for nntplib's socket file once XFEATURE COMPRESS GZIP
+    ## is on.  gzip bodies are read a chunk at a time and a chunk can
+    ## run past the end of one into whatever follows it, the next
+    ## pipelined response say.  what was read too far is unread()
+    ## and handed out again before anything new off the socket.
+    def __init__(self, raw):
+        self._raw = raw
+        self._back = b''
+
+    def unread(self, data):
+        self._back = data + self._back
+
+    def read1(self, size=-1):
+        if not self._back:
+            return self._raw.read1(size)
+        end = len(self._back) if size < 0 else size
+        data, self._back = self._back[:end], self._back[end:]
+        return data
+
+    def readline(self, limit=-1):
+        if not self._back:
+            return self._raw.readline(limit)
+        end = self._back.find(b'\n') + 1 or len(self._back)
+        if 0 < limit < end:
+            end = limit
+        line, self._back = self._back[:end], self._back[end:]
+        if line.endswith(b'\n') or 0 < limit <= len(line):
+            return line
+        return line + self._raw.readline(limit - len(line) if limit > 0 else -1)
+
+    def write(self, data):
+        return self._raw.write(data)
+
+    def flush(self):
+        self._raw.flush()
+
+    def close(self):
+        self._raw.close()
+
+
+def _lines(pending, data):
+    ## split freshly inflated data into complete lines,
+    ## returning them with what is left over
+    *lines, pending = (pending + data).split(b'\n')
+    return [line.rstrip(b'\r') for line in lines], pending
+
+
+def iter_gzip_lines(raw, chunk=65536):
+    ## the body of an XFEATURE COMPRESS GZIP response, raw being the
+    ## socket file (a PushbackFile) positioned just after the status
+    ## line.  yields the
+    ## text lines, stopping at the terminating '.' line (which some
+    ## servers compress and some don't).  with TERMINATOR the server
+    ## sends an uncompressed '.' line after the compressed block.
+    inflate = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    pending = b''
+    done = False
+    while not inflate.eof:
+        data = raw.read1(chunk)
+        if not data:
+            raise EOFError
+        lines, pending = _lines(pending, inflate.decompress(data))
+        for line in lines:
+            if done:
+                continue
+            if line == b'.':
+                done = True
+                continue
+            if line.startswith(b'..'):
+                line = line[1:]
+            yield line
+    if pending and not done and pending.rstrip(b'\r') != b'.':
+        yield pending.rstrip(b'\r')
+
+    ## the (uncompressed) TERMINATOR line, anything after it is
+    ## the next response's and goes back for it to be read from
+    tail = inflate.unused_data
+    while b'\n' not in tail:
+        data = raw.read1(chunk)
+        if not data:
+            raise EOFError
+        tail += data
+    rest = tail[tail.index(b'\n') + 1:]
+    if rest:
+        raw.unread(rest)
+
+
+def iter_xzver_lines(lines):
+    ## XZVER sends the overview deflated and then yEnc'd,
+    ## lines is the yEnc text (already dot-unstuffed)
+    inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+    pending = b''
+    for line in lines:
+        if yenc.is_control(line):
+            continue
+        out, pending = _lines(pending, inflate.decompress(yenc.decode_line(line)))
+        for line in out:
+            if line and line != b'.':
+                yield line
+    out, pending = _lines(pending, inflate.flush())
+    for line in out + [pending.rstrip(b'\r')]:
+        if line and line != b'.':
+            yield line
@@ -6,23 +6,23 @@ import socket
 import logging
 import select
 import queue
+import threading
 import traceback
 import time
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pynntpprox import settings
-from pynntpprox.nntp import NNTPClient, ConnectionError, RequestError
+from pynntpprox import protocol
+from pynntpprox import stats
+from pynntpprox.nntp import ConnectionError, RequestError
+from pynntpprox.service import NNTPService
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s')
 log = logging.getLogger(__name__)
 log.setLevel('DEBUG')
 
-DELIMITER = b"\x00~~EOM~~\x00"
-
 
 def printgroups(c):
     grps = c.getgroups(prefix='alt.binaries.*')
@@ -37,12 +37,11 @@ def printgroup(c, group, f, l):
             sys.stdout.write('\t%s: %s\n' % (k, v))
 
 
-class Break(Exception):
+class StreamStalled(Exception):
     pass
 
-if __name__ == '__main__':
-    #printgroup(c, 'alt.binaries.teevee', 452267550, 452267563)
 
+class DaemonProx(object):
     '''
     COMMANDS:
         {'CMD': 'GROUP',
@@ -50,296 +49,710 @@ if __name__ == '__main__':
 
 
         Takes Args
-        GETGROUPS: returns a list of groups 
-            prefix (str)
+        GETGROUPS: returns a list of groups, from a copy of the active
+                   list kept up to date with NEWGROUPS (see
+                   NNTPService.get_groups)
+            prefix (str) a wildmat, e.g. 'alt.binaries.*'
         GROUP: select a group, returns details about it
             group_name (str)
         GETGROUP: returns a list of articles/messages with short header info
             message_spec (str or list of first/last article ids)
-            group_name (str) 
+            group_name (str)
+            raw (bool) skip RFC 2047 decoding of the header values
+            fields (list of str) the overview keys to send, e.g.
+                                 ['subject', 'message-id', 'bytes']
+            where (dict) only send articles matching all of 'subject'
+                         and 'from' (regexes), 'min_bytes' and
+                         'max_bytes' (see nntp.OverviewFilter)
+        GETGROUPSINCE: GETGROUP for the articles posted since a date,
+                       found by bisecting the group on article Dates
+                       (see NNTPService.iter_group_since), no further
+                       back than the server's RETENTION
+            group_name (str)
+            since (datetime, naive local time, or epoch seconds)
+            raw, fields, where as GETGROUP
         GETHEADER: gets the entire header, parsed, for a single article
             message_spec (str)
-            group_name (str) 
+            group_name (str)
+        GETHEADERS: GETHEADER for many articles, returns a list of
+                    (message_spec, header) with header None for
+                    articles the server doesn't have
+            message_specs (list of str or article ids)
+            group_name (str)
+        GETHDR: one header across a range of articles, as a list of
+                (article_number, value), through HDR/XHDR, which
+                moves far less than GETGROUP when that's all you need
+            header (str) e.g. 'subject', or ':bytes'
+            message_spec (str or list of first/last article ids)
+            group_name (str)
+            pattern (str) a wildmat, only articles whose value
+                          matches (XPAT, where the server has it)
+            raw (bool) as GETGROUP
+        SYNC: the articles of a group not yet handed to this consumer,
+              tracked by a high/low-water mark kept on disk (see
+              NNTPService.iter_sync).  returns GROUP's dict plus the
+              new 'low' and 'high' marks and 'articles', as GETGROUP.
+              the marks move once the answer has been sent, or each
+              MORE when streamed
+            group_name (str)
+            name (str) the consumer, marks are kept per name
+            backfill (int) articles to also fetch below the low mark
+            limit (int) most new articles to fetch in one go
+            initial (int) how far back a group's first SYNC starts,
+                          settings.SYNC_INITIAL by default
+            reset (bool) forget the marks and start over
+            raw, fields, where as GETGROUP
+        GETBODY: an article's body, yEnc decoded and CRC32 checked as
+                 it comes off the socket and written to a file (see
+                 NNTPService.get_body).  returns the 'path' written and
+                 what the yEnc lines said: 'name', 'size', 'part',
+                 'begin', 'end', 'bytes' and 'crc32'.  streamed, the
+                 decoded data comes back instead, a block of
+                 settings.BODY_BLOCK bytes to a MORE
+            message_spec (str)
+            group_name (str)
+            path (str) the file to write, by default the yEnc name in
+                       settings.DOWNLOAD_DIR.  the parts of a multipart
+                       post each go at their own offset, so fetching
+                       them all into one path puts the file together
+            decode (bool) False for the body as sent
+        GETARTICLE: GETBODY through ARTICLE, also returns the parsed
+                    'header'.  not streamed
 
         No Args
         DATE: gets what time the server thinks it is (naieve UTC for now)
              but only because we know that's what we get from usenetserver
+        STATS: per command latency histograms, bytes in and out, errors
+               by NNTP code, NNTP round trip times and pool, session and
+               cache occupancy (see stats.Stats).  the same numbers are
+               served as plaintext on settings.METRICS_PORT if it is set
+
+        Streaming
+        adding 'STREAM': True (or a number of articles per chunk) to
+        a GETGROUP, GETGROUPSINCE, GETHDR, GETHEADERS, GETBODY or SYNC
+        message sends the result back in pieces as it is read from
+        the server.
+
+    FRAMING:
+        v1: the pickled message followed by protocol.DELIMITER
+        v2: protocol.MAGIC, a 4 byte big endian length, then the
+            pickled message
+
+        both are accepted on the same connection, responses are
+        framed the same way as the request they answer.
 
     RESPONSES:
         {'RSP': 'OK',
          'ARG': <data> or (str) }
-    '''
-       
 
-    host = '0.0.0.0' 
-    port = 1701
-    backlog = 5 
-    size = 1024
+        Streamed responses are a run of
+        {'RSP': 'MORE',
+         'ARG': [<chunk of data>] }
+        terminated by
+        {'RSP': 'END',
+         'ARG': <total count> }
+        (SYNC's END has the rest of its answer instead)
+        or by an 'ERR'/'NO' response if the request failed part way,
+        or the client stopped reading for settings.STREAM_STALL
+        seconds (see _wait_for_room).
+
+        Request IDs
+        a message carrying an 'ID' (any picklable value) has it copied
+        into every response it gets, MORE and END included.  requests
+        with an ID don't wait for each other: up to
+        settings.SESSION_CONCURRENCY of them from one session run at
+        once and their responses come back in whatever order they
+        finish, interleaved a message at a time.  a request without
+        an ID still waits for everything before it and holds up
+        everything after it, so clients that never send IDs see
+        responses in order, as before.  requests running side by side
+        should name their group_name rather than rely on GROUP.
+
+        Formats
+        adding 'FORMAT': 'COLUMNAR' to a GETGROUP (or GETGROUPSINCE)
+        message sends the overviews column-wise (see
+        protocol.encode_columnar), each streamed chunk is encoded on
+        its own.  protocol.decode_columnar turns it back into the
+        usual list.
+
+    The select loop only ever does socket work.  Every NNTP call
+    runs on a shared pool of worker threads, which post the finished
+    response back to the loop and poke a wakeup socket so select()
+    returns.  Requests from one session are run one at a time, in
+    order, so responses come back in the order they were asked,
+    unless they carry an ID (see above).
+
+    Sessions do not own an NNTP connection, requests borrow one from
+    the service's pool.  The group selected with GROUP is remembered
+    per session and passed along with later GETGROUP/GETHEADER calls.
+    '''
+    ## bytes asked for per recv_into
+    recv_size = 65536
     max_session_age = 30 # seconds
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-    server.bind((host,port)) 
-    server.listen(backlog) 
-    server.setblocking(False)
-    ## this is equivalent to the # of connections
-    ## the NNTP server supports.. 
-    MAX_SESSIONS = settings.SERVERS['default']['CONNECTIONS']
-
-    sessions = {}
-    inputs = [server]
-    outputs = []
-
-    try:
-        while inputs: 
-            ## check sessions
-            skeys = list(sessions.keys())
-            skeys_len = len(skeys) 
-            for i, s in enumerate(skeys):
-                now = time.time()
-                delta = now - sessions[s]['mod']
-                #log.info('session(%s/%s) (%s - %s) %s vs %s' \
-                #% (i+1, skeys_len, now, sessions[s]['mod'],
-                #           delta, max_session_age))
-                log.info('session(%s/%s) %s vs %s' \
-                            % (i+1, skeys_len, delta, max_session_age))
-                if delta > max_session_age:
-                    log.info('Session timed out: %s' % s)
-                    # kill session
-                    sessions[s]['nntp']._disconnect()
-                    keys = sessions[s].keys()
-                    for k in list(keys):
-                        del sessions[s][k]
-                    del sessions[s]
-
-            readsock, writesock, errorsock = select.select(inputs,
-                                                           outputs,
-                                                           inputs)
-            ## Handle inputs
-            for s in readsock:
-                ## accept
-                if s is server:
-                    connection, client_address = s.accept()
-                    log.debug('Connection from: %s:%s' % client_address)
-                    if len(sessions.keys()) >= MAX_SESSIONS:
-                        log.info('Max sessions reached')
-                        connection.close()
-                        continue
-                    # Give the connection a queue for data we want to send
-                    try:
-                        nntpc = NNTPClient(settings.SERVERS['default'])
-                        sessions[connection] = {'q': queue.Queue(),
-                                                'nntp': nntpc,
-                                                'data': b'',
-                                                'mod': time.time()}
-                    except ConnectionError as e:
-                        log.info('Max NNTP sessions reached: [%s: %s]' \
-                                                % (e.code, e.msg))
-                        connection.close()
-                        continue
-                        
-                    connection.setblocking(0)
-                    inputs.append(connection)
-
-                ## read
-                else:
-                    ## This is vulnerable to failures
-                    ## "Connection reset by peer"
-                    r, w, e = select.select([s], [], [], 0)
-
-                    data = None
-                    if s not in sessions: 
-                        if s in outputs:
-                            outputs.remove(s)
-                        if s in inputs:
-                            inputs.remove(s)
-                        log.debug('%s session expired. closing.' % cliaddr) 
-                        s.close()
-                    elif r:
-                        ## This is vulnerable to failures
-                        ## "Connection reset by peer"
-                        try:
-                            data = s.recv(size)
-                        except ConnectionResetError:
-                            data = None
-
-                        if data:
-                            # A readable client socket has data
-                            cliaddr = '%s:%s' % s.getpeername()
-                            log.debug('received %s bytes from %s' % (len(data),
-                                                                     cliaddr))
-                            sessions[s]['q'].put(data)
-                            sessions[s]['mod'] = time.time()
-                            # Add output channel for response
-                            if s not in outputs:
-                                outputs.append(s)
-                        else:
-                            # Stop listening for input on the connection
-                            if s in outputs:
-                                outputs.remove(s)
-                            if s in inputs:
-                                inputs.remove(s)
-                            s.close()
-                            log.debug('closing %s for inactivity' % cliaddr) 
-                            sessions[s]['nntp']._disconnect()
-                            keys = sessions[s].keys()
-                            for k in list(keys):
-                                del sessions[s][k]
-                            del sessions[s]
-                    else:
-                        log.debug('Recv error')
-
-            ## handle output
-            for s in writesock:
-                ## we removed it earlier..
-                if s not in outputs:
-                    continue
-
-                ## succeptable to: OSError: [Errno 107]
-                ## Transport endpoint is not connected
-                cliaddr = '%s:%s' % s.getpeername()
-                cli_data = None
+    ## how long select() may block before we look at session ages
+    tick = 1.0
+    ## articles per streamed chunk
+    stream_chunk = 1000
+
+    def __init__(self, host=settings.LISTEN_HOST, port=settings.LISTEN_PORT,
+                 backlog=5, config=None, service=None,
+                 high_water=settings.HIGH_WATER, metrics_port=settings.METRICS_PORT,
+                 servers=None, sock=None):
+        ## config is a single server's, servers several (shaped like
+        ## settings.SERVERS), otherwise every one in settings.SERVERS
+        if service is None:
+            if config is not None:
+                service = NNTPService(config)
+            else:
+                service = NNTPService(servers=servers or settings.SERVERS)
+        self.service = service
+        self.config = service._conf
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(backlog)
+        ## (or one already listening, shared with
+        ## other worker processes, see prefork.py)
+        self.server = sock
+        self.server.setblocking(False)
+        ## client sessions no longer map to NNTP connections
+        self.max_sessions = settings.MAX_SESSIONS
+        ## requests with an ID one session may have running at once
+        self.concurrency = settings.SESSION_CONCURRENCY
+        ## once this much is waiting to go out to a client we stop
+        ## reading its requests and hold up its streams, until it
+        ## drains back down to low_water
+        self.high_water = high_water
+        self.low_water = high_water // 2
+        ## seconds a paused stream waits on its client before giving up
+        self.stream_stall = settings.STREAM_STALL
+        self.executor = ThreadPoolExecutor(max_workers=settings.WORKERS)
+
+        ## workers hand back (socket, response) pairs through here
+        self.results = queue.Queue()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+        self.sessions = {}
+        self.inputs = [self.server, self._wake_r]
+        self.outputs = []
+
+        self.stats = stats.STATS
+        self.stats.gauges['sessions'] = self._session_stats
+        self.stats.gauges['pool'] = self.service.pool.stats
+        self.stats.gauges['servers'] = self.service.router.stats
+        if self.service.headers is not None:
+            self.stats.gauges['header_cache'] = self.service.headers.stats
+        if self.service.flights is not None:
+            self.stats.gauges['coalesced'] = self.service.flights.stats
+        self.metrics = None
+        if metrics_port:
+            self.metrics = stats.serve_metrics(host, metrics_port, self.stats)
+
+    def serve_forever(self):
+        self.service.warm()
+        try:
+            while self.inputs:
+                self._expire_sessions()
+
+                readsock, writesock, errorsock = select.select(self.inputs,
+                                                               self.outputs,
+                                                               self.inputs,
+                                                               self.tick)
+                ## Handle inputs
+                for s in readsock:
+                    if s is self.server:
+                        self._accept()
+                    elif s is self._wake_r:
+                        self._collect_results()
+                    elif s in self.sessions:
+                        self._read(s)
+
+                ## handle output
+                for s in writesock:
+                    ## we removed it earlier..
+                    if s in self.sessions and s in self.outputs:
+                        self._write(s)
+
+                # Handle "exceptional conditions"
+                for s in errorsock:
+                    if s in self.sessions:
+                        log.debug('handling error condition for %s' \
+                                    % self.sessions[s]['addr'])
+                        self._close(s)
+        except:
+            log.debug('Fatal error')
+            log.debug(traceback.format_exc())
+        finally:
+            ## close the entire socket if we broke the main loop
+            ## e.g. above here would be some basic signal handling
+            log.info('Shutting down...')
+            for s in list(self.sessions.keys()):
+                self._close(s)
+            for s in self.outputs + self.inputs:
+                s.close()
+            self.executor.shutdown(wait=False)
+            self.service.close()
+            if self.metrics is not None:
+                self.metrics.shutdown()
+            self._wake_w.close()
+
+    def _expire_sessions(self):
+        now = time.time()
+        for s in list(self.sessions.keys()):
+            session = self.sessions[s]
+            ## a session waiting on a slow NNTP call
+            ## or a slow reader is not idle
+            if session['running'] or session['pending'] or session['out']:
+                continue
+            if now - session['mod'] > self.max_session_age:
+                log.info('Session timed out: %s' % session['addr'])
+                self._close(s)
+
+    def _accept(self):
+        try:
+            connection, client_address = self.server.accept()
+        except BlockingIOError:
+            ## another worker process got there first
+            return
+        log.debug('Connection from: %s:%s' % client_address)
+        if len(self.sessions.keys()) >= self.max_sessions:
+            log.info('Max sessions reached')
+            connection.close()
+            return
+
+        connection.setblocking(0)
+        self.sessions[connection] = {'pending': deque(),
+                                     ## requests on workers, and whether
+                                     ## one without an ID is among them
+                                     'running': 0,
+                                     'exclusive': False,
+                                     'group': None,
+                                     'data': protocol.FrameReader(self.recv_size,
+                                                                  settings.MAX_FRAME),
+                                     ## responses waiting to be sent,
+                                     ## and how far into the first
+                                     ## one we are
+                                     'out': deque(),
+                                     'offset': 0,
+                                     'paused': False,
+                                     ## bytes posted but not yet sent,
+                                     ## shared with the worker
+                                     'queued': 0,
+                                     ## when the client last took any
+                                     'drained': time.time(),
+                                     'cond': threading.Condition(),
+                                     'closed': False,
+                                     'addr': '%s:%s' % client_address,
+                                     'mod': time.time()}
+        self.inputs.append(connection)
+
+    def _close(self, s):
+        if s in self.outputs:
+            self.outputs.remove(s)
+        if s in self.inputs:
+            self.inputs.remove(s)
+        s.close()
+        session = self.sessions.pop(s, None)
+        if session is not None:
+            ## wake up a worker waiting to stream to us
+            with session['cond']:
+                session['closed'] = True
+                session['cond'].notify_all()
+
+    def _read(self, s):
+        session = self.sessions[s]
+        ## This is vulnerable to failures
+        ## "Connection reset by peer"
+        try:
+            n = session['data'].recv_from(s, self.recv_size)
+        except ConnectionResetError:
+            n = 0
+
+        if not n:
+            log.debug('closing %s for inactivity' % session['addr'])
+            self._close(s)
+            return
+
+        log.debug('received %s bytes from %s' % (n, session['addr']))
+        session['mod'] = time.time()
+
+        ## hand every complete message to the worker.  they are
+        ## unpickled here, straight off the receive buffer
+        try:
+            for version, frame in session['data'].frames():
                 try:
-                    cli_data = sessions[s]['q'].get_nowait()
-                    ## could be some, or all of a message
-                except queue.Empty:
-                    log.debug('message queue for %s is empty' % cliaddr)
-                    outputs.remove(s)
-                else:
-                    sessions[s]['data'] += cli_data
-
-                ## service as many messages in queue for this
-                ## client as is available.
-                ## PROCESS LOOP
+                    mdata = protocol.decode(frame)
+                except Exception as e:
+                    mdata = e
+                session['pending'].append((version, mdata, len(frame), time.time()))
+        except ValueError as e:
+            log.info('(%s) %s, closing' % (session['addr'], e))
+            self._close(s)
+            return
+        self._dispatch(s, session)
+
+    def _dispatch(self, s, session):
+        ## starts what can start, in arrival order: requests with an
+        ## ID alongside each other, one without an ID on its own
+        pending = session['pending']
+        while pending and not session['exclusive']:
+            if self._request_id(pending[0][1]) is None:
+                if session['running']:
+                    break
+                session['exclusive'] = True
+            elif session['running'] >= self.concurrency:
+                break
+            session['running'] += 1
+            self.executor.submit(self._run, s, session, *pending.popleft())
+
+    @staticmethod
+    def _request_id(mdata):
+        if isinstance(mdata, dict):
+            return mdata.get('ID')
+        return None
+
+    def _write(self, s):
+        ## only called once select says s is writable.  sends as much
+        ## as the kernel will take without copying what is left over
+        session = self.sessions[s]
+        out = session['out']
+        sent = 0
+        try:
+            while out:
+                with memoryview(out[0]) as view:
+                    n = s.send(view[session['offset']:])
+                sent += n
+                session['offset'] += n
+                if session['offset'] < len(out[0]):
+                    ## socket buffer is full
+                    break
+                out.popleft()
+                session['offset'] = 0
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            log.error('Send error %s' % e)
+            self._close(s)
+            return
+
+        if sent:
+            log.debug('(%s)(%s) SEND %s bytes' \
+                        % (session['addr'], len(self.sessions), sent))
+        with session['cond']:
+            session['queued'] -= sent
+            queued = session['queued']
+            if sent:
+                session['drained'] = time.time()
+            session['cond'].notify_all()
+
+        if not out:
+            self.outputs.remove(s)
+        if session['paused'] and queued <= self.low_water:
+            ## client caught up, listen to it again
+            session['paused'] = False
+            self.inputs.append(s)
+
+    def _post(self, s, resp):
+        ## called from worker threads, a resp of None
+        ## means the request is finished
+        self.results.put((s, resp))
+        try:
+            self._wake_w.send(b'\x00')
+        except (BlockingIOError, OSError):
+            ## the loop already has a wakeup pending
+            pass
+
+    def _collect_results(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while 1:
+            try:
+                s, resp = self.results.get_nowait()
+            except queue.Empty:
+                break
+            session = self.sessions.get(s)
+            if session is None:
+                ## client went away while we were busy
+                continue
+            session['mod'] = time.time()
+            if resp is None:
+                session['running'] -= 1
+                if not session['running']:
+                    session['exclusive'] = False
+                self._dispatch(s, session)
+                continue
+            session['out'].append(resp)
+            if s not in self.outputs:
+                self.outputs.append(s)
+            if not session['paused'] and session['queued'] > self.high_water:
+                log.debug('(%s) paused' % session['addr'])
+                session['paused'] = True
+                self.inputs.remove(s)
+
+    def _run(self, s, session, version, mdata, size, received):
+        ## runs on a worker thread
+        responses = self._process(session, mdata)
+        request_id = self._request_id(mdata)
+        sent = 0
+        error = None
+        try:
+            for sdata in responses:
+                error = self._error_code(sdata) or error
+                if request_id is not None:
+                    sdata['ID'] = request_id
+                ## RESPOND
+                resp = protocol.encode(sdata, version)
+                if not self._wait_for_room(session, len(resp)):
+                    ## client is gone, stop producing
+                    break
+                self._post(s, resp)
+                sent += len(resp)
+        except StreamStalled as e:
+            ## closing responses below hangs up the upstream
+            ## connection it was reading, the pool opens another
+            log.info('(%s) %s' % (session['addr'], e))
+            sdata = {'RSP': 'NO',
+                     'ARG': 'Stream Aborted: %s' % e}
+            error = 'NO'
+            if request_id is not None:
+                sdata['ID'] = request_id
+            self._post(s, protocol.encode(sdata, version))
+        except Exception as e:
+            log.error(traceback.format_exc())
+            sdata = {'RSP': 'NO',
+                     'ARG': 'Unknown Error: %s' % e}
+            error = 'NO'
+            if request_id is not None:
+                sdata['ID'] = request_id
+            self._post(s, protocol.encode(sdata, version))
+        finally:
+            responses.close()
+            self._post(s, None)
+            cmd = mdata.get('CMD') if isinstance(mdata, dict) else None
+            self.stats.request(cmd, time.time() - received, size, sent, error)
+
+    @staticmethod
+    def _error_code(sdata):
+        if sdata['RSP'] == 'ERR':
+            return sdata['ARG']['code']
+        if sdata['RSP'] == 'NO':
+            return 'NO'
+        return None
+
+    def _session_stats(self):
+        sessions = list(self.sessions.values())
+        return {'count': len(sessions),
+                'max': self.max_sessions,
+                'running': sum(session['running'] for session in sessions),
+                'pending': sum(len(session['pending']) for session in sessions),
+                'paused': sum(1 for session in sessions if session['paused']),
+                'queued_bytes': sum(session['queued'] for session in sessions)}
+
+    def _wait_for_room(self, session, size):
+        ## keeps a streaming request from running ahead of a slow
+        ## client.  one that takes nothing for stream_stall seconds
+        ## loses the request (StreamStalled) rather than keep a worker
+        ## and an upstream connection waiting on it.  False once it's
+        ## gone
+        start = time.time()
+        with session['cond']:
+            while session['queued'] > self.high_water and not session['closed']:
+                left = max(start, session['drained']) + self.stream_stall - time.time()
+                if left <= 0:
+                    raise StreamStalled('client took nothing for %ss' % self.stream_stall)
+                session['cond'].wait(left)
+            if session['closed']:
+                return False
+            session['queued'] += size
+            return True
+
+    def _group(self, session, group_name=None):
+        ## GROUP without a name answers from the session
+        if group_name is None:
+            return session['group']
+        session['group'] = self.service.group(group_name)
+        return session['group']
+
+    def _in_group(self, session, action):
+        ## the session's selected group is the default, naming
+        ## a group selects it for the session, as it would in NNTP
+        def _inner(*args, group_name=None, **kwargs):
+            if group_name is None:
+                group_name = (session['group'] or {}).get('group')
+            elif group_name != (session['group'] or {}).get('group'):
+                session['group'] = {'group': group_name}
+            return action(*args, group_name=group_name, **kwargs)
+        return _inner
+
+    def _process(self, session, mdata):
+        ## mdata is the unpickled message, or whatever
+        ## went wrong unpickling it
+        try:
+            if isinstance(mdata, Exception):
+                raise mdata
+            cmd = mdata['CMD']
+            arg = mdata.get('ARG', {})
+        except Exception as e:
+            yield {'RSP': 'NO',
+                   'ARG': 'Bad Message: %s' % e}
+            return
+        log.info('(%s) RECV %s' % (session['addr'], mdata))
+
+        ## perform action based on command
+        actions = {
+                'GETGROUPS': self.service.get_groups,
+                'GROUP': lambda **kw: self._group(session, **kw),
+                'GETGROUP': self._in_group(session, self.service.get_group),
+                'GETHEADER': self._in_group(session, self.service.get_header),
+                'GETHEADERS': self._in_group(session, self.service.get_headers),
+                'GETHDR': self._in_group(session, self.service.get_hdr),
+                'GETGROUPSINCE': self._in_group(session, self.service.get_group_since),
+                'STATS': self.stats.snapshot,
+                'GETBODY': self._in_group(session, self.service.get_body),
+                'GETARTICLE': self._in_group(
+                    session, functools.partial(self.service.get_body, article=True)),
+            }
+        ## commands that can hand back their result a piece at a time
+        streams = {
+                'GETGROUP': self._in_group(session, self.service.iter_group),
+                'GETHEADERS': self._in_group(session, self.service.iter_headers),
+                'GETHDR': self._in_group(session, self.service.iter_hdr),
+                'GETGROUPSINCE': self._in_group(session, self.service.iter_group_since),
+                'GETBODY': self._in_group(session, self.service.iter_body),
+            }
+        ## streams whose items are already blocks of data,
+        ## sent one to a MORE whatever the chunk size
+        blocks = ('GETBODY', )
+        ## commands answering with overviews, which can be sent
+        ## in another FORMAT (see protocol.ENCODERS)
+        overviews = ('GETGROUP', 'GETGROUPSINCE')
+
+        encode = None
+        fmt = mdata.get('FORMAT')
+        if fmt and cmd in overviews:
+            try:
+                encode = protocol.ENCODERS[fmt]
+            except KeyError:
+                yield {'RSP': 'NO',
+                       'ARG': 'Unknown Format: %s' % fmt}
+                return
+
+        stream = mdata.get('STREAM')
+        if cmd == 'SYNC':
+            chunk_size = None
+            if stream:
+                chunk_size = self.stream_chunk if stream is True else int(stream)
+            yield from self._sync(arg, chunk_size)
+            return
+        if stream and cmd in streams:
+            chunk_size = self.stream_chunk if stream is True else int(stream)
+            if cmd in blocks:
+                chunk_size = 1
+            yield from self._stream(streams[cmd], arg, chunk_size, encode)
+            return
+
+        try:
+            action = actions[cmd]
+        except KeyError:
+            yield {'RSP': 'NO',
+                   'ARG': 'Unknown Command: %s' % cmd}
+            return
+        yield self._respond(action, arg, encode)
+
+    @staticmethod
+    def _error(e):
+        if isinstance(e, (RequestError, ConnectionError)):
+            ## a bad NNTP connection is dropped by the pool,
+            ## the client session itself is fine
+            return {'RSP': 'ERR',
+                    'ARG': {'code': e.code,
+                            'message': e.msg}}
+        return {'RSP': 'NO',
+                'ARG': 'Unknown Error: %s' % e}
+
+    def _respond(self, action, arg, encode=None):
+        try:
+            result = action(**arg)
+            return {'RSP': 'OK',
+                    'ARG': encode(result) if encode else result}
+        except Exception as e:
+            return self._error(e)
+
+    def _sync(self, arg, chunk_size=None):
+        ## SYNC through NNTPService.iter_sync.  _run only asks for the
+        ## next response once it has posted the last, so the marks
+        ## never move past articles that aren't on their way to the
+        ## client.  streamed, the articles come a list to a MORE and
+        ## END has the rest of the answer, 'articles' being the count
+        batches = None
+        try:
+            batches = self.service.iter_sync(batch=chunk_size, **arg)
+            info = next(batches)
+            if chunk_size is None:
+                info['articles'] = next(batches, [])
+                yield {'RSP': 'OK',
+                       'ARG': info}
+                ## posted, the marks can move.  there's no answering
+                ## with an error now, it's logged instead
                 try:
-                    while 1:
-                        try:
-                            eom = sessions[s]['data'].index(DELIMITER) + len(DELIMITER)
-                        except ValueError:
-                            log.debug('All messages from queue serviced.')
-                            raise Break('PROCESS LOOP')
-                        else:
-                            ## partition
-                            message = sessions[s]['data'][:eom]
-                            try:
-                                sessions[s]['data'] = sessions[s]['data'][eom+1:]
-                            except IndexError:
-                                sessions[s]['data'] = b''
-
-                            ##now we have one raw message.
-                            ## "Bytes past the pickled object’s representation 
-                            ## are ignored [by pickle]."
-                            #message = message.rstrip(b"\x00") #.decode('utf-8')
-                            if not len(message):
-                                raise Break('PROCESS LOOP')
-
-                            ## blow up on decoding errors for now..
-                            mdata = pickle.loads(message, encoding='utf8')
-                            cmd = mdata['CMD']
-                            arg = mdata.get('ARG', {})
-                            log.info('(%s) RECV %s' % (cliaddr, message))
-
-                            ## perform action based on command
-                            actions = {
-                                    'GETGROUPS': sessions[s]['nntp'].get_groups,
-                                    'GROUP': sessions[s]['nntp'].group,
-                                    'GETGROUP': sessions[s]['nntp'].get_group,
-                                    'GETHEADER': sessions[s]['nntp'].get_header,
-                                }
-                            try:
-                                sdata = {'RSP': 'OK',
-                                         'ARG': actions[cmd](**arg)}
-                            except RequestError as e:
-                                sdata = {'RSP': 'ERR',
-                                         'ARG': {'code': e.code,
-                                                 'message': e.msg}}
-                            except ConnectionError as e:
-                                log.info('NNTP Connection error, closing '
-                                         'client connection')
-                                ## certainly this list will grow.
-                                ## The nntp connection has gone bad
-                                if s in inputs:
-                                    inputs.remove(s)
-                                outputs.remove(s)
-                                s.close()
-                                # Remove message queue
-                                sessions[s]['nntp']._disconnect()
-                                keys = sessions[s].keys()
-                                for k in list(keys):
-                                    del sessions[s][k]
-                                del sessions[s]
-                                raise Break('PROCESS LOOP')
-                            except KeyError:
-                                sdata = {'RSP': 'NO',
-                                         'ARG': 'Unknown Command: %s' % cmd}
-                            except Exception as e:
-                                sdata = {'RSP': 'NO',
-                                         'ARG': 'Unknown Error: %s' % e}
-
-                            ## RESPOND
-                            resp = pickle.dumps(sdata, protocol=settings.PICKLE_PROTOCOL) + DELIMITER
-                            #resp = resp.encode('utf-8')
-
-                            log.info('(%s)(%s) SEND %s bytes' \
-                                        % (cliaddr, len(sessions), len(resp)))
-                            ## chunk response on agreed upon size..
-                            #log.debug('(%s) SEND %s' % (cliaddr, resp))
-                            while len(resp):
-                                ## probably not efficient..
-                                chunk = resp[:size]
-                                resp = resp[size:]
-
-                                for i in range(0, 5):
-                                    try:
-                                        s.send(chunk)
-                                    except socket.error as e:
-                                        if e.errno == 11:
-                                            ## retry send if we get temporarily
-                                            ## unavail socket
-                                            time.sleep(0.5)
-                                            continue
-                                        else:
-                                            log.error('Send error %s' % e)
-                                            if s in inputs:
-                                                inputs.remove(s)
-                                            outputs.remove(s)
-                                            s.close()
-                                            sessions[s]['nntp']._disconnect()
-                                            # Remove message queue
-                                            keys = sessions[s].keys()
-                                            for k in list(keys):
-                                                del sessions[s][k]
-                                            del sessions[s]
-                                            ## break loop even tho there is
-                                            ## still message to send
-                                            raise Break('PROCESS LOOP')
-                                    else:
-                                        # success
-                                        break
-                except Break:
-                    pass
-                            
-
-            # Handle "exceptional conditions"
-            for s in errorsock:
-                cliaddr = '%s:%s' % s.getpeername()
-                log.debug('handling error condition for %s' % cliaddr)
-                # Stop listening for input on the connection
-                inputs.remove(s)
-                if s in outputs:
-                    outputs.remove(s)
-                s.close()
+                    next(batches, None)
+                except Exception:
+                    log.error(traceback.format_exc())
+                return
+            count = 0
+            for articles in batches:
+                count += len(articles)
+                yield {'RSP': 'MORE',
+                       'ARG': articles}
+        except Exception as e:
+            yield self._error(e)
+            return
+        finally:
+            if batches is not None:
+                batches.close()
+        info['articles'] = count
+        yield {'RSP': 'END',
+               'ARG': info}
+
+    def _stream(self, action, arg, chunk_size, encode=None):
+        count = 0
+        chunk = []
+        items = None
+        try:
+            items = action(**arg)
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    count += len(chunk)
+                    yield {'RSP': 'MORE',
+                           'ARG': encode(chunk) if encode else chunk}
+                    chunk = []
+        except Exception as e:
+            yield self._error(e)
+            return
+        finally:
+            if items is not None:
+                items.close()
+
+        if chunk:
+            count += len(chunk)
+            yield {'RSP': 'MORE',
+                   'ARG': encode(chunk) if encode else chunk}
+        yield {'RSP': 'END',
+               'ARG': count}
+
 
-                sessions[s]['nntp']._disconnect()
-                # Remove message queue
-                keys = sessions[s].keys()
-                for k in list(keys):
-                    del sessions[s][k]
-                del sessions[s]
-    except:
-        log.debug('Fatal error')
-        log.debug(traceback.format_exc())
-    finally:
-        ## close the entire socket if we broke the main loop
-        ## e.g. above here would be some basic signal handling
-        log.info('Shutting down...')
-        for s in outputs + inputs:
-            s.close()
+if __name__ == '__main__':
+    #printgroup(c, 'alt.binaries.teevee', 452267550, 452267563)
+    if settings.PROCESSES > 1:
+        from pynntpprox.prefork import Supervisor
+        Supervisor(settings.PROCESSES).serve_forever()
+    else:
+        DaemonProx().serve_forever()
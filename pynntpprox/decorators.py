@@ -17,7 +17,9 @@ def decorate_all(decorator):
                     nb.extend(gab(cls.__bases__))
                 return nb
 
-            bases_namespaces = [base.__dict__.items() for base in gab(bases)]
+            ## most derived last, so an override wins over
+            ## what it overrides (e.g. NNTP_SSL's _create_socket)
+            bases_namespaces = [base.__dict__.items() for base in reversed(gab(bases))]
             items = [item for sublist in bases_namespaces for item in sublist] + list(namespace.items())
             for attr, value in items:
                 if do_decorate(attr, value):
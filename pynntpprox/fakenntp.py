@@ -0,0 +1,451 @@
+# a stand-in NNTP server with made up groups, for benchmarks and
+# trying things out without a provider account.
+##
+## speaks enough of RFC 3977 for NNTPClient: CAPABILITIES, MODE
+## READER, LIST (ACTIVE, OVERVIEW.FMT), NEWGROUPS, GROUP, OVER/XOVER,
+## HEAD, HDR/XHDR, XPAT, BODY, ARTICLE, DATE and QUIT, and if asked
+## to, COMPRESS DEFLATE, XFEATURE COMPRESS GZIP and XZVER.  every
+## group holds articles 1..articles, with overviews, headers and
+## bodies generated from the article number so two runs always
+## see the same data.  article n of group g has message-id
+## <n.g@fake.invalid> and was posted spacing seconds after n - 1.
+## bodies are body_bytes of noise, yEnc encoded, every parts
+## articles in a row being the parts of one file.
+##
+##   python -m pynntpprox.fakenntp [--port 1119] [--groups 10] ...
+##
+## then point a server entry at it with 'SECURE': 'PLAIN'.
+import sys
+import zlib
+import time
+import random
+import logging
+import argparse
+import fnmatch
+import datetime
+import threading
+import socketserver
+
+from .yenc import encode_lines
+from .compress import DeflateFile
+from .cache import wildmat
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+OVERVIEW_FMT = ['Subject:', 'From:', 'Date:', 'Message-ID:', 'References:',
+                ':bytes', ':lines', 'Xref:full']
+
+
+class FakeNNTPHandler(socketserver.StreamRequestHandler):
+    ## one per client connection
+
+    def send(self, line):
+        self.wfile.write(line.encode('utf-8') + b'\r\n')
+        self.wfile.flush()
+
+    def send_lines(self, status, lines):
+        ## a multi-line response, written in one go
+        self.send_data(status, (line.encode('utf-8') for line in lines))
+
+    def send_data(self, status, lines):
+        ## send_lines for lines that are bytes already
+        out = []
+        for line in lines:
+            out.append(b'.' + line if line.startswith(b'.') else line)
+        out.append(b'.')
+        body = b'\r\n'.join(out) + b'\r\n'
+        if self.gzip:
+            ## XFEATURE COMPRESS GZIP: the body, terminator and all,
+            ## gzipped, then a plain '.' line for TERMINATOR
+            gzip = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+            body = gzip.compress(body) + gzip.flush()
+            if self.gzip == 'TERMINATOR':
+                body += b'.\r\n'
+            status += ' [COMPRESS=GZIP]'
+        self.wfile.write(status.encode('utf-8') + b'\r\n' + body)
+        self.wfile.flush()
+
+    def handle(self):
+        self.group = None
+        self.gzip = None
+        self.send('200 pynntpprox fake server ready')
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                ## reset, same as a hang up
+                return
+            if not line:
+                return
+            words = line.decode('utf-8', 'replace').split()
+            if not words:
+                continue
+            cmd, args = words[0].upper(), words[1:]
+            if cmd == 'QUIT':
+                self.send('205 bye')
+                return
+            self.server.wait()
+            handler = getattr(self, 'do_' + cmd, None)
+            if handler is None:
+                self.send('500 unknown command %s' % cmd)
+                continue
+            try:
+                handler(args)
+            except (ValueError, IndexError):
+                self.send('501 syntax error')
+
+    def do_CAPABILITIES(self, args):
+        caps = ['VERSION 2', 'READER', 'OVER', 'HDR', 'LIST ACTIVE OVERVIEW.FMT']
+        if 'DEFLATE' in self.server.compression:
+            caps.append('COMPRESS DEFLATE')
+        if 'XZVER' in self.server.compression:
+            caps.append('XZVER')
+        self.send_lines('101 capability list follows', caps)
+
+    def do_COMPRESS(self, args):
+        if 'DEFLATE' not in self.server.compression or args[0].upper() != 'DEFLATE':
+            self.send('500 unknown command COMPRESS')
+            return
+        self.send('206 compression active')
+        ## everything from here on, both ways
+        self.rfile = DeflateFile(self.rfile)
+        self.wfile = DeflateFile(self.wfile)
+
+    def do_XFEATURE(self, args):
+        words = [word.upper() for word in args]
+        if 'GZIP' not in self.server.compression or words[:2] != ['COMPRESS', 'GZIP']:
+            self.send('500 unknown command XFEATURE')
+            return
+        self.send('290 feature enabled')
+        self.gzip = 'TERMINATOR' if 'TERMINATOR' in words else 'GZIP'
+
+    def do_MODE(self, args):
+        self.send('200 reader mode')
+
+    def do_DATE(self, args):
+        self.send('111 %s' % datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+    def do_LIST(self, args):
+        keyword = args[0].upper() if args else 'ACTIVE'
+        if keyword == 'OVERVIEW.FMT':
+            self.send_lines('215 order of fields in overview database', OVERVIEW_FMT)
+        elif keyword == 'ACTIVE':
+            ## only the one pattern, no wildmat lists
+            pattern = args[1] if len(args) > 1 else '*'
+            server = self.server
+            self.send_lines('215 list of newsgroups follows',
+                            ['%s %d 1 y' % (name, server.articles)
+                             for name in server.group_names
+                             if fnmatch.fnmatchcase(name, pattern)])
+        else:
+            self.send('501 unsupported LIST keyword')
+
+    def do_NEWGROUPS(self, args):
+        ## yyyymmdd hhmmss, or yymmdd, UTC or not
+        date = args[0] if len(args[0]) == 8 else '20' + args[0]
+        since = datetime.datetime.strptime(date + args[1], '%Y%m%d%H%M%S')
+        if len(args) < 3 or args[2].upper() != 'GMT':
+            since = since + (datetime.datetime.utcnow() - datetime.datetime.now())
+        server = self.server
+        self.send_lines('231 list of new newsgroups follows',
+                        ['%s %d 1 y' % (name, server.articles)
+                         for name in server.group_names
+                         if server.created.get(name, 0) >= since.replace(
+                             tzinfo=datetime.timezone.utc).timestamp()])
+
+    def do_GROUP(self, args):
+        if args[0] not in self.server.groups:
+            self.send('411 no such group')
+            return
+        self.group = args[0]
+        articles = self.server.articles
+        self.send('211 %d 1 %d %s' % (articles, articles, self.group))
+
+    def _range(self, spec):
+        ## n, n- or n-m, clamped to what the group holds
+        if '-' not in spec:
+            first = last = int(spec)
+        else:
+            first, last = spec.split('-', 1)
+            first = int(first)
+            last = int(last) if last else self.server.articles
+        return max(first, 1), min(last, self.server.articles)
+
+    def do_OVER(self, args):
+        if self.group is None:
+            self.send('412 no newsgroup selected')
+            return
+        first, last = self._range(args[0])
+        if first > last:
+            self.send('423 no articles in that range')
+            return
+        overview = self.server.overview
+        self.send_lines('224 overview information follows',
+                        (overview(self.group, n) for n in range(first, last + 1)))
+
+    do_XOVER = do_OVER
+
+    def do_XZVER(self, args):
+        ## OVER, deflated and yEnc'd
+        if 'XZVER' not in self.server.compression:
+            self.send('500 unknown command XZVER')
+            return
+        if self.group is None:
+            self.send('412 no newsgroup selected')
+            return
+        first, last = self._range(args[0])
+        if first > last:
+            self.send('423 no articles in that range')
+            return
+        overview = self.server.overview
+        text = ''.join(overview(self.group, n) + '\r\n'
+                       for n in range(first, last + 1)).encode('utf-8')
+        deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data = deflate.compress(text) + deflate.flush()
+        self.send_data('224 compressed data follows',
+                       [b'=ybegin line=128 size=%d name=xzver' % len(data)]
+                       + encode_lines(data)
+                       + [b'=yend size=%d crc32=%08x' % (len(data), zlib.crc32(data))])
+
+    def _article(self, spec):
+        ## (group, number) for a message-id or a number in the
+        ## current group, None if there is no such article
+        server = self.server
+        if spec.startswith('<'):
+            try:
+                number, group = spec[1:spec.index('@')].split('.', 1)
+                number = int(number)
+            except ValueError:
+                return None
+        else:
+            group, number = self.group, int(spec)
+        if group not in server.groups or not 1 <= number <= server.articles:
+            return None
+        return group, number
+
+    def do_HEAD(self, args):
+        article = self._article(args[0]) if args else None
+        if article is None:
+            self.send('430 no such article')
+            return
+        group, number = article
+        self.send_lines('221 %d %s' % (number, self.server.message_id(group, number)),
+                        self.server.header(group, number))
+
+    def _values(self, name, spec):
+        ## (number, value) of header name for a message-id or a range
+        server = self.server
+        if spec.startswith('<'):
+            article = self._article(spec)
+            if article is None:
+                return None
+            return [(0, server.header_value(article[0], article[1], name))]
+        if self.group is None:
+            return None
+        first, last = self._range(spec)
+        return [(n, server.header_value(self.group, n, name)) for n in range(first, last + 1)]
+
+    def do_HDR(self, args):
+        values = self._values(args[0], args[1])
+        if values is None:
+            self.send('430 no such article' if args[1].startswith('<')
+                      else '412 no newsgroup selected')
+            return
+        self.send_lines('225 headers follow', ('%d %s' % pair for pair in values))
+
+    def do_XHDR(self, args):
+        values = self._values(args[0], args[1])
+        if values is None:
+            self.send('430 no such article' if args[1].startswith('<')
+                      else '412 no newsgroup selected')
+            return
+        self.send_lines('221 headers follow', ('%d %s' % pair for pair in values))
+
+    def do_XPAT(self, args):
+        values = self._values(args[0], args[1])
+        if values is None:
+            self.send('430 no such article' if args[1].startswith('<')
+                      else '412 no newsgroup selected')
+            return
+        patterns = args[2:]
+        if any(p.count('[') != p.count(']') for p in patterns):
+            self.send('501 bad pattern')
+            return
+        self.send_lines('221 headers follow',
+                        ('%d %s' % (n, v) for n, v in values
+                         if any(wildmat(v, p.split(',')) for p in patterns)))
+
+    def do_BODY(self, args):
+        article = self._article(args[0]) if args else None
+        if article is None:
+            self.send('430 no such article')
+            return
+        group, number = article
+        self.send_data('222 %d %s' % (number, self.server.message_id(group, number)),
+                       self.server.body(group, number))
+
+    def do_ARTICLE(self, args):
+        article = self._article(args[0]) if args else None
+        if article is None:
+            self.send('430 no such article')
+            return
+        group, number = article
+        server = self.server
+        head = [line.encode('utf-8') for line in server.header(group, number)]
+        self.send_data('220 %d %s' % (number, server.message_id(group, number)),
+                       head + [b''] + server.body(group, number))
+
+
+class FakeNNTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    ## seconds between consecutive articles' Date headers
+    spacing = 60
+    epoch = 1700000000
+
+    def __init__(self, address, groups=10, articles=100000, latency=0,
+                 subject_bytes=60, body_bytes=64 * 1024, parts=1, compression=()):
+        socketserver.ThreadingTCPServer.__init__(self, address, FakeNNTPHandler)
+        self.group_names = ['alt.binaries.fake.%d' % i for i in range(groups)]
+        self.groups = set(self.group_names)
+        ## when groups were added with add_group, the
+        ## ones we started with are as old as time
+        self.created = {}
+        self.articles = articles
+        ## seconds added to every command, the provider's round trip
+        self.latency = latency
+        self.subject_bytes = subject_bytes
+        self.body_bytes = body_bytes
+        self.parts = parts
+        ## what's on offer of 'DEFLATE' (COMPRESS), 'GZIP'
+        ## (XFEATURE COMPRESS) and 'XZVER'
+        self.compression = set(compression)
+
+    def add_group(self, name):
+        ## a new group, for NEWGROUPS to find
+        self.created[name] = time.time()
+        self.group_names = sorted(self.group_names + [name])
+        self.groups = set(self.group_names)
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def message_id(self, group, number):
+        return '<%d.%s@fake.invalid>' % (number, group)
+
+    def date(self, number):
+        posted = self.epoch + number * self.spacing
+        return time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(posted))
+
+    def subject(self, group, number):
+        subject = '[%d/%d] - "%s.part%03d.rar" yEnc (1/%d)' % (
+            number % 50, 50, group, number % 1000, 1 + number % 200)
+        return subject.ljust(self.subject_bytes, '_')
+
+    def overview(self, group, number):
+        return '\t'.join([
+            str(number),
+            self.subject(group, number),
+            'poster%d@fake.invalid (Poster)' % (number % 17),
+            self.date(number),
+            self.message_id(group, number),
+            '',
+            str(400000 + number % 1000),
+            str(3000 + number % 100),
+            'Xref: fake.invalid %s:%d' % (group, number),
+        ])
+
+    def header(self, group, number):
+        return ['Path: fake.invalid!not-for-mail',
+                'From: poster%d@fake.invalid (Poster)' % (number % 17),
+                'Newsgroups: %s' % group,
+                'Subject: %s' % self.subject(group, number),
+                'Date: %s' % self.date(number),
+                'Message-ID: %s' % self.message_id(group, number),
+                'Lines: %d' % (3000 + number % 100),
+                'Bytes: %d' % (400000 + number % 1000),
+                'Xref: fake.invalid %s:%d' % (group, number)]
+
+    def header_value(self, group, number, name):
+        name = name.lower()
+        if name == ':bytes':
+            return str(400000 + number % 1000)
+        if name == ':lines':
+            return str(3000 + number % 100)
+        for line in self.header(group, number):
+            k, _, v = line.partition(': ')
+            if k.lower() == name:
+                return v
+        return ''
+
+    def data(self, group, number):
+        ## the decoded body of an article
+        return random.Random('%s:%d' % (group, number)).randbytes(self.body_bytes)
+
+    def body(self, group, number):
+        ## yEnc lines, as bytes
+        data = self.data(group, number)
+        part = (number - 1) % self.parts + 1
+        name = '%s.%d.bin' % (group, (number - 1) // self.parts)
+        size = self.body_bytes * self.parts
+        if self.parts == 1:
+            head = [b'=ybegin line=128 size=%d name=%s' % (size, name.encode())]
+            tail = b'=yend size=%d crc32=%08x' % (len(data), zlib.crc32(data))
+        else:
+            begin = (part - 1) * self.body_bytes + 1
+            head = [b'=ybegin part=%d total=%d line=128 size=%d name=%s'
+                    % (part, self.parts, size, name.encode()),
+                    b'=ypart begin=%d end=%d' % (begin, begin + len(data) - 1)]
+            tail = b'=yend size=%d part=%d pcrc32=%08x' % (len(data), part, zlib.crc32(data))
+        return head + encode_lines(data) + [tail]
+
+
+def start(host='127.0.0.1', port=0, **kwargs):
+    ## serves on a thread of its own, port 0 picks a free one
+    ## (see server.server_address)
+    server = FakeNNTPServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='fake NNTP server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1119)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--articles', type=int, default=100000,
+                        help='articles per group')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every command')
+    parser.add_argument('--subject-bytes', type=int, default=60)
+    parser.add_argument('--body-bytes', type=int, default=64 * 1024,
+                        help='decoded bytes per article body')
+    parser.add_argument('--parts', type=int, default=1,
+                        help='articles per posted file')
+    parser.add_argument('--compression', default='',
+                        help='comma separated DEFLATE, GZIP, XZVER to offer')
+    opts = parser.parse_args(argv)
+    server = FakeNNTPServer((opts.host, opts.port), groups=opts.groups,
+                            articles=opts.articles, latency=opts.latency,
+                            subject_bytes=opts.subject_bytes,
+                            body_bytes=opts.body_bytes, parts=opts.parts,
+                            compression=[mode.strip().upper() for mode in
+                                         opts.compression.split(',') if mode.strip()])
+    log.info('Fake NNTP server on %s:%s' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,22 @@
 # helper module for talking to nntp
+import os
+import ssl
 import logging
 import nntplib
 import datetime
+import time
 #from collections import OrderedDict
 import traceback
+import inspect
+import itertools
 import re
 
 from .decorators import decorate_all
+from . import compress
+from . import settings
+from . import yenc
+from .stats import STATS
+from .cache import wildmat
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s')
@@ -17,7 +27,7 @@ log.setLevel('INFO')
 class ParsedNNTPError(Exception):
     def __init__(self, response):
         super(ParsedNNTPError, self).__init__(response)
-        match = re.search(r'^(\d{3}) (.*)', response)
+        match = re.search(r'^(\d{3}) (.*)', str(response))
         if match:
             self.code, self.msg = match.groups()
         else:
@@ -34,10 +44,23 @@ class RequestError(ParsedNNTPError):
 
 
 def handle_nntp_exceptions(func):
+    if inspect.isgeneratorfunction(func):
+        ## generators raise while being iterated, not when called
+        def _inner(self, *args, **kwargs):
+            try:
+                yield from func(self, *args, **kwargs)
+            except (OSError, EOFError, nntplib.NNTPPermanentError) as e:
+                log.debug(traceback.format_exc())
+                raise ConnectionError(getattr(e, 'response', e))
+            except nntplib.NNTPError as e:
+                log.debug(traceback.format_exc())
+                raise RequestError(e.response)
+        return _inner
+
     def _inner(self, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
-        except (BrokenPipeError, nntplib.NNTPPermanentError) as e:
+        except (OSError, EOFError, nntplib.NNTPPermanentError) as e:
             ## certainly this list will grow.
             ## The nntp connection has gone bad
             log.debug(traceback.format_exc())
@@ -47,14 +70,239 @@ def handle_nntp_exceptions(func):
             raise RequestError(e.response)
     return _inner
 
+class OverviewDecoder(object):
+    ## OVER/XOVER lines to (article_id, fields), the hot loop of a
+    ## big GETGROUP.  everything that only depends on the overview
+    ## format is worked out once up front:
+    ##
+    ## (some) short headers from grouplists have these colon
+    ## prefixes for no aparrent reason (they're not in the
+    ## raw headers).  We strip them so that the response of
+    ## short and long headers properly intersect (and breaks
+    ## the general rule of not touching the data as much as possible)
+    ##
+    ## RFC 2047 decoding is only attempted on values that contain
+    ## an encoded word ('=?'), anything else comes back from
+    ## nntplib.decode_header unchanged anyway.
+    def __init__(self, fmt):
+        n_defaults = len(nntplib._DEFAULT_OVERVIEW_FMT)
+        self.keys = tuple(name.lstrip(':') for name in fmt)
+        ## non-default headers are sent as 'name: value'
+        self.prefixes = tuple(name + ': ' if i >= n_defaults and not name.startswith(':')
+                              else None
+                              for i, name in enumerate(fmt))
+        self._plain = all(p is None for p in self.prefixes)
+
+    def parse(self, line):
+        ## undecoded fields.  tokens past the end of the format are
+        ## dropped, some servers send more than LIST OVERVIEW.FMT says
+        article_number, *tokens = line.split('\t')
+        if self._plain:
+            return int(article_number), dict(zip(self.keys, tokens))
+        fields = {}
+        for key, prefix, token in zip(self.keys, self.prefixes, tokens):
+            if prefix is not None:
+                # Non-default header names are included in full in the response
+                # (unless the field is totally empty)
+                if not token:
+                    token = None
+                elif token[:len(prefix)].lower() == prefix:
+                    token = token[len(prefix):]
+                else:
+                    raise nntplib.NNTPDataError("OVER/XOVER response doesn't include "
+                                                "names of additional headers")
+            fields[key] = token
+        return int(article_number), fields
+
+    @staticmethod
+    def decode(fields):
+        for k, v in fields.items():
+            if v and '=?' in v:
+                fields[k] = nntplib.decode_header(v)
+        return fields
+
+    def __call__(self, line):
+        article_id, fields = self.parse(line)
+        return article_id, self.decode(fields)
+
+
+class OverviewFilter(object):
+    ## which articles, and which of their fields, iter_group hands
+    ## back.  it works on the undecoded fields, so articles it drops
+    ## and fields it leaves out are never RFC 2047 decoded, let
+    ## alone pickled and sent to the client.
+    ##
+    ## fields is the overview keys to keep ('subject', 'message-id',
+    ## 'bytes'...), None for all.  where holds the predicates an
+    ## article has to pass, all of them:
+    ##     subject    regex searched for in the (decoded) subject
+    ##     from       regex searched for in the (decoded) poster
+    ##     min_bytes  smallest :bytes to keep
+    ##     max_bytes  largest :bytes to keep
+    predicates = ('subject', 'from', 'min_bytes', 'max_bytes')
+
+    def __init__(self, fields=None, where=None):
+        where = where or {}
+        unknown = set(where) - set(self.predicates)
+        if unknown:
+            raise Exception('Unknown predicate: %s' % ', '.join(sorted(unknown)))
+        self.fields = tuple(fields) if fields else None
+        self.subject = re.compile(where['subject']) if where.get('subject') else None
+        self.poster = re.compile(where['from']) if where.get('from') else None
+        self.min_bytes = where.get('min_bytes')
+        self.max_bytes = where.get('max_bytes')
+
+    @staticmethod
+    def _text(fields, key):
+        v = fields.get(key)
+        if v and '=?' in v:
+            v = nntplib.decode_header(v)
+        return v or ''
+
+    def match(self, fields):
+        if self.subject is not None and not self.subject.search(self._text(fields, 'subject')):
+            return False
+        if self.poster is not None and not self.poster.search(self._text(fields, 'from')):
+            return False
+        if self.min_bytes is not None or self.max_bytes is not None:
+            try:
+                n = int(fields.get('bytes') or 0)
+            except ValueError:
+                return False
+            if self.min_bytes is not None and n < self.min_bytes:
+                return False
+            if self.max_bytes is not None and n > self.max_bytes:
+                return False
+        return True
+
+    def __call__(self, overviews):
+        keys = self.fields
+        for article_id, fields in overviews:
+            if self.match(fields):
+                if keys is not None:
+                    fields = {k: fields.get(k) for k in keys}
+                yield article_id, fields
+
+
+def _iter_body(cli, resp):
+    ## the lines of a multi-line response whose status line has
+    ## just been read, dot-unstuffed, without the terminating '.'
+    if '[COMPRESS=GZIP]' in resp:
+        yield from compress.iter_gzip_lines(cli.file)
+        return
+    while 1:
+        line = cli._getline()
+        if line == b'.':
+            break
+        if line.startswith(b'..'):
+            line = line[1:]
+        yield line
+
+
+def _file_name(message_spec):
+    ## something to call a body that didn't name itself
+    return re.sub(r'[^\w.@-]', '_', str(message_spec).strip('<>')) or 'body'
+
+
+def _open_body(path, offset):
+    ## offset is where the data goes, None for the whole file.  parts
+    ## of one file share it, so it isn't truncated when there's an
+    ## offset and each part seeks to its own
+    if offset is None:
+        return open(path, 'wb', buffering=settings.BODY_BLOCK)
+    out = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b',
+               buffering=settings.BODY_BLOCK)
+    out.seek(offset)
+    return out
+
+
+def _getlongresp(self, file=None):
+    ## nntplib's, but able to read XFEATURE COMPRESS GZIP bodies
+    if file is not None:
+        return nntplib.NNTP._getlongresp(self, file)
+    resp = self._getresp()
+    if resp[:3] not in nntplib._LONGRESP:
+        raise nntplib.NNTPReplyError(resp)
+    return resp, list(_iter_body(self, resp))
+
+
+def _putcmd(self, line):
+    ## note the time, _getresp records the round trip
+    self._sent = (line.split(' ', 1)[0].upper(), time.time())
+    return nntplib.NNTP._putcmd(self, line)
+
+
+def _getresp(self):
+    try:
+        return nntplib.NNTP._getresp(self)
+    finally:
+        sent, self._sent = getattr(self, '_sent', None), None
+        if sent is not None:
+            STATS.nntp(sent[0], time.time() - sent[1])
+
+
+## connections to one server share a dict (see NNTPPool.shared),
+## set on the nntplib object before its __init__ runs (see _open):
+##     caps: CAPABILITIES as the first connection got them after
+##           logging in, later ones skip asking
+##     ssl_context: one context for every connection, TLS sessions
+##                  can only be resumed with the one they came from
+##     tls_session: the last TLS session, offered when connecting
+def getcapabilities(self):
+    shared = getattr(self, '_shared', None)
+    if self._caps is None and shared and shared.get('caps') is not None:
+        ## as nntplib's, minus the round trip
+        self._caps = shared['caps']
+        self.nntp_version = max(map(int, self._caps.get('VERSION', ['1'])))
+        self.nntp_implementation = ' '.join(self._caps.get('IMPLEMENTATION', [])) or None
+    return nntplib.NNTP.getcapabilities(self)
+
+
+def _create_ssl_socket(self, timeout):
+    ## nntplib's, but resuming the last TLS session if there is one
+    sock = nntplib.NNTP._create_socket(self, timeout)
+    shared = getattr(self, '_shared', None) or {}
+    context = self.ssl_context or ssl._create_stdlib_context()
+    try:
+        return context.wrap_socket(sock, server_hostname=self.host,
+                                   session=shared.get('tls_session'))
+    except:
+        sock.close()
+        raise
+
+
+def _open(cls, shared, *args, **kwargs):
+    cli = cls.__new__(cls)
+    cli._shared = shared
+    cli.__init__(*args, **kwargs)
+    return cli
+
+
+OVERRIDES = {'_getlongresp': _getlongresp,
+             '_putcmd': _putcmd,
+             '_getresp': _getresp,
+             'getcapabilities': getcapabilities}
+
 NNTPMC = decorate_all(handle_nntp_exceptions)
-NNTP = NNTPMC('NNTP', (nntplib.NNTP, ), {})
-NNTP_SSL = NNTPMC('NNTP_SSL', (nntplib.NNTP_SSL, ), {})
+NNTP = NNTPMC('NNTP', (nntplib.NNTP, ), dict(OVERRIDES))
+NNTP_SSL = NNTPMC('NNTP_SSL', (nntplib.NNTP_SSL, ),
+                  dict(OVERRIDES, _create_socket=_create_ssl_socket))
 
 class NNTPClient(object):
-    def __init__(self, config={}):
+    ## HEADs kept in flight by get_headers
+    pipeline_window = 64
+
+    def __init__(self, config={}, cache=None, shared=None):
         # connection config
         self._conf = self._getconf(config)
+        # state shared with the other connections to this server
+        self._shared = shared if shared is not None else {}
+        # when it last finished a request, for keepalives
+        self.used = time.time()
+        # local overview store (cache.OverviewCache), optional
+        self._cache = cache
+        # OverviewDecoder for this server's overview format
+        self._decoder = None
         # client
         self._cli = None
         self._disconnected = False
@@ -64,6 +312,12 @@ class NNTPClient(object):
         self._group = None
         # server capabilities (also inits connection)
         self._caps = self.cli.getcapabilities()
+        self._shared.setdefault('caps', self._caps)
+        self._save_tls_session()
+        # compressed transfer in use, if any
+        self._compression = None
+        if self._conf['COMPRESSION']:
+            self._compression = self._start_compression()
 
     def __del__(self):
         self._disconnect()
@@ -71,26 +325,60 @@ class NNTPClient(object):
     def _connect(self):
         cli = None
         log.info('Connecting to NNTP server')
+        ## seconds any one read or write may take, a hung
+        ## server then fails over instead of stalling us
+        kwargs = {}
+        if self._conf['TIMEOUT']:
+            kwargs['timeout'] = self._conf['TIMEOUT']
         if self._conf['SECURE'] == 'STARTTLS':
             ## POW MONKEYPATCH METACLASS
-            cli = NNTP(self._conf['HOST'], usenetrc=False)
+            cli = _open(NNTP, self._shared, self._conf['HOST'], usenetrc=False, **kwargs)
             log.debug('starttls')
-            cli.starttls()
+            ## no session resumption here, nntplib's
+            ## starttls has nowhere to pass one
+            cli.starttls(self._ssl_context())
             log.debug('login')
             cli.login(user=self._conf['USER'], password=self._conf['PASS'],
                       usenetrc=False)
         elif self._conf['SECURE'] == 'SSL':
             ## POW MONKEYPATCH METACLASS
             port = self._conf['PORT'] if self._conf['PORT'] else 563
-            cli = NNTP_SSL(self._conf['HOST'], port=port,
+            cli = _open(NNTP_SSL, self._shared, self._conf['HOST'], port=port,
+                                    ssl_context=self._ssl_context(),
                                     user=self._conf['USER'],
                                     password=self._conf['PASS'],
-                                    usenetrc=False)
+                                    usenetrc=False, **kwargs)
+        elif self._conf['SECURE'] == 'PLAIN':
+            ## cleartext, for local servers (fakenntp) only.  has to
+            ## be asked for by name so a missing SECURE still refuses
+            port = self._conf['PORT'] if self._conf['PORT'] else 119
+            cli = _open(NNTP, self._shared, self._conf['HOST'], port=port,
+                       user=self._conf['USER'],
+                       password=self._conf['PASS'],
+                       usenetrc=False, **kwargs)
         else:
             raise Exception('No insecure connections yet')
 
         return cli
 
+    def _ssl_context(self):
+        ## nntplib's default context, made once per server
+        if self._shared.get('ssl_context') is None:
+            self._shared['ssl_context'] = ssl._create_stdlib_context()
+        return self._shared['ssl_context']
+
+    def _save_tls_session(self):
+        ## TLS 1.3 tickets only arrive after the handshake, by now
+        ## the welcome and CAPABILITIES have been read so we have one
+        session = getattr(self.cli.sock, 'session', None)
+        if session is not None:
+            log.debug('TLS session %s' % ('resumed' if self.cli.sock.session_reused else 'new'))
+            self._shared['tls_session'] = session
+
+    def keepalive(self):
+        ## the cheapest thing that gets an answer
+        self.cli.date()
+
     def _disconnect(self):
         log.info('Disconnecting from NNTP server')
         if self._cli and not self._disconnected:
@@ -101,6 +389,22 @@ class NNTPClient(object):
                 pass
             self._disconnected = True
 
+    def _abort(self):
+        ## drop the connection without a QUIT, used when we stop reading
+        ## half way through a response and the stream is out of step
+        log.info('Aborting NNTP connection')
+        if self._cli and not self._disconnected:
+            self._disconnected = True
+            for f in (self._cli.file, self._cli.sock):
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+    @property
+    def usable(self):
+        return not self._disconnected
+
     @property
     def cli(self):
         ## retries and all shall go here..
@@ -113,10 +417,48 @@ class NNTPClient(object):
     def _getconf(kls, config):
         nc = {}
         ##TODO replace this bs w/ conf obj and getattr
-        for c in ['HOST', 'PORT', 'USER', 'PASS', 'SECURE', 'CONNECTIONS', 'RETENTION']:
+        for c in ['HOST', 'PORT', 'USER', 'PASS', 'SECURE', 'CONNECTIONS', 'RETENTION',
+                  'COMPRESSION', 'TIMEOUT']:
             nc[c] = config.get(c, None)
         return nc
 
+    def _start_compression(self):
+        ## COMPRESS DEFLATE (RFC 8054) squeezes everything in both
+        ## directions, so it wins.  XZVER has to be asked for per
+        ## command and isn't probed for, it's used if the server
+        ## advertises it or the config asks for it.  XFEATURE COMPRESS
+        ## GZIP compresses multi-line responses.  None of them
+        ## means plain XOVER.
+        ##
+        ## COMPRESSION in the config is 'AUTO' or one of
+        ## 'DEFLATE', 'XZVER', 'GZIP' to only try that one.
+        mode = self._conf['COMPRESSION']
+        cli = self.cli
+        if mode in ('AUTO', 'DEFLATE') and 'DEFLATE' in self._caps.get('COMPRESS', ()):
+            try:
+                cli._shortcmd('COMPRESS DEFLATE')
+            except ParsedNNTPError as e:
+                log.info('COMPRESS DEFLATE refused: %s %s' % (e.code, e.msg))
+            else:
+                cli.file = compress.DeflateFile(cli.file)
+                log.debug('compression: DEFLATE')
+                return 'DEFLATE'
+
+        if mode == 'XZVER' or (mode == 'AUTO' and 'XZVER' in self._caps):
+            log.debug('compression: XZVER')
+            return 'XZVER'
+
+        if mode in ('AUTO', 'GZIP'):
+            try:
+                cli._shortcmd('XFEATURE COMPRESS GZIP TERMINATOR')
+            except ParsedNNTPError as e:
+                log.debug('XFEATURE COMPRESS GZIP refused: %s %s' % (e.code, e.msg))
+            else:
+                cli.file = compress.PushbackFile(cli.file)
+                log.debug('compression: GZIP')
+                return 'GZIP'
+        return None
+
     def date(self, date=None):
         ## this is TZ naive currently and only figures the offset...
         ## and I do this because the date object that comes back
@@ -134,10 +476,11 @@ class NNTPClient(object):
             ld = datetime.datetime.now()
             self._timedelta = sd - ld
 
+        ## _timedelta is how far the server's clock is ahead of ours
         if date is None:
-            return sd + self._timedelta
+            return sd - self._timedelta
         else:
-            return date - self._timedelta
+            return date + self._timedelta
 
     def get_groups(self, prefix=None):
         ## groups are converted to dicts with keys:
@@ -150,6 +493,15 @@ class NNTPClient(object):
         resp, groups = self.cli.list(prefix)
         return tuple([g._asdict() for g in groups])
 
+    def new_groups(self, since):
+        ## get_groups, but only the groups created since the (local,
+        ## naive) datetime since.  DATE answers in UTC so date() takes
+        ## since to the server's UTC, which NEWGROUPS is told with GMT
+        when = self.date(since)
+        date_str, time_str = nntplib._unparse_datetime(when, self.cli.nntp_version < 2)
+        resp, lines = self.cli._longcmdstring('NEWGROUPS %s %s GMT' % (date_str, time_str))
+        return tuple([g._asdict() for g in self.cli._grouplist(lines)])
+
     def group(self, group_name=None):
         ## if group name provided, select the current group
         ## either way return the current group data
@@ -165,10 +517,11 @@ class NNTPClient(object):
             log.debug('Set group: %s %s %s %s' % v)
         return self._group
 
-    def get_group(self, message_spec, group_name=None):
+    def get_group(self, message_spec, group_name=None, raw=False, fields=None, where=None):
         ## because we need to fully decode the header
         ## in python3 land, we're dealing with
         ## loading the entire thing to mem..
+        ## (see iter_group for the streaming version)
         ##
         ## if you need to know the # of articles
         ## get it from the currently selected group
@@ -179,30 +532,192 @@ class NNTPClient(object):
         ## per NNTP, message_spec is either, a message_id
         ## or otherwise a (first, last) tuple of
         ## article ids
+        ##
+        ## raw skips RFC 2047 decoding and hands the
+        ## fields back as the server sent them
+        ##
+        ## fields and where narrow down what comes back,
+        ## see OverviewFilter
+        return list(self.iter_group(message_spec, group_name, raw, fields, where))
+
+    def iter_group(self, message_spec, group_name=None, raw=False, fields=None, where=None):
+        ## same as get_group, but the overview is read off the
+        ## socket and decoded one article at a time, so memory
+        ## stays flat however big the range is.
+        ##
+        ## the connection is busy until the generator is exhausted,
+        ## closing it early drops the connection.
         if group_name is not None:
             self.group(group_name)
 
         if isinstance(message_spec, (tuple, list)) and not self._group:
             raise Exception('Article ids supplied without group name')
 
-        resp, overviews = self.cli.over(message_spec)
-      
-        log.debug(len(overviews))
-        h = [] 
-        for article_id, ovr in overviews:
-            d = {}
-            log.debug(u'BEFORE %s' % ovr['subject'])
-            for k, v in ovr.items():
-                ## (some) short headers from grouplists have these colon
-                ## prefixes for no aparrent reason (they're not in the 
-                ## raw headers).  We do this so that the response of
-                ## short and long headers properly intersect (and breaks
-                ## the general rule of not touching the data as much as possible)
-                k = k.lstrip(':')
-                d[k] = nntplib.decode_header(v)
-            log.debug('AFTER %s' % d['subject'])
-            h.append((article_id, d))
-        return h
+        self._overview_decoder()
+        if self._cache is not None and isinstance(message_spec, (tuple, list)):
+            overviews = self._iter_over_cached(message_spec)
+        else:
+            overviews = self._iter_over(message_spec)
+        if fields or where:
+            overviews = OverviewFilter(fields, where)(overviews)
+        if raw:
+            yield from overviews
+            return
+        decode = self._decoder.decode
+        for article_id, fields in overviews:
+            yield article_id, decode(fields)
+
+    def _overview_decoder(self):
+        ## must be known before OVER goes out, it's a command of its own
+        if self._decoder is None:
+            self._decoder = OverviewDecoder(self.cli._getoverviewfmt())
+        return self._decoder
+
+    def _iter_over(self, message_spec):
+        ## undecoded (article_id, fields) pairs straight from the server
+        parse = self._overview_decoder().parse
+        encoding, errors = self.cli.encoding, self.cli.errors
+        for line in self._iter_over_lines(message_spec):
+            yield parse(line.decode(encoding, errors=errors))
+
+    def _iter_over_lines(self, message_spec):
+        if self._compression == 'XZVER' and isinstance(message_spec, (tuple, list)):
+            start, end = message_spec
+            lines = self._iter_longcmd('XZVER {0}-{1}'.format(start, end or ''))
+            try:
+                ## errors come with the status line, before any data
+                first = next(lines, None)
+            except ParsedNNTPError as e:
+                if e.code not in ('500', '501'):
+                    raise
+                log.info('XZVER refused, falling back to XOVER: %s %s' % (e.code, e.msg))
+                self._compression = None
+            else:
+                if first is not None:
+                    yield from compress.iter_xzver_lines(itertools.chain((first, ), lines))
+                return
+        yield from self._iter_longcmd(self._over_cmd(message_spec))
+
+    def _iter_over_cached(self, message_spec):
+        ## serves what it can from the overview cache and only
+        ## asks the server for the sub ranges it hasn't seen
+        group = self._group['group']
+        first, last = message_spec
+        if last is None:
+            last = self._group['last']
+        ## anything past the group's last article may still turn up,
+        ## so it is never recorded as fetched
+        newest = self._group['last']
+
+        pos = first
+        for f, l in self._cache.missing(group, first, last):
+            if pos < f:
+                yield from self._cache.iter_range(group, pos, f - 1)
+            log.debug('overview cache miss %s %s-%s' % (group, f, l))
+            batch = []
+            try:
+                for ovr in self._iter_over((f, l)):
+                    batch.append(ovr)
+                    if len(batch) >= self._cache.page:
+                        self._cache.store(group, batch)
+                        yield from batch
+                        batch = []
+            except RequestError as e:
+                ## 423: no articles in that range
+                if e.code != '423':
+                    raise
+            self._cache.store(group, batch)
+            yield from batch
+            self._cache.cover(group, f, min(l, newest))
+            pos = l + 1
+        if pos <= last:
+            yield from self._cache.iter_range(group, pos, last)
+
+    def _over_cmd(self, message_spec):
+        cmd = 'OVER' if 'OVER' in self._caps else 'XOVER'
+        if isinstance(message_spec, (tuple, list)):
+            start, end = message_spec
+            cmd += ' {0}-{1}'.format(start, end or '')
+        elif message_spec is not None:
+            cmd = cmd + ' ' + message_spec
+        return cmd
+
+    def get_hdr(self, header, message_spec, group_name=None, pattern=None, raw=False):
+        return list(self.iter_hdr(header, message_spec, group_name, pattern, raw))
+
+    def iter_hdr(self, header, message_spec, group_name=None, pattern=None, raw=False):
+        ## one header (or :bytes/:lines) across a range of articles,
+        ## as (article_number, value) pairs, number 0 for a message-id.
+        ## a line per article instead of a whole overview, so a
+        ## column of subjects costs a fraction of an OVER.
+        ##
+        ## HDR when the server lists it, XHDR otherwise.  with pattern
+        ## (a wildmat) only the articles whose value matches come
+        ## back: the server matches with XPAT, or if it won't take
+        ## XPAT we do it here on the HDR answer.
+        if group_name is not None:
+            self.group(group_name)
+
+        if isinstance(message_spec, (tuple, list)):
+            if not self._group:
+                raise Exception('Article ids supplied without group name')
+            start, end = message_spec
+            message_spec = '{0}-{1}'.format(start, end or '')
+
+        def decode(value):
+            if raw or '=?' not in value:
+                return value
+            return nntplib.decode_header(value)
+
+        if pattern is not None and self._shared.get('xpat', True):
+            lines = self._iter_longcmd('XPAT %s %s %s' % (header, message_spec, pattern))
+            try:
+                ## refused with the status line, before any data
+                first = next(lines, None)
+            except ParsedNNTPError as e:
+                if e.code not in ('500', '501'):
+                    raise
+                log.info('XPAT refused, matching HDR here: %s %s' % (e.code, e.msg))
+                if e.code == '500':
+                    ## no such command, no point asking this server
+                    ## again.  a 501 was just this pattern
+                    self._shared['xpat'] = False
+            else:
+                if first is not None:
+                    for number, value in self._hdr_pairs(itertools.chain((first, ), lines)):
+                        yield number, decode(value)
+                return
+
+        cmd = 'HDR' if 'HDR' in self._caps else 'XHDR'
+        ## matched as the server's XPAT would: commas, '!' and all
+        patterns = pattern.split(',') if pattern is not None else None
+        for number, value in self._hdr_pairs(
+                self._iter_longcmd('%s %s %s' % (cmd, header, message_spec))):
+            if patterns is None or wildmat(value, patterns):
+                yield number, decode(value)
+
+    def _hdr_pairs(self, lines):
+        encoding, errors = self.cli.encoding, self.cli.errors
+        for line in lines:
+            number, _, value = line.decode(encoding, errors=errors).partition(' ')
+            yield int(number), value
+
+    @handle_nntp_exceptions
+    def _iter_longcmd(self, line):
+        ## nntplib's _longcmd, but handing back lines as they arrive
+        cli = self.cli
+        cli._putcmd(line)
+        resp = cli._getresp()
+        if resp[:3] not in nntplib._LONGRESP:
+            raise nntplib.NNTPReplyError(resp)
+
+        done = False
+        try:
+            yield from _iter_body(cli, resp)
+            done = True
+        finally:
+            if not done:
+                self._abort()
 
     def get_header(self, message_spec, group_name=None):
         if group_name is not None:
@@ -213,56 +728,183 @@ class NNTPClient(object):
 
         ## class ArticleInfo
         resp, header = self.cli.head(message_spec)
+        return self._parse_header_lines(header.lines)
+
+    def iter_headers(self, message_specs, group_name=None, window=None):
+        ## get_header for many articles at once.  HEAD commands are
+        ## pipelined, up to window of them are on the wire before we
+        ## wait for the first answer, so n headers cost about
+        ## n / window round trips instead of n.
+        ##
+        ## yields (message_spec, header) in the order asked, header
+        ## is None when the server doesn't have the article.
+        if group_name is not None:
+            self.group(group_name)
+
+        message_specs = list(message_specs)
+        if not self._group:
+            for message_spec in message_specs:
+                if not isinstance(message_spec, str) or not message_spec.startswith('<'):
+                    raise Exception('Article id supplied without group name')
+
+        for message_spec, lines in self._iter_pipelined('HEAD', message_specs,
+                                                        window or self.pipeline_window):
+            if lines is not None:
+                lines = self._parse_header_lines(lines)
+            yield message_spec, lines
+
+    def get_headers(self, message_specs, group_name=None, window=None):
+        return list(self.iter_headers(message_specs, group_name, window))
+
+    @handle_nntp_exceptions
+    def _iter_pipelined(self, cmd, args, window):
+        ## sends 'cmd arg' for every arg without waiting for answers,
+        ## keeping at most window outstanding, and yields
+        ## (arg, lines) as each long response comes back.  lines is
+        ## None for a 4xx (no such article and friends)
+        cli = self.cli
+        sent = done = 0
+        ## whether we're between answers with none outstanding, the
+        ## one place the connection can be left as it is
+        clean = False
+        try:
+            while done < len(args):
+                ## top up in batches, a write per answer would
+                ## cost a syscall each
+                if sent < len(args) and sent - done <= window // 2:
+                    while sent < len(args) and sent - done < window:
+                        cli.file.write(('%s %s\r\n' % (cmd, args[sent])).encode(cli.encoding))
+                        sent += 1
+                    cli.file.flush()
+
+                arg = args[done]
+                done += 1
+                try:
+                    resp, lines = cli._getlongresp()
+                except RequestError as e:
+                    log.debug('%s %s: %s %s' % (cmd, arg, e.code, e.msg))
+                    lines = None
+                clean = sent == done
+                yield arg, lines
+                clean = False
+            clean = True
+        finally:
+            if not clean:
+                ## answers still on their way
+                self._abort()
+
+    def _parse_header_lines(self, lines):
         h = {}
-        for line in header.lines:
+        k = None
+        for line in lines:
             line = line.decode(self.cli.encoding, errors=self.cli.errors)
+            if k is not None and line[:1] in (' ', '\t'):
+                ## folded onto the next line
+                h[k] = '%s %s' % (h[k], nntplib.decode_header(line).strip())
+                continue
             k, v = line.split(':', 1)
+            k = k.lower()
             v = nntplib.decode_header(v)
-            h[k.lower()] = v.strip()
+            h[k] = v.strip()
         return h
 
-    @staticmethod
-    def _parse_header(tokens):
-        fields = {}
-        for i, token in enumerate(tokens):
-            if i >= len(fmt):
-                # XXX should we raise an error? Some servers might not
-                # support LIST OVERVIEW.FMT and still return additional
-                # headers.
-                continue
-            field_name = fmt[i]
-            if i >= n_defaults and not is_metadata:
-                # Non-default header names are included in full in the response
-                # (unless the field is totally empty)
-                h = field_name + ": "
-                if token and token[:len(h)].lower() != h:
-                    raise nntplib.NNTPDataError("HEAD response doesn't include "
-                                                "names of additional headers")
-                token = token[len(h):] if token else None
-            fields[fmt[i]] = token
-        return fields
-
-    def get_body(self, message_spec, group_name=None):
-        raise NotImplemented
-
+    def iter_body(self, message_spec, group_name=None, article=False):
+        ## the raw lines of BODY (ARTICLE with article=True) as they
+        ## come off the socket, nothing is kept.  dropping it part
+        ## way through costs the connection
         if group_name is not None:
             self.group(group_name)
 
         if (not isinstance(message_spec, str) or not message_spec.startswith('<')) and not self._group:
             raise Exception('Article id supplied without group name')
 
-        resp, body = self.cli.body(message_spec)
-
-
-    def get_article(self, message_spec, group_name=None):
-        raise NotImplemented
-
-        if group_name is not None:
-            self.group(group_name)
-
-        if (not isinstance(message_spec, str) or not message_spec.startswith('<')) and not self._group:
-            raise Exception('Article id supplied without group name')
+        yield from self._iter_longcmd('%s %s' % ('ARTICLE' if article else 'BODY', message_spec))
 
-        resp, info = self.cli.article(message_spec)
-        info.lines
+    def iter_body_blocks(self, message_spec, group_name=None, decode=True,
+                         block_size=settings.BODY_BLOCK):
+        ## the body in blocks of about block_size bytes, yEnc decoded
+        ## (CRC checked at the end) or, with decode=False, as sent
+        lines = self.iter_body(message_spec, group_name)
+        decoder = yenc.Decoder() if decode else None
+        block = bytearray()
+        try:
+            for line in lines:
+                if decoder is not None:
+                    block += decoder.feed(line)
+                else:
+                    block += line + b'\r\n'
+                if len(block) >= block_size:
+                    yield bytes(block)
+                    block.clear()
+        finally:
+            lines.close()
+        if decoder is not None:
+            decoder.check()
+        if block:
+            yield bytes(block)
+
+    def get_body(self, message_spec, group_name=None, path=None, directory=None, decode=True):
+        ## BODY written to a file a line at a time as it arrives,
+        ## so memory use doesn't grow with the article.
+        ##
+        ## yEnc is decoded (decode=False writes the body as sent) into
+        ## path, or directory/<the yEnc name>.  a part of a multipart
+        ## post goes at its own offset in the file, so all the parts
+        ## fetched into the same path make up the whole file.  raises
+        ## yenc.YencError if the CRC32 or size don't match.
+        ##
+        ## returns the path written and what the yEnc lines said
+        ## (see yenc.Decoder.info)
+        lines = self.iter_body(message_spec, group_name)
+        try:
+            return self._save_body(lines, message_spec, path, directory, decode)
+        finally:
+            lines.close()
+
+    def get_article(self, message_spec, group_name=None, path=None, directory=None, decode=True):
+        ## get_body, through ARTICLE: the same dict, with the
+        ## parsed header under 'header'
+        lines = self.iter_body(message_spec, group_name, article=True)
+        try:
+            head = []
+            for line in lines:
+                if not line:
+                    break
+                head.append(line)
+            info = self._save_body(lines, message_spec, path, directory, decode)
+        finally:
+            lines.close()
+        info['header'] = self._parse_header_lines(head)
+        return info
+
+    def _save_body(self, lines, message_spec, path, directory, decode):
+        ## the file isn't opened until the first data, by then
+        ## =ybegin/=ypart have said what it's called and where
+        ## this part goes
+        decoder = yenc.Decoder() if decode else None
+        out = None
+        try:
+            for line in lines:
+                if decoder is None:
+                    data = line + b'\r\n'
+                else:
+                    data = decoder.feed(line)
+                    if not data:
+                        continue
+                if out is None:
+                    if path is None:
+                        path = os.path.join(directory or '.',
+                                            (decoder and decoder.name and yenc.safe_name(decoder.name))
+                                            or _file_name(message_spec))
+                    out = _open_body(path, decoder.offset if decoder else None)
+                out.write(data)
+        finally:
+            if out is not None:
+                out.close()
+
+        info = {'path': path}
+        if decoder is not None:
+            decoder.check()
+            info.update(decoder.info())
+        return info
 
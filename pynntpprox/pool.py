@@ -0,0 +1,192 @@
+# shared pool of long lived NNTP connections
+import time
+import logging
+import threading
+import contextlib
+import nntplib
+
+from .nntp import NNTPClient, ConnectionError
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+class PoolTimeout(ConnectionError):
+    ## every connection stayed busy for the whole timeout,
+    ## nothing is wrong with the server itself
+    pass
+
+
+class NNTPPool(object):
+    ## connections are checked out for the length of a single request
+    ## and handed back, so any number of client sessions can share
+    ## the handful of connections the provider allows.
+    ##
+    ## each NNTPClient already remembers which group it has selected,
+    ## the pool uses that to only send GROUP when a request needs a
+    ## different one.
+    def __init__(self, config, size=None, cache=None):
+        self._conf = config
+        # shared by every connection
+        self._cache = cache
+        # what one connection learns that saves the next one a round
+        # trip: capabilities, the TLS context and session (see nntp.py)
+        self.shared = {}
+        self.size = size if size is not None else config['CONNECTIONS']
+        # idle clients, most recently used last
+        self._idle = []
+        # clients open or being opened
+        self._count = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @staticmethod
+    def selected(client):
+        return (client.group() or {}).get('group')
+
+    def _connect(self):
+        try:
+            return NNTPClient(self._conf, cache=self._cache, shared=self.shared)
+        except ConnectionError:
+            raise
+        except (nntplib.NNTPError, OSError, EOFError) as e:
+            ## nntplib raises from __init__ before our
+            ## exception handling has a chance to wrap it
+            raise ConnectionError(getattr(e, 'response', str(e)))
+
+    def _take(self, group_name):
+        ## prefer an idle connection that already sits in the group
+        if group_name is not None:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self.selected(self._idle[i]) == group_name:
+                    return self._idle.pop(i)
+        return self._idle.pop()
+
+    def acquire(self, group_name=None, timeout=None):
+        client = None
+        with self._cond:
+            while 1:
+                if self._closed:
+                    raise ConnectionError('400 Connection pool closed')
+                if self._idle:
+                    client = self._take(group_name)
+                    break
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                if not self._cond.wait(timeout):
+                    raise PoolTimeout('400 Timed out waiting for a connection')
+
+        if client is None:
+            try:
+                client = self._connect()
+            except:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify()
+                raise
+
+        if group_name is not None and self.selected(client) != group_name:
+            try:
+                client.group(group_name)
+            except ConnectionError:
+                self.discard(client)
+                raise
+            except:
+                self.release(client)
+                raise
+        return client
+
+    def release(self, client):
+        if not client.usable:
+            ## e.g. a stream that was abandoned part way
+            return self.discard(client)
+        client.used = time.time()
+        with self._cond:
+            if self._closed:
+                self._count -= 1
+            else:
+                self._idle.append(client)
+                self._cond.notify()
+                return
+        self._hangup(client)
+
+    def discard(self, client):
+        ## the connection has gone bad, make room for a new one
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+        self._hangup(client)
+
+    @staticmethod
+    def _hangup(client):
+        try:
+            client._disconnect()
+        except Exception:
+            ## if it's dead, it's dead
+            pass
+
+    @contextlib.contextmanager
+    def connection(self, group_name=None, timeout=None):
+        client = self.acquire(group_name, timeout)
+        try:
+            yield client
+        except ConnectionError:
+            self.discard(client)
+            raise
+        except:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def maintain(self, warm=0, keepalive=None):
+        ## run every so often: sends a keepalive down connections idle
+        ## for more than keepalive seconds, so the server doesn't hang
+        ## up on them, and opens connections until warm are open, so
+        ## requests don't wait for a connect and login
+        if keepalive:
+            now = time.time()
+            with self._cond:
+                stale = [c for c in self._idle if now - c.used > keepalive]
+                self._idle = [c for c in self._idle if c not in stale]
+            for client in stale:
+                try:
+                    client.keepalive()
+                except Exception as e:
+                    log.info('Keepalive failed, dropping connection: %s' % e)
+                    self.discard(client)
+                else:
+                    self.release(client)
+
+        while 1:
+            with self._cond:
+                if self._closed or self._count >= min(warm, self.size):
+                    return
+                self._count += 1
+            try:
+                client = self._connect()
+            except Exception as e:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify()
+                log.info('Could not open a warm connection: %s' % e)
+                return
+            self.release(client)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self.size,
+                    'open': self._count,
+                    'idle': len(self._idle)}
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            self._cond.notify_all()
+        for client in idle:
+            self._hangup(client)
@@ -0,0 +1,141 @@
+# several daemon processes on one port, to use more than one core
+##
+## the supervisor opens the listening socket and forks a DaemonProx per
+## process, which all select() on it; whichever wakes first accepts the
+## client and keeps it.  each worker gets its slice of every server's
+## CONNECTIONS so between them they never open more than the provider
+## allows.  a worker that dies is started again.
+##
+## the overview cache, SYNC marks and group list are on disk and
+## shared, the header cache and STATS are per worker.  with
+## METRICS_PORT set worker i serves its metrics on METRICS_PORT + i.
+##
+## fork() only, so not on Windows.
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import traceback
+
+from . import settings
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+def primary_name(servers):
+    ## as NNTPService picks it
+    return min(servers, key=lambda name: servers[name].get('PRIORITY') or 0)
+
+
+def split_servers(servers, processes, index):
+    ## worker index's share of servers: CONNECTIONS divided as evenly
+    ## as it goes, a server with nothing left over for this worker is
+    ## left out of it
+    share = {}
+    for name, config in servers.items():
+        total = config.get('CONNECTIONS') or 1
+        n = total // processes + (1 if index < total % processes else 0)
+        if n:
+            share[name] = dict(config, CONNECTIONS=n)
+    return share
+
+
+class Supervisor(object):
+    ## seconds a worker has to stay up to be restarted straight away,
+    ## one dying faster than that is restarted after this long instead
+    restart_delay = 1.0
+
+    def __init__(self, processes, host=settings.LISTEN_HOST, port=settings.LISTEN_PORT,
+                 backlog=128, servers=None):
+        self.servers = servers or settings.SERVERS
+        ## every worker needs a connection to the primary server
+        budget = self.servers[primary_name(self.servers)].get('CONNECTIONS') or 1
+        if processes > budget:
+            log.info('Only %s connections to share, running %s workers' % (budget, budget))
+            processes = budget
+        self.processes = processes
+        self.address = (host, port)
+        self.backlog = backlog
+        self.sock = None
+        ## pid: worker index
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+
+    def serve_forever(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(self.backlog)
+        self.sock.setblocking(False)
+        log.info('Listening on %s:%s with %s workers' % (self.address + (self.processes, )))
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.processes):
+            self._spawn(index)
+
+        try:
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                index = self.children.pop(pid, None)
+                if index is None or self.stopping:
+                    continue
+                log.error('Worker %s (pid %s) exited with status %s, restarting'
+                          % (index, pid, status))
+                if time.time() - self.started[index] < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                if not self.stopping:
+                    self._spawn(index)
+        finally:
+            self.sock.close()
+            log.info('Shut down')
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            self.started[index] = time.time()
+            return
+
+        ## in the worker from here on
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            ## lets serve_forever clean up (QUIT its connections)
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            self._work(index)
+        except SystemExit:
+            pass
+        except:
+            log.error(traceback.format_exc())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _work(self, index):
+        from .daemonprox import DaemonProx
+        metrics_port = None
+        if settings.METRICS_PORT:
+            metrics_port = settings.METRICS_PORT + index
+        servers = split_servers(self.servers, self.processes, index)
+        log.info('Worker %s (pid %s) up, connections: %s' % (
+            index, os.getpid(),
+            ', '.join('%s=%s' % (name, c['CONNECTIONS']) for name, c in servers.items())))
+        DaemonProx(sock=self.sock, servers=servers, metrics_port=metrics_port).serve_forever()
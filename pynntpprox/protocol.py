@@ -0,0 +1,238 @@
+# wire framing shared by the daemon and its clients
+##
+## v1: a pickle followed by DELIMITER
+## v2: MAGIC, a 4 byte big endian length, then the pickle
+##
+## a v2 frame can't be mistaken for a v1 one, pickles never
+## start with a NUL byte.
+import sys
+import struct
+from array import array
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from pynntpprox import settings
+
+
+DELIMITER = b"\x00~~EOM~~\x00"
+MAGIC = b"\x00PX2"
+HEADER = struct.Struct('!4sI')
+
+V1 = 1
+V2 = 2
+
+
+def encode(sdata, version=V1):
+    payload = pickle.dumps(sdata, protocol=settings.PICKLE_PROTOCOL)
+    if version == V2:
+        return HEADER.pack(MAGIC, len(payload)) + payload
+    return payload + DELIMITER
+
+
+class FrameReader(object):
+    ## receive buffer for one connection.
+    ##
+    ## data is read straight into a preallocated bytearray with
+    ## recv_into and frames are handed out as memoryviews over it,
+    ## so nothing is copied on the way in.  the DELIMITER search
+    ## resumes where the last one left off, so a large v1 message
+    ## arriving in many reads is only scanned once.
+    ##
+    ## a frame longer than max_frame (None for no limit) is a
+    ## ValueError, before any room is made for it.
+    def __init__(self, size=65536, max_frame=None):
+        self._buf = bytearray(size)
+        self._max_frame = max_frame
+        self._start = 0
+        self._end = 0
+        ## where the next DELIMITER search picks up
+        self._scan = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        ## make room for at least size more bytes at the end
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start:
+            ## slide what is left down to the front
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._scan -= self._start
+            self._start, self._end = 0, pending
+        if len(self._buf) - self._end < size:
+            self._buf.extend(bytes(max(size, len(self._buf))))
+
+    def _check_length(self, length):
+        if self._max_frame is not None and length > self._max_frame:
+            raise ValueError('Frame too large (%d bytes, at most %d)'
+                             % (length, self._max_frame))
+
+    def recv_from(self, sock, size=65536):
+        self._reserve(size)
+        with memoryview(self._buf) as view:
+            n = sock.recv_into(view[self._end:self._end + size])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        ## yields (version, memoryview) for every complete frame.
+        ## a view is only good until the next one is asked for
+        while self._start < self._end:
+            start, end = self._start, self._end
+            if self._buf[start:start + 1] == MAGIC[:1]:
+                ## v2, or the start of one
+                if end - start < HEADER.size:
+                    if not MAGIC.startswith(bytes(self._buf[start:end])[:len(MAGIC)]):
+                        raise ValueError('Bad frame header')
+                    return
+                magic, length = HEADER.unpack_from(self._buf, start)
+                if magic != MAGIC:
+                    raise ValueError('Bad frame header')
+                self._check_length(length)
+                eom = start + HEADER.size + length
+                if eom > end:
+                    ## make sure the rest of it will fit
+                    self._reserve(eom - end)
+                    return
+                body = (start + HEADER.size, eom)
+                version = V2
+            else:
+                scan = max(self._scan, start)
+                found = self._buf.find(DELIMITER, scan, end)
+                if found < 0:
+                    self._check_length(end - start - len(DELIMITER))
+                    self._scan = max(start, end - len(DELIMITER) + 1)
+                    return
+                eom = found + len(DELIMITER)
+                body = (start, found)
+                version = V1
+
+            self._start = self._scan = eom
+            with memoryview(self._buf) as view:
+                with view[body[0]:body[1]] as frame:
+                    yield version, frame
+        ## everything consumed, start over at the front
+        self._start = self._end = self._scan = 0
+
+
+## overview results, column-wise
+##
+## GETGROUP normally answers with a list of (article_id, {field: value})
+## which repeats every key for every article.  asking for
+## 'FORMAT': 'COLUMNAR' gets this instead:
+##
+##     {'FORMAT': 'COLUMNAR',
+##      'ids': <article ids, little endian int64s>,
+##      'columns': {field: ('int', <little endian int64s>)
+##                      or ('str', [distinct values], <little endian
+##                              uint32 index into them per article>)}}
+##
+## a field made up only of plain decimal numbers is an int column,
+## anything else is a str column.  an article without the field has
+## index MISSING in a str column (int columns are only used when
+## every article has the field).  decode_columnar turns it back
+## into the list.
+COLUMNAR = 'COLUMNAR'
+MISSING = 0xffffffff
+_ABSENT = object()
+
+
+def _pack(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack(typecode, data):
+    a = array(typecode)
+    a.frombytes(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+## the largest value an int column ('q') holds
+_INT_MAX = 2 ** 63 - 1
+
+
+def _is_int(v):
+    ## round trips through an int column: no leading zeros to
+    ## lose and small enough for a signed 64 bit int
+    return (v.isdigit() and v.isascii() and (v == '0' or v[0] != '0')
+            and (len(v) < 19 or int(v) <= _INT_MAX))
+
+
+def encode_columnar(overviews):
+    ids = []
+    fields = {}
+    for i, (article_id, ovr) in enumerate(overviews):
+        ids.append(article_id)
+        for k, v in ovr.items():
+            column = fields.get(k)
+            if column is None:
+                column = fields[k] = [_ABSENT] * i
+            column.append(v)
+        for k, column in fields.items():
+            if len(column) <= i:
+                ## this article doesn't have it
+                column.append(_ABSENT)
+
+    columns = {}
+    for k, values in fields.items():
+        if all(isinstance(v, str) and _is_int(v) for v in values):
+            columns[k] = ('int', _pack('q', [int(v) for v in values]))
+            continue
+        strings = []
+        lookup = {}
+        index = []
+        for v in values:
+            if v is _ABSENT:
+                index.append(MISSING)
+                continue
+            n = lookup.get(v)
+            if n is None:
+                n = lookup[v] = len(strings)
+                strings.append(v)
+            index.append(n)
+        columns[k] = ('str', strings, _pack('I', index))
+
+    return {'FORMAT': COLUMNAR,
+            'ids': _pack('q', ids),
+            'columns': columns}
+
+
+def decode_columnar(data):
+    ids = _unpack('q', data['ids'])
+    overviews = [(article_id, {}) for article_id in ids]
+    for k, column in data['columns'].items():
+        if column[0] == 'int':
+            for (article_id, ovr), v in zip(overviews, _unpack('q', column[1])):
+                ovr[k] = str(v)
+        else:
+            strings = column[1]
+            for (article_id, ovr), n in zip(overviews, _unpack('I', column[2])):
+                if n != MISSING:
+                    ovr[k] = strings[n]
+    return overviews
+
+
+## response encodings a client can ask for with 'FORMAT'
+ENCODERS = {
+    COLUMNAR: encode_columnar,
+}
+
+
+def decode(frame):
+    ## "Bytes past the pickled object’s representation
+    ## are ignored [by pickle]."
+    return pickle.loads(frame, encoding='utf8')
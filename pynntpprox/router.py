@@ -0,0 +1,220 @@
+# picks which of the configured servers a request goes to
+##
+## every server in settings.SERVERS gets a pool of its own (sized by
+## its CONNECTIONS) and a running score: an average of how long its
+## requests take and how often they fail.  requests go to the best
+## scoring server first and fail over down the list when a server
+## can't be reached, errors out, or (for message-ids) answers 430.
+##
+## article numbers are per provider, so anything asked by number can
+## only go to servers sharing the primary server's NUMBERING.  by
+## default every server numbers on its own and numbered requests only
+## ever go to the primary.  message-ids are the same everywhere and
+## can go anywhere.
+##
+## server config keys used here:
+##     PRIORITY  lower is tried first, whatever the scores (default 0),
+##               give backups a higher one to only use them on failover
+##     NUMBERING servers with the same value share article numbers
+##               (e.g. two hostnames of one provider), default the name
+import time
+import logging
+import contextlib
+
+from . import settings
+from .pool import NNTPPool, PoolTimeout
+from .nntp import ConnectionError, RequestError
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+## answers that mean try another server for a message-id
+MISSING = ('430', )
+
+
+class Server(object):
+    ## one configured server, its pool and how it has been doing
+    ##
+    ## latency and errors are exponentially weighted averages, so a
+    ## slow spell shows up within a few requests and is forgotten
+    ## as quickly once it's over.  a run of connection failures
+    ## takes the server out of the rotation for a while, doubling
+    ## each time up to max_backoff.
+    alpha = 0.2
+    max_backoff = 300
+
+    def __init__(self, name, config, pool):
+        self.name = name
+        self.config = config
+        self.pool = pool
+        self.priority = config.get('PRIORITY') or 0
+        self.numbering = config.get('NUMBERING') or name
+        self.latency = None
+        self.errors = 0.0
+        self.failures = 0
+        self.down_until = 0
+
+    def __repr__(self):
+        return '<Server %s>' % self.name
+
+    @property
+    def up(self):
+        return time.time() >= self.down_until
+
+    def score(self):
+        ## seconds, give or take.  a server we know nothing about
+        ## yet scores best so it gets measured
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + 4 * self.errors)
+
+    def _average(self, value, sample):
+        return sample if value is None else value + self.alpha * (sample - value)
+
+    def succeeded(self, seconds=None):
+        if seconds is not None:
+            self.latency = self._average(self.latency, seconds)
+        self.errors = self._average(self.errors, 0.0)
+        self.failures = 0
+
+    def missed(self):
+        ## didn't have the article, fine but not great
+        self.errors = self._average(self.errors, 0.5)
+
+    def failed(self, error):
+        self.errors = self._average(self.errors, 1.0)
+        self.failures += 1
+        if self.failures >= 3:
+            backoff = min(2 ** (self.failures - 3), self.max_backoff)
+            self.down_until = time.time() + backoff
+            log.info('%s is down for %ss: %s' % (self.name, backoff, error))
+        else:
+            log.info('%s failed: %s' % (self.name, error))
+
+    def stats(self):
+        pool = self.pool.stats()
+        return {'latency': self.latency or 0.0,
+                'errors': self.errors,
+                'up': int(self.up),
+                'open': pool['open'],
+                'idle': pool['idle']}
+
+
+class Router(object):
+    def __init__(self, servers, make_pool=None, failover_wait=None):
+        ## servers is settings.SERVERS shaped: {name: config}, the
+        ## first of the lowest PRIORITY is the primary.  make_pool
+        ## (name, config) returns the pool for a server
+        self.servers = []
+        for name, config in servers.items():
+            pool = make_pool(name, config) if make_pool else NNTPPool(config)
+            self.servers.append(Server(name, config, pool))
+        if not self.servers:
+            raise Exception('No servers configured')
+        ## sort is stable, config order breaks ties
+        self.servers.sort(key=lambda server: server.priority)
+        self.primary = self.servers[0]
+        ## how long to wait on a busy server's pool
+        ## before trying the next one instead
+        self.failover_wait = (failover_wait if failover_wait is not None
+                              else settings.FAILOVER_WAIT)
+
+    def close(self):
+        for server in self.servers:
+            server.pool.close()
+
+    def order(self, numbering=None):
+        ## the servers to try, best first.  servers that are down go
+        ## last rather than nowhere, if they're all down the one
+        ## that's been down longest might be back
+        servers = [server for server in self.servers
+                   if numbering is None or server.numbering == numbering]
+        return sorted(servers, key=lambda server: (not server.up, server.priority,
+                                                   server.score()))
+
+    def _acquire(self, servers, group_name):
+        ## (server, client) from the first of servers with one to spare
+        last_error = None
+        for i, server in enumerate(servers):
+            last = i == len(servers) - 1
+            try:
+                return server, server.pool.acquire(group_name,
+                                                   None if last else self.failover_wait)
+            except PoolTimeout as e:
+                last_error = e
+            except ConnectionError as e:
+                server.failed(e)
+                last_error = e
+        raise last_error
+
+    @contextlib.contextmanager
+    def checkout(self, group_name=None, numbering=None, servers=None):
+        ## pool.connection(), from the best server that can be
+        ## reached.  yields (server, client)
+        server, client = self._acquire(servers or self.order(numbering), group_name)
+        start = time.time()
+        try:
+            yield server, client
+        except ConnectionError as e:
+            server.pool.discard(client)
+            server.failed(e)
+            raise
+        except:
+            server.pool.release(client)
+            raise
+        else:
+            server.pool.release(client)
+            server.succeeded(time.time() - start)
+
+    @contextlib.contextmanager
+    def connection(self, group_name=None, numbering=None):
+        with self.checkout(group_name, numbering) as (server, client):
+            yield client
+
+    def run(self, func, group_name=None, numbering=None, exclude=()):
+        ## func(client) on the best server, then on the next one if
+        ## that can't be reached, fails, or doesn't have the article
+        servers = [server for server in self.order(numbering) if server not in exclude]
+        last_error = None
+        while servers:
+            start = time.time()
+            try:
+                server, client = self._acquire(servers, group_name)
+            except ConnectionError:
+                ## the ones we did reach didn't have it, say so
+                if last_error is not None:
+                    raise last_error
+                raise
+            servers = servers[servers.index(server) + 1:]
+            try:
+                result = func(client)
+            except ConnectionError as e:
+                server.pool.discard(client)
+                server.failed(e)
+                last_error = e
+                continue
+            except RequestError as e:
+                server.pool.release(client)
+                if e.code not in MISSING:
+                    raise
+                server.missed()
+                last_error = e
+                continue
+            except:
+                server.pool.release(client)
+                raise
+            server.pool.release(client)
+            server.succeeded(time.time() - start)
+            return result
+        raise last_error
+
+    def stats(self):
+        ## flat, so the metrics endpoint can show it
+        stats = {}
+        for server in self.servers:
+            for k, v in server.stats().items():
+                stats['%s_%s' % (server.name, k)] = v
+        return stats
@@ -0,0 +1,617 @@
+# the NNTP side of the daemon: every request runs against a
+# connection borrowed from the pool for just that request, from
+# whichever server the router thinks best (see router.py)
+import os
+import time
+import logging
+import datetime
+import traceback
+import itertools
+import threading
+import email.utils
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import settings
+from .pool import NNTPPool
+from .nntp import RequestError
+from .router import Router
+from .singleflight import SingleFlight
+from .cache import OverviewCache, HeaderCache, SyncMarks, GroupList, DatePoints
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+def is_message_id(message_spec):
+    return isinstance(message_spec, str) and message_spec.startswith('<')
+
+
+class NNTPService(object):
+    def __init__(self, config=None, pool=None, servers=None):
+        ## servers is settings.SERVERS shaped, or just one server's
+        ## config.  the caches and marks belong to the primary server,
+        ## whose article numbers everything numbered is asked by
+        if servers is None:
+            servers = {'default': config}
+        primary = min(servers, key=lambda name: servers[name].get('PRIORITY') or 0)
+        config = servers[primary]
+        self.numbering = config.get('NUMBERING') or primary
+        self._conf = config
+        self.overviews = None
+        if settings.OVERVIEW_CACHE:
+            path = os.path.join(settings.CACHE_DIR,
+                                '%s.overview.db' % config['HOST'])
+            self.overviews = OverviewCache(path, config.get('RETENTION'))
+        ## headers by message-id, shared by all sessions
+        self.headers = None
+        if settings.HEADER_CACHE_BYTES:
+            self.headers = HeaderCache(settings.HEADER_CACHE_BYTES)
+        ## the active list, for GETGROUPS
+        self.group_list = None
+        if settings.GROUP_LIST_TTL:
+            self.group_list = GroupList(os.path.join(settings.CACHE_DIR,
+                                                     '%s.groups.pickle' % config['HOST']))
+        self._groups_lock = threading.Lock()
+        ## article number -> date points, for GETGROUPSINCE
+        self.dates = DatePoints()
+        ## identical requests in flight together share a fetch
+        self.flights = SingleFlight() if settings.COALESCE_REQUESTS else None
+        ## how far SYNC has got in each group, opened by the first
+        ## SYNC (see marks)
+        self._marks = None
+        self._marks_lock = threading.Lock()
+
+        def make_pool(name, conf):
+            if name == primary and pool is not None:
+                return pool
+            ## the overview cache is by article number
+            if (conf.get('NUMBERING') or name) == self.numbering:
+                return NNTPPool(conf, cache=self.overviews)
+            return NNTPPool(conf)
+        self.router = Router(servers, make_pool)
+        ## the primary's pool
+        self.pool = self.router.primary.pool
+
+        ## big article ranges are cut into chunk_size pieces and
+        ## fetched on up to parallel connections at once
+        self.chunk_size = settings.OVERVIEW_CHUNK
+        self.parallel = min(settings.OVERVIEW_PARALLEL or self.pool.size,
+                            self.pool.size)
+        self._fetcher = ThreadPoolExecutor(max_workers=self.pool.size)
+        self._closed = threading.Event()
+
+    @property
+    def marks(self):
+        with self._marks_lock:
+            if self._marks is None:
+                self._marks = SyncMarks(os.path.join(settings.CACHE_DIR,
+                                                     '%s.sync.db' % self._conf['HOST']))
+            return self._marks
+
+    def warm(self):
+        ## opens connections ahead of the first request and keeps them
+        ## open, in the background until close()
+        thread = threading.Thread(target=self._keep_warm)
+        thread.daemon = True
+        thread.start()
+
+    def _keep_warm(self):
+        while not self._closed.is_set():
+            for server in self.router.servers:
+                warm = server.config.get('WARM')
+                if warm is None:
+                    warm = settings.WARM_CONNECTIONS
+                try:
+                    server.pool.maintain(warm, settings.KEEPALIVE)
+                except Exception:
+                    log.error(traceback.format_exc())
+            self._closed.wait(settings.KEEPALIVE_INTERVAL)
+
+    def close(self):
+        self._closed.set()
+        self._fetcher.shutdown(wait=False)
+        self.router.close()
+        if self._marks is not None:
+            self._marks.close()
+        if self.overviews is not None:
+            self.overviews.close()
+
+    def get_groups(self, prefix=None):
+        ## prefix is a wildmat, e.g. 'alt.binaries.*'.  first/last
+        ## are as of the last LIST ACTIVE, GROUP has fresh ones
+        if self.group_list is None:
+            with self._connection() as nntp:
+                return nntp.get_groups(prefix)
+        self._refresh_groups()
+        return tuple(self.group_list.match(prefix))
+
+    def _refresh_groups(self):
+        ## a full LIST ACTIVE every GROUP_LIST_TTL, NEWGROUPS for
+        ## the groups created in between every GROUP_LIST_REFRESH.
+        ## only the very first listing is waited for, after that the
+        ## list we have is served while one thread updates it
+        if not self._groups_due(self.group_list):
+            return
+        if self.group_list.listed is None:
+            with self._groups_lock:
+                self._update_groups()
+            return
+        if not self._groups_lock.acquire(blocking=False):
+            ## already being updated
+            return
+        thread = threading.Thread(target=self._update_groups_in_background)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _groups_due(groups):
+        now = time.time()
+        return (groups.listed is None
+                or now - groups.listed > settings.GROUP_LIST_TTL
+                or now - groups.refreshed > settings.GROUP_LIST_REFRESH)
+
+    def _update_groups_in_background(self):
+        ## _groups_lock was taken for us by _refresh_groups
+        try:
+            self._update_groups()
+        except Exception:
+            log.debug(traceback.format_exc())
+        finally:
+            self._groups_lock.release()
+
+    def _update_groups(self):
+        ## with _groups_lock held
+        groups = self.group_list
+        now = time.time()
+        try:
+            if groups.listed is None or now - groups.listed > settings.GROUP_LIST_TTL:
+                with self._connection() as nntp:
+                    listing = nntp.get_groups()
+                groups = GroupList.listing(groups.path, listing, now)
+                log.info('Listed %s groups' % len(groups))
+            elif now - groups.refreshed > settings.GROUP_LIST_REFRESH:
+                ## a minute of overlap in case the clocks
+                ## moved, merging a group twice is harmless
+                since = datetime.datetime.fromtimestamp(groups.refreshed - 60)
+                with self._connection() as nntp:
+                    new = nntp.new_groups(since)
+                groups = groups.added(new, now)
+            else:
+                return
+        except Exception:
+            if groups.listed is None:
+                raise
+            ## a stale list beats no list
+            log.info('Group list refresh failed, serving the old one')
+            log.debug(traceback.format_exc())
+            return
+        self.group_list = groups
+        groups.save()
+
+    def _connection(self, group_name=None):
+        ## for anything by article number: only servers
+        ## numbering articles the way the primary does
+        return self.router.connection(group_name, self.numbering)
+
+    def _coalesce(self, key, func):
+        ## func(), shared with any identical request (same key)
+        ## already on its way to the server
+        if self.flights is None:
+            return func()
+        return self.flights.do(key, func)
+
+    @staticmethod
+    def _key(*args):
+        ## hashable, whatever the client sent
+        return tuple(tuple(sorted(arg.items())) if isinstance(arg, dict)
+                     else tuple(arg) if isinstance(arg, list)
+                     else arg for arg in args)
+
+    def group(self, group_name):
+        ## always asks the server, so counts are fresh
+        def fetch():
+            with self._connection() as nntp:
+                return nntp.group(group_name)
+        return self._coalesce(('GROUP', group_name), fetch)
+
+    def get_group(self, message_spec, group_name=None, raw=False, fields=None, where=None):
+        return self._coalesce(
+            self._key('OVER', group_name, message_spec, raw, fields, where),
+            lambda: list(self.iter_group(message_spec, group_name, raw, fields, where)))
+
+    def iter_group(self, message_spec, group_name=None, raw=False, fields=None, where=None):
+        ## the connection stays checked out while the caller iterates
+        if isinstance(message_spec, (tuple, list)):
+            if group_name is None:
+                raise Exception('Article ids supplied without group name')
+            first, last = message_spec
+            if last is None:
+                last = self.group(group_name)['last']
+            if self.parallel > 1 and last - first + 1 > self.chunk_size:
+                yield from self._iter_parallel(group_name, first, last, raw, fields, where)
+                return
+
+        with self._connection(group_name) as nntp:
+            overviews = nntp.iter_group(message_spec, raw=raw, fields=fields, where=where)
+            try:
+                for ovr in overviews:
+                    yield ovr
+            finally:
+                overviews.close()
+
+    def _fetch_range(self, group_name, first, last, raw, fields, where):
+        with self._connection(group_name) as nntp:
+            try:
+                return nntp.get_group((first, last), raw=raw, fields=fields, where=where)
+            except RequestError as e:
+                ## 423: no articles in that range, a chunk past the
+                ## end of the group or in a gap of it
+                if e.code != '423':
+                    raise
+                return []
+
+    def _iter_parallel(self, group_name, first, last, raw, fields=None, where=None):
+        ## keeps parallel chunks in flight and hands them
+        ## back in article order as they complete
+        chunks = ((f, min(f + self.chunk_size - 1, last))
+                  for f in range(first, last + 1, self.chunk_size))
+        futures = deque(self._fetcher.submit(self._fetch_range, group_name, f, l,
+                                             raw, fields, where)
+                        for f, l in itertools.islice(chunks, self.parallel))
+        try:
+            while futures:
+                overviews = futures.popleft().result()
+                for f, l in itertools.islice(chunks, 1):
+                    futures.append(self._fetcher.submit(self._fetch_range,
+                                                        group_name, f, l, raw,
+                                                        fields, where))
+                yield from overviews
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def get_hdr(self, header, message_spec, group_name=None, pattern=None, raw=False):
+        return self._coalesce(
+            self._key('HDR', header.lower(), group_name, message_spec, pattern, raw),
+            lambda: list(self.iter_hdr(header, message_spec, group_name, pattern, raw)))
+
+    def iter_hdr(self, header, message_spec, group_name=None, pattern=None, raw=False):
+        ## (article_number, value) for one header over a range, see
+        ## NNTPClient.iter_hdr.  a message-id can go to any server
+        if is_message_id(message_spec):
+            yield from self.router.run(
+                lambda nntp: nntp.get_hdr(header, message_spec, pattern=pattern, raw=raw))
+            return
+        if group_name is None:
+            raise Exception('Article ids supplied without group name')
+        with self._connection(group_name) as nntp:
+            values = nntp.iter_hdr(header, message_spec, pattern=pattern, raw=raw)
+            try:
+                yield from values
+            finally:
+                values.close()
+
+    def get_group_since(self, group_name, since, raw=False, fields=None, where=None):
+        return list(self.iter_group_since(group_name, since, raw, fields, where))
+
+    def iter_group_since(self, group_name, since, raw=False, fields=None, where=None):
+        ## iter_group for the articles of group_name posted since
+        ## since (a datetime, naive ones are local time as
+        ## NNTPClient.date gives, or epoch seconds).  the first of them is found by bisecting
+        ## first..last on the Date of single articles, then the range
+        ## from there on is fetched as usual.  nothing older than the
+        ## server's RETENTION is asked for.
+        ##
+        ## Date is the poster's and posts don't arrive quite in order,
+        ## so the edge is only as sharp as the group's dates are.
+        if not isinstance(since, datetime.datetime):
+            since = datetime.datetime.fromtimestamp(since)
+        elif since.tzinfo is not None:
+            since = since.astimezone().replace(tzinfo=None)
+        with self._connection(group_name) as nntp:
+            info = nntp.group(group_name)
+            ## into the server's clock, which its Dates are in.  date()
+            ## gives the server's naive UTC, an epoch needs it said so
+            posted = self._server_time(nntp, since)
+            if self._conf.get('RETENTION'):
+                posted = max(posted, self._server_time(nntp, datetime.datetime.now())
+                             - self._conf['RETENTION'] * 86400)
+            first = self._find_since(nntp, group_name, info['first'], info['last'], posted)
+        if first > info['last']:
+            return
+        yield from self.iter_group((first, info['last']), group_name, raw, fields, where)
+
+    @staticmethod
+    def _server_time(nntp, local):
+        ## epoch seconds of a naive local datetime, by the server's clock
+        return nntp.date(local).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def _find_since(self, nntp, group_name, first, last, posted):
+        ## the lowest article number posted at or after posted,
+        ## last + 1 if there isn't one.  starts from what earlier
+        ## searches found out about the group
+        lo, hi = first, last + 1
+        below, above = self.dates.bounds(group_name, posted)
+        if below is not None:
+            lo = max(lo, below + 1)
+        if above is not None:
+            hi = max(lo, min(hi, above))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._probe_date(nntp, group_name, mid, hi - 1)
+            if found is None or found[1] >= posted:
+                ## nothing between mid and what we found is
+                ## older, whichever way it's articles from here on
+                hi = mid
+            else:
+                lo = found[0] + 1
+        return lo
+
+    def _probe_date(self, nntp, group_name, first, last):
+        ## (number, posted) of the first article from first on that
+        ## the server still has, None if none up to last.  asks for
+        ## Date over a small window, widening it over gaps
+        window = 16
+        while first <= last:
+            end = min(first + window - 1, last)
+            try:
+                values = nntp.get_hdr('date', (first, end), raw=True)
+            except RequestError as e:
+                ## 423: no articles in that range
+                if e.code != '423':
+                    raise
+                values = []
+            found = None
+            for number, value in values:
+                try:
+                    posted = email.utils.parsedate_to_datetime(value).timestamp()
+                except (TypeError, ValueError):
+                    continue
+                self.dates.add(group_name, number, posted)
+                if found is None:
+                    found = (number, posted)
+            if found is not None:
+                return found
+            first = end + 1
+            window *= 4
+        return None
+
+    def sync(self, group_name, name='', backfill=0, limit=None,
+             initial=None, reset=False, raw=False, fields=None, where=None):
+        ## the articles of group_name this consumer (name) hasn't
+        ## seen yet: everything above its high-water mark, up to
+        ## limit of them, and backfill more below its low-water
+        ## mark.  a group never synced before starts initial
+        ## articles back from the newest.  the marks only move once
+        ## the articles are in hand, so a failed SYNC is simply
+        ## asked again (see iter_sync to have them move later still).
+        ##
+        ## polling a quiet group costs a GROUP and nothing else.
+        ## fields and where are as GETGROUP's, the marks still move
+        ## past the articles they leave out
+        batches = self.iter_sync(group_name, name, backfill, limit, initial,
+                                 reset, raw, fields, where)
+        try:
+            info = next(batches)
+            info['articles'] = next(batches, [])
+            ## runs it to the end, which moves the marks
+            next(batches, None)
+        finally:
+            batches.close()
+        return info
+
+    def iter_sync(self, group_name, name='', backfill=0, limit=None, initial=None,
+                  reset=False, raw=False, fields=None, where=None, batch=None):
+        ## sync a list at a time: yields GROUP's dict with the 'low'
+        ## and 'high' the marks end up at, then the articles in lists
+        ## of up to batch (all in one by default).  the marks move
+        ## past a list only when the next thing is asked for, so a
+        ## consumer that stops part way is handed the rest, and the
+        ## list it stopped on, by the next SYNC
+        if reset:
+            self.marks.forget(name, group_name)
+        if initial is None:
+            initial = settings.SYNC_INITIAL
+
+        fetched = None
+        with self._connection() as nntp:
+            info = dict(nntp.group(group_name))
+            first, last = info['first'], info['last']
+            mark = self.marks.get(name, group_name)
+            if mark is None:
+                high = max(last - initial, first - 1)
+                low = high + 1
+            else:
+                low, high = mark
+
+            ranges = []
+            if backfill and low - 1 >= first:
+                ranges.append((max(first, low - backfill), low - 1))
+            ## articles that expired since the last SYNC are skipped
+            newest = last if limit is None else min(last, max(high, first - 1) + limit)
+            if newest >= max(high + 1, first):
+                ranges.append((max(high + 1, first), newest))
+
+            ## the usual poll is small enough for this connection,
+            ## which already sits in the group
+            if sum(l - f + 1 for f, l in ranges) <= self.chunk_size:
+                fetched = [nntp.get_group((f, l), raw=raw, fields=fields, where=where)
+                           for f, l in ranges]
+        if fetched is None:
+            fetched = (self.iter_group((f, l), group_name, raw, fields, where)
+                       for f, l in ranges)
+
+        new_low = ranges[0][0] if backfill and low - 1 >= first else low
+        new_high = max(high, newest)
+        info.update({'low': new_low,
+                     'high': new_high})
+        yield info
+
+        articles = itertools.chain.from_iterable(fetched)
+        while True:
+            chunk = list(itertools.islice(articles, batch))
+            if not chunk:
+                break
+            yield chunk
+            ## everything up to the last of them has been handed out,
+            ## the backfill once that's past the bottom of the old marks
+            number = chunk[-1][0]
+            self.marks.advance(name, group_name,
+                               new_low if number >= low - 1 else low,
+                               max(high, number))
+        self.marks.advance(name, group_name, new_low, new_high)
+
+    def get_header(self, message_spec, group_name=None):
+        if not is_message_id(message_spec):
+            if group_name is None:
+                raise Exception('Article id supplied without group name')
+        elif self.headers is not None:
+            ## a hit doesn't even need a connection
+            header = self.headers.get(message_spec)
+            if header is not None:
+                return header
+
+        if is_message_id(message_spec):
+            return self._coalesce(('HEAD', message_spec),
+                                  lambda: self._fetch_header(message_spec))
+
+        def fetch():
+            with self._connection(group_name) as nntp:
+                return nntp.get_header(message_spec)
+        return self._coalesce(('HEAD', group_name, message_spec), fetch)
+
+    def _fetch_header(self, message_spec):
+        ## any server will do, the first that has it wins
+        header = self.router.run(lambda nntp: nntp.get_header(message_spec))
+        if self.headers is not None:
+            self.headers.put(message_spec, header)
+        return header
+
+    def _header_elsewhere(self, message_spec, server):
+        ## a message-id server didn't have, from any other server
+        if len(self.router.servers) < 2:
+            return None
+        try:
+            return self.router.run(lambda nntp: nntp.get_header(message_spec),
+                                   exclude=(server, ))
+        except RequestError as e:
+            if e.code != '430':
+                raise
+            return None
+
+    def iter_headers(self, message_specs, group_name=None):
+        ## yields (message_spec, header) in the order asked.  cached
+        ## headers are answered locally, the rest are pipelined
+        ## down a single connection
+        message_specs = list(message_specs)
+        fetch = []
+        cached = {}
+        for message_spec in message_specs:
+            if is_message_id(message_spec):
+                if self.headers is not None:
+                    header = self.headers.get(message_spec)
+                    if header is not None:
+                        cached[message_spec] = header
+                        continue
+            elif group_name is None:
+                raise Exception('Article id supplied without group name')
+            fetch.append(message_spec)
+
+        if not fetch:
+            for message_spec in message_specs:
+                yield message_spec, cached[message_spec]
+            return
+
+        ## message-ids alone can go to any server, article
+        ## numbers only to the primary's kind
+        numbered = not all(is_message_id(message_spec) for message_spec in fetch)
+        ## from the first message-id the server didn't have on, the
+        ## rest are read off its connection and it goes back before
+        ## other servers are asked, so waiting on their pools can't
+        ## cost it a healthy connection
+        rest = None
+        with self.router.checkout(group_name if numbered else None,
+                                  self.numbering if numbered else None) as (server, nntp):
+            fetched = nntp.iter_headers(fetch)
+            try:
+                for i, message_spec in enumerate(message_specs):
+                    if message_spec in cached:
+                        yield message_spec, cached[message_spec]
+                        continue
+                    message_spec, header = next(fetched)
+                    if (header is None and is_message_id(message_spec)
+                            and len(self.router.servers) > 1):
+                        rest = [(message_spec, None)]
+                        rest.extend((m, cached[m]) if m in cached else next(fetched)
+                                    for m in message_specs[i + 1:])
+                        break
+                    yield message_spec, self._keep_header(message_spec, header)
+            finally:
+                fetched.close()
+        for message_spec, header in rest or ():
+            if message_spec not in cached:
+                if header is None and is_message_id(message_spec):
+                    header = self._header_elsewhere(message_spec, server)
+                header = self._keep_header(message_spec, header)
+            yield message_spec, header
+
+    def _keep_header(self, message_spec, header):
+        if (header is not None and self.headers is not None
+                and is_message_id(message_spec)):
+            self.headers.put(message_spec, header)
+        return header
+
+    def get_headers(self, message_specs, group_name=None):
+        return list(self.iter_headers(message_specs, group_name))
+
+    def get_body(self, message_spec, group_name=None, path=None, decode=True, article=False):
+        ## the article's body saved to path, or under DOWNLOAD_DIR by
+        ## its yEnc name.  returns NNTPClient.get_body's dict (with
+        ## the header too for article=True)
+        if not is_message_id(message_spec) and group_name is None:
+            raise Exception('Article id supplied without group name')
+        directory = None
+        if path is None:
+            directory = settings.DOWNLOAD_DIR
+            os.makedirs(directory, exist_ok=True)
+
+        def fetch(nntp):
+            get = nntp.get_article if article else nntp.get_body
+            return get(message_spec, path=path, directory=directory, decode=decode)
+
+        if is_message_id(message_spec):
+            return self.router.run(fetch)
+        with self._connection(group_name) as nntp:
+            return fetch(nntp)
+
+    def iter_body(self, message_spec, group_name=None, decode=True):
+        ## the body in blocks of BODY_BLOCK bytes, straight through
+        ## from the server.  a message-id the server doesn't have is
+        ## tried on the next one, but once data has gone out there's
+        ## no starting over elsewhere
+        numbered = not is_message_id(message_spec)
+        if numbered and group_name is None:
+            raise Exception('Article id supplied without group name')
+        servers = self.router.order(self.numbering if numbered else None)
+        for i, server in enumerate(servers):
+            with self.router.checkout(group_name if numbered else None,
+                                      servers=[server]) as (server, nntp):
+                blocks = nntp.iter_body_blocks(message_spec, decode=decode)
+                try:
+                    try:
+                        block = next(blocks)
+                    except StopIteration:
+                        return
+                    except RequestError as e:
+                        if e.code != '430' or i == len(servers) - 1:
+                            raise
+                        server.missed()
+                        continue
+                    yield block
+                    yield from blocks
+                finally:
+                    blocks.close()
+            return
@@ -1,4 +1,5 @@
 # generic settings module
+import os
 
 SERVERS = {
         'default': {
@@ -8,9 +9,88 @@ SERVERS = {
             'PASS': 'serpent01',
             'SECURE': 'SSL',
             'CONNECTIONS': 6,
-            ## unused..
+            ## days the provider keeps articles: cached overviews older
+            ## than this are dropped, GETGROUPSINCE looks no further back
             'RETENTION': 1577,
+            ## compressed overviews: 'AUTO' uses whatever the server
+            ## has, or 'DEFLATE', 'XZVER', 'GZIP', or None for plain
+            'COMPRESSION': 'AUTO',
+            ## seconds a read from the server may take
+            ## before it is given up on (and failed over)
+            'TIMEOUT': 60,
         }
+        ## more servers are used alongside this one, requests go to
+        ## whichever is doing best.  optional keys:
+        ##   'PRIORITY': lower first whatever the speed, e.g. 1 for
+        ##               a backup that is only used on failover
+        ##   'NUMBERING': servers giving the same value share article
+        ##                numbers, anything asked by number only goes
+        ##                to the first server's kind
     }
 # python 2 compat..
 PICKLE_PROTOCOL = 2
+
+## daemon
+LISTEN_HOST = '0.0.0.0'
+LISTEN_PORT = 1701
+## client sessions share the NNTP connection pool so this
+## is no longer bound by CONNECTIONS
+MAX_SESSIONS = 512
+## worker processes sharing the listening socket, each with its
+## share of every server's CONNECTIONS (see prefork.py)
+PROCESSES = 1
+## threads running requests against the pool (per process)
+WORKERS = 16
+## requests carrying an ID one client session may have running
+## at once (those without an ID always run one at a time)
+SESSION_CONCURRENCY = 8
+## bytes queued for a client before we stop reading from it
+## (and pause its streams) until it catches up
+HIGH_WATER = 4 * 1024 * 1024
+## seconds a stream held up by a client that has stopped reading
+## waits, still holding its worker and upstream connection, before
+## it is aborted
+STREAM_STALL = 10
+## largest request (in bytes) a client may send, anything bigger
+## closes its session
+MAX_FRAME = 16 * 1024 * 1024
+
+## local stores (overview cache etc) live here
+CACHE_DIR = os.path.expanduser('~/.pynntpprox')
+## keep overviews on disk and only ask the server for ranges we
+## haven't seen
+OVERVIEW_CACHE = True
+## bytes of GETHEADER results kept in memory by message-id, 0 for none
+HEADER_CACHE_BYTES = 64 * 1024 * 1024
+## GETGROUP ranges longer than this many articles are split into
+## pieces of this size and fetched on several connections at once
+OVERVIEW_CHUNK = 20000
+## connections used by one split GETGROUP, None for all of them
+OVERVIEW_PARALLEL = None
+## serve plaintext metrics over HTTP on this port, None for off
+METRICS_PORT = None
+## articles the first SYNC of a group goes back from the newest
+SYNC_INITIAL = 1000
+## seconds between full LIST ACTIVEs behind GETGROUPS, 0 to always
+## ask the server instead of keeping the list
+GROUP_LIST_TTL = 24 * 60 * 60
+## seconds between NEWGROUPS checks for groups created since
+GROUP_LIST_REFRESH = 5 * 60
+## seconds to wait for a busy server's connection before trying
+## the next server
+FAILOVER_WAIT = 2
+## connections opened to each server at startup and kept open
+## (a server's 'WARM' overrides it, capped at its CONNECTIONS)
+WARM_CONNECTIONS = 2
+## seconds a connection may sit idle before it gets a DATE to keep
+## the server from hanging up on it, None for never
+KEEPALIVE = 60
+## seconds between looking for idle connections and topping up
+KEEPALIVE_INTERVAL = 15
+## GETBODY writes here when not given a path
+DOWNLOAD_DIR = os.path.join(CACHE_DIR, 'downloads')
+## bytes per streamed GETBODY response, and of write buffer
+BODY_BLOCK = 256 * 1024
+## identical GROUP, GETGROUP, GETHDR and GETHEADER requests running
+## at the same time share one upstream fetch
+COALESCE_REQUESTS = True
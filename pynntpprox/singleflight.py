@@ -0,0 +1,67 @@
+# one upstream fetch for identical requests that are in flight together
+##
+## when a burst of clients asks for the same thing at once (everyone
+## polling a group the moment new posts land) only the first request
+## goes to the server, the rest wait for it and get its answer, or
+## its exception.  nothing is kept once the fetch is done, that's
+## what the caches are for, so an answer is never more than the
+## one fetch old.
+import threading
+import logging
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    ## results are handed to every waiter as they are, callers
+    ## mustn't change them in place
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        ## func() for the first caller with key, its result
+        ## for everyone else who asks while it runs
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            log.debug('Waiting on in flight %s' % (key, ))
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls,
+                    'shared': self.shared,
+                    'in_flight': len(self._calls)}
@@ -0,0 +1,172 @@
+# counters for the STATS command and the metrics endpoint
+import time
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logging.basicConfig(format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel('INFO')
+
+
+class Histogram(object):
+    ## latencies in seconds, bucketed in powers of two from 1ms
+    ## to ~65s.  percentiles are the upper bound of the bucket
+    ## they land in, which is plenty to see where time goes.
+    bounds = tuple(0.001 * 2 ** i for i in range(17)) + (float('inf'), )
+
+    def __init__(self):
+        self.buckets = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        for i, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        want = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= want:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': list(zip(self.bounds, self.buckets))}
+
+
+class Stats(object):
+    ## per daemon command: latency as the client sees it (from the
+    ## request arriving to the last byte of the answer being queued),
+    ## bytes in and out and errors by NNTP code ('NO' for ones that
+    ## aren't NNTP's).  per NNTP command: the round trip to the
+    ## status line.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}
+        self.upstream = {}
+        ## callables returning extra dicts for snapshot(),
+        ## e.g. pool and session occupancy
+        self.gauges = {}
+
+    def _command(self, cmd):
+        c = self.commands.get(cmd)
+        if c is None:
+            c = self.commands[cmd] = {'latency': Histogram(),
+                                      'bytes_in': 0,
+                                      'bytes_out': 0,
+                                      'errors': {}}
+        return c
+
+    def request(self, cmd, seconds, bytes_in=0, bytes_out=0, error=None):
+        with self._lock:
+            c = self._command(cmd)
+            c['latency'].add(seconds)
+            c['bytes_in'] += bytes_in
+            c['bytes_out'] += bytes_out
+            if error is not None:
+                c['errors'][error] = c['errors'].get(error, 0) + 1
+
+    def nntp(self, command, seconds):
+        with self._lock:
+            h = self.upstream.get(command)
+            if h is None:
+                h = self.upstream[command] = Histogram()
+            h.add(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            snap = {'uptime': time.time() - self.started,
+                    'commands': dict((cmd, {'latency': c['latency'].snapshot(),
+                                            'bytes_in': c['bytes_in'],
+                                            'bytes_out': c['bytes_out'],
+                                            'errors': dict(c['errors'])})
+                                     for cmd, c in self.commands.items()),
+                    'upstream': dict((cmd, h.snapshot())
+                                     for cmd, h in self.upstream.items())}
+        for name, gauge in list(self.gauges.items()):
+            try:
+                snap[name] = gauge()
+            except Exception as e:
+                log.debug('gauge %s failed: %s' % (name, e))
+        return snap
+
+    def format_text(self, snap=None):
+        ## prometheus style plaintext
+        snap = snap if snap is not None else self.snapshot()
+        out = ['pynntpprox_uptime_seconds %f' % snap['uptime']]
+
+        def histogram(name, labels, h):
+            seen = 0
+            for bound, n in h['buckets']:
+                seen += n
+                le = '+Inf' if bound == float('inf') else '%g' % bound
+                out.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, seen))
+            out.append('%s_sum{%s} %f' % (name, labels, h['sum']))
+            out.append('%s_count{%s} %d' % (name, labels, h['count']))
+
+        for cmd, c in sorted(snap['commands'].items(), key=lambda i: str(i[0])):
+            labels = 'cmd="%s"' % cmd
+            histogram('pynntpprox_request_seconds', labels, c['latency'])
+            out.append('pynntpprox_bytes_in_total{%s} %d' % (labels, c['bytes_in']))
+            out.append('pynntpprox_bytes_out_total{%s} %d' % (labels, c['bytes_out']))
+            for code, n in sorted(c['errors'].items(), key=lambda i: str(i[0])):
+                out.append('pynntpprox_errors_total{%s,code="%s"} %d' % (labels, code, n))
+        for cmd, h in sorted(snap['upstream'].items()):
+            histogram('pynntpprox_nntp_seconds', 'command="%s"' % cmd, h)
+
+        ## gauges are flat dicts of numbers
+        for name, values in sorted(snap.items()):
+            if name in ('uptime', 'commands', 'upstream') or not isinstance(values, dict):
+                continue
+            for k, v in sorted(values.items()):
+                if isinstance(v, (int, float)):
+                    out.append('pynntpprox_%s{name="%s"} %s' % (name, k, v))
+        return '\n'.join(out) + '\n'
+
+
+## one per process, nntp.py records upstream timings here
+STATS = Stats()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.stats.format_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve_metrics(host, port, stats=STATS):
+    ## plaintext metrics over HTTP on a thread of its own
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.stats = stats
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info('Metrics on http://%s:%s/' % (host, port))
+    return server
@@ -0,0 +1,153 @@
+# yEnc decoding
+##
+## every byte is sent as (byte + 42) % 256, and the handful that
+## would upset NNTP (NUL, LF, CR, '=') as '=' followed by
+## (byte + 42 + 64) % 256.
+import os
+import re
+import zlib
+
+_SHIFT = bytes((i + 42) % 256 for i in range(256))
+_CRITICAL = re.compile(b'[\x00\n\r=]')
+_UNSHIFT = bytes((i - 42) % 256 for i in range(256))
+_UNESCAPE = bytes((i - 106) % 256 for i in range(256))
+
+
+def decode_line(line):
+    ## one line of yEnc data, without its line ending
+    if b'=' not in line:
+        return line.translate(_UNSHIFT)
+    parts = line.split(b'=')
+    out = [parts[0].translate(_UNSHIFT)]
+    for part in parts[1:]:
+        if part:
+            out.append(part[:1].translate(_UNESCAPE))
+            out.append(part[1:].translate(_UNSHIFT))
+    return b''.join(out)
+
+
+def is_control(line):
+    ## =ybegin, =ypart and =yend lines carry no data
+    return line.startswith((b'=ybegin ', b'=ypart ', b'=yend '))
+
+
+class YencError(ValueError):
+    pass
+
+
+def parse_control(line):
+    ## '=ybegin part=1 line=128 size=500 name=a file.bin' to a dict.
+    ## name runs to the end of the line, it may have spaces in it
+    line = line.decode('latin-1')
+    keyword, _, rest = line.partition(' ')
+    fields = {'keyword': keyword[2:]}
+    name = None
+    if ' name=' in ' ' + rest:
+        rest, _, name = (' ' + rest).partition(' name=')
+    for pair in rest.split():
+        k, _, v = pair.partition('=')
+        fields[k] = v
+    if name is not None:
+        fields['name'] = name
+    return fields
+
+
+def safe_name(name):
+    ## a yEnc name (the poster's choice) made safe to put in a directory
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    if name in ('', '.', '..'):
+        return None
+    return name
+
+
+class Decoder(object):
+    ## decodes a body a line at a time, keeping the CRC32 and
+    ## byte count as it goes so nothing has to be held onto.
+    ##
+    ## what the =ybegin/=ypart/=yend lines said ends up in name,
+    ## size (of the whole file), part, begin and end (1-based, of
+    ## this part within the file).  check() once the body is done.
+    def __init__(self):
+        self.begun = False
+        self.ended = False
+        self.name = None
+        self.size = None
+        self.part = None
+        self.begin = None
+        self.end = None
+        self.trailer = {}
+        self.crc = 0
+        self.length = 0
+
+    def feed(self, line):
+        ## decoded data for one line (b'' for control lines
+        ## and anything outside =ybegin .. =yend)
+        if is_control(line):
+            fields = parse_control(line)
+            keyword = fields['keyword']
+            if keyword == 'begin':
+                self.begun = True
+                self.name = fields.get('name')
+                self.size = int(fields['size']) if 'size' in fields else None
+                self.part = int(fields['part']) if 'part' in fields else None
+            elif keyword == 'part':
+                self.begin = int(fields['begin'])
+                self.end = int(fields['end'])
+            elif keyword == 'end':
+                self.ended = True
+                self.trailer = fields
+            return b''
+        if not self.begun or self.ended:
+            return b''
+        data = decode_line(line)
+        self.crc = zlib.crc32(data, self.crc)
+        self.length += len(data)
+        return data
+
+    @property
+    def offset(self):
+        ## where this part's data goes in the file, None when there
+        ## was no =ypart and the body is the whole file
+        return self.begin - 1 if self.begin is not None else None
+
+    def check(self):
+        if not self.begun:
+            raise YencError('Not yEnc encoded')
+        if not self.ended:
+            raise YencError('yEnc data ends without =yend')
+        if 'size' in self.trailer and int(self.trailer['size']) != self.length:
+            raise YencError('yEnc size mismatch: expected %s, got %s'
+                            % (self.trailer['size'], self.length))
+        ## pcrc32 is this part's, crc32 the whole file's (the
+        ## same thing for a single part post)
+        expected = self.trailer.get('pcrc32')
+        if expected is None and self.part is None:
+            expected = self.trailer.get('crc32')
+        if expected is not None and int(expected, 16) != self.crc:
+            raise YencError('yEnc CRC32 mismatch: expected %s, got %08x'
+                            % (expected.lower(), self.crc))
+
+    def info(self):
+        return {'name': self.name,
+                'size': self.size,
+                'part': self.part,
+                'begin': self.begin,
+                'end': self.end,
+                'bytes': self.length,
+                'crc32': '%08x' % self.crc}
+
+
+def encode_lines(data, line_length=128):
+    ## the other way, for the fake server.  an escape
+    ## is never split across lines
+    shifted = _CRITICAL.sub(lambda m: b'=' + bytes(((m.group()[0] + 64) % 256, )),
+                            data.translate(_SHIFT))
+    lines = []
+    pos = 0
+    while pos < len(shifted):
+        end = pos + line_length
+        if shifted[end - 1:end] == b'=':
+            end += 1
+        lines.append(shifted[pos:end])
+        pos = end
+    return lines
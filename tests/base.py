@@ -0,0 +1,49 @@
+# what the tests share: a fake server to talk to and settings that
+# are put back afterwards
+import shutil
+import logging
+import tempfile
+import unittest
+
+from pynntpprox import settings, fakenntp, service
+
+
+class FakeServerTestCase(unittest.TestCase):
+    ## settings for the length of each test, CACHE_DIR is always a
+    ## fresh temporary directory
+    overrides = {'OVERVIEW_CACHE': False,
+                 'HEADER_CACHE_BYTES': 0}
+    ## fakenntp.start arguments for self.fake, None for no server
+    fake_options = {'groups': 1, 'articles': 1000}
+
+    def setUp(self):
+        for name, value in dict(self.overrides, CACHE_DIR=tempfile.mkdtemp()).items():
+            self.addCleanup(setattr, settings, name, getattr(settings, name))
+            setattr(settings, name, value)
+        self.addCleanup(shutil.rmtree, settings.CACHE_DIR, True)
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        self.fake = None
+        if self.fake_options is not None:
+            self.fake = self.start_fake(**self.fake_options)
+            self.group = self.fake.group_names[0]
+
+    def start_fake(self, **options):
+        fake = fakenntp.start(**options)
+        self.addCleanup(fake.server_close)
+        self.addCleanup(fake.shutdown)
+        return fake
+
+    def server_config(self, fake=None, **config):
+        ## a settings.SERVERS entry for fake (self.fake by default)
+        fake = fake or self.fake
+        return dict({'HOST': '127.0.0.1',
+                     'PORT': fake.server_address[1],
+                     'SECURE': 'PLAIN',
+                     'CONNECTIONS': 2,
+                     'TIMEOUT': 10}, **config)
+
+    def start_service(self, fake=None, **config):
+        svc = service.NNTPService(servers={'fake': self.server_config(fake, **config)})
+        self.addCleanup(svc.close)
+        return svc
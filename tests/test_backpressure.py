@@ -0,0 +1,53 @@
+# clients that stop reading their streams mustn't starve everyone else
+import time
+import socket
+import threading
+import unittest
+
+from pynntpprox import protocol
+from pynntpprox.client import Client
+from pynntpprox.daemonprox import DaemonProx
+
+from base import FakeServerTestCase
+
+
+class StalledStreamTest(FakeServerTestCase):
+    connections = 4
+    fake_options = {'groups': 1, 'articles': 20000, 'subject_bytes': 500}
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.daemon = DaemonProx(port=0, high_water=64 * 1024,
+                                 service=self.start_service(CONNECTIONS=self.connections))
+        self.daemon.stream_stall = 1
+        threading.Thread(target=self.daemon.serve_forever, daemon=True).start()
+        self.port = self.daemon.server.getsockname()[1]
+
+    def test_stalled_streams_give_up_their_connections(self):
+        group = self.group
+        stalled = []
+        for i in range(self.connections):
+            s = socket.socket()
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            s.connect(('127.0.0.1', self.port))
+            s.sendall(protocol.encode({'CMD': 'GETGROUP', 'STREAM': True,
+                                       'ARG': {'group_name': group,
+                                               'message_spec': (1, 20000)}},
+                                      protocol.V2))
+            stalled.append(s)
+        ## every connection is busy with a stream nobody reads (one
+        ## range, short of OVERVIEW_CHUNK, is read off one connection)
+        time.sleep(0.5)
+        self.assertEqual(self.daemon.service.pool.stats()['idle'], 0)
+
+        with Client('127.0.0.1', self.port, timeout=10) as client:
+            start = time.time()
+            header = client.get_header('<5.%s@fake.invalid>' % group)
+            self.assertEqual(header['message-id'], '<5.%s@fake.invalid>' % group)
+            self.assertLess(time.time() - start, 5)
+        for s in stalled:
+            s.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# the overview cache and the ranges it knows it has
+import os
+import shutil
+import tempfile
+import unittest
+
+from pynntpprox.cache import OverviewCache
+
+from base import FakeServerTestCase
+
+
+class OverviewCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.cache = OverviewCache(os.path.join(directory, 'overview.db'))
+        self.addCleanup(self.cache.close)
+
+    def test_missing(self):
+        self.assertEqual(self.cache.missing('g', 1, 100), [(1, 100)])
+        self.cache.cover('g', 10, 19)
+        self.cache.cover('g', 40, 49)
+        self.assertEqual(self.cache.missing('g', 1, 100),
+                         [(1, 9), (20, 39), (50, 100)])
+        self.assertEqual(self.cache.missing('g', 12, 15), [])
+        self.assertEqual(self.cache.missing('other', 12, 15), [(12, 15)])
+
+    def test_cover_merges(self):
+        self.cache.cover('g', 10, 19)
+        self.cache.cover('g', 30, 39)
+        ## touching both, the three become one
+        self.cache.cover('g', 20, 29)
+        self.assertEqual(self.cache.missing('g', 10, 40), [(40, 40)])
+        rows = self.cache._db.execute('SELECT first, last FROM coverage').fetchall()
+        self.assertEqual(rows, [(10, 39)])
+
+    def test_iter_range_pages(self):
+        self.cache.page = 7
+        ## every other article, the rest are gaps
+        self.cache.store('g', [(n, {'subject': str(n)}) for n in range(1, 50, 2)])
+        got = list(self.cache.iter_range('g', 4, 40))
+        self.assertEqual([n for n, _ in got], list(range(5, 40, 2)))
+        self.assertEqual(got[0][1], {'subject': '5'})
+
+
+class CachedGetGroupTest(FakeServerTestCase):
+    overrides = dict(FakeServerTestCase.overrides, OVERVIEW_CACHE=True)
+    fake_options = {'groups': 1, 'articles': 500}
+
+    def test_coverage(self):
+        svc = self.start_service()
+        first = svc.get_group((100, 300), self.group)
+        self.assertEqual(svc.overviews.missing(self.group, 100, 300), [])
+        ## a range reaching past the end is covered as far as the group goes
+        svc.get_group((250, 800), self.group)
+        self.assertEqual(svc.overviews.missing(self.group, 100, 800), [(501, 800)])
+        self.assertEqual(svc.get_group((100, 300), self.group), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# every compressed transfer mode against the fake server
+import unittest
+
+from base import FakeServerTestCase
+
+
+class CompressionTest(FakeServerTestCase):
+    fake_options = None
+
+    def test_modes(self):
+        for mode in ('DEFLATE', 'GZIP', 'XZVER'):
+            fake = self.start_fake(groups=1, articles=500, compression=[mode])
+            group = fake.group_names[0]
+            svc = self.start_service(fake, CONNECTIONS=1, COMPRESSION=mode)
+            with svc.pool.connection() as nntp:
+                self.assertEqual(nntp._compression, mode)
+            overviews = svc.get_group((1, 500), group)
+            self.assertEqual([n for n, ovr in overviews], list(range(1, 501)), mode)
+            self.assertEqual(overviews[9][1]['message-id'],
+                             '<10.%s@fake.invalid>' % group, mode)
+            ## HEADs pipelined, many responses on the wire at once
+            specs = ['<%d.%s@fake.invalid>' % (n, group) for n in range(1, 201)]
+            headers = svc.get_headers(specs)
+            self.assertEqual([h['message-id'] for spec, h in headers], specs, mode)
+            ## and the connection still in step after them
+            self.assertEqual(svc.group(group)['last'], 500, mode)
+
+
+if __name__ == '__main__':
+    unittest.main()
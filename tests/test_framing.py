@@ -0,0 +1,57 @@
+# v1 and v2 framing, and FrameReader
+import unittest
+
+from pynntpprox import protocol
+
+
+class FrameReaderTest(unittest.TestCase):
+    def frames(self, reader):
+        return [(version, protocol.decode(frame)) for version, frame in reader.frames()]
+
+    def test_both_framings(self):
+        reader = protocol.FrameReader()
+        reader.feed(protocol.encode({'CMD': 'A'}, protocol.V1)
+                    + protocol.encode({'CMD': 'B'}, protocol.V2))
+        self.assertEqual(self.frames(reader), [(protocol.V1, {'CMD': 'A'}),
+                                               (protocol.V2, {'CMD': 'B'})])
+        self.assertEqual(len(reader), 0)
+
+    def test_split_feeds(self):
+        ## a byte at a time, across the delimiter and the v2 header
+        data = (protocol.encode({'ARG': 'x' * 1000}, protocol.V2)
+                + protocol.encode({'ARG': 'y' * 1000}, protocol.V1)) * 2
+        reader = protocol.FrameReader(size=16)
+        got = []
+        for i in range(len(data)):
+            reader.feed(data[i:i + 1])
+            got.extend(self.frames(reader))
+        self.assertEqual([version for version, _ in got],
+                         [protocol.V2, protocol.V1] * 2)
+        self.assertEqual(got[3][1], {'ARG': 'y' * 1000})
+
+    def test_bad_header(self):
+        reader = protocol.FrameReader()
+        reader.feed(b'\x00PX3' + b'\x00' * 8)
+        self.assertRaises(ValueError, self.frames, reader)
+
+    def test_v2_too_large(self):
+        ## refused from the header alone, before making room for it
+        reader = protocol.FrameReader(max_frame=1024)
+        reader.feed(protocol.HEADER.pack(protocol.MAGIC, 0xffffffff))
+        self.assertRaisesRegex(ValueError, 'too large', self.frames, reader)
+        self.assertLess(len(reader._buf), 1024 * 1024)
+
+    def test_v1_too_large(self):
+        reader = protocol.FrameReader(max_frame=1024)
+        reader.feed(b'x' * 2048)
+        self.assertRaisesRegex(ValueError, 'too large', self.frames, reader)
+
+    def test_at_the_limit(self):
+        frame = protocol.encode({'ARG': 'x' * 100}, protocol.V2)
+        reader = protocol.FrameReader(max_frame=len(frame) - protocol.HEADER.size)
+        reader.feed(frame)
+        self.assertEqual(len(self.frames(reader)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
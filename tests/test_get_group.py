@@ -0,0 +1,27 @@
+# GETGROUP over ranges cut into parallel chunks
+import unittest
+
+from base import FakeServerTestCase
+
+
+class ParallelChunksTest(FakeServerTestCase):
+    overrides = dict(FakeServerTestCase.overrides,
+                     OVERVIEW_CHUNK=5000,
+                     OVERVIEW_PARALLEL=2)
+    fake_options = {'groups': 1, 'articles': 25000}
+
+    def test_range_past_the_end(self):
+        ## the chunks after 25000 have no articles (423) and
+        ## the cache is off, so that comes straight from OVER
+        svc = self.start_service()
+        overviews = svc.get_group((1, 50000), self.group)
+        self.assertEqual([number for number, _ in overviews], list(range(1, 25001)))
+
+    def test_in_order(self):
+        svc = self.start_service()
+        overviews = svc.get_group((4001, 17000), self.group)
+        self.assertEqual([number for number, _ in overviews], list(range(4001, 17001)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+# GETGROUPS keeps answering from the list it has while it's refreshed
+import time
+import unittest
+
+from pynntpprox import settings
+
+from base import FakeServerTestCase
+
+
+class GroupListRefreshTest(FakeServerTestCase):
+    fake_options = {'groups': 3, 'articles': 10}
+
+    def test_stale_list_served_during_relist(self):
+        svc = self.start_service()
+        self.assertEqual(len(svc.get_groups('*')), 3)
+        self.fake.add_group('alt.binaries.fake.new')
+        ## due a full relist, from a slow server
+        svc.group_list.listed -= settings.GROUP_LIST_TTL + 1
+        self.fake.latency = 0.5
+        start = time.time()
+        for i in range(5):
+            self.assertEqual(len(svc.get_groups('*')), 3)
+        self.assertLess(time.time() - start, 0.4)
+        ## one relist, done in the background
+        deadline = time.time() + 10
+        while len(svc.get_groups('*')) != 4 and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(len(svc.get_groups('*')), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# GETGROUPSINCE against the fake server, on hosts that aren't on UTC
+import os
+import time
+import unittest
+
+from base import FakeServerTestCase
+
+
+class GroupSinceTimezoneTest(FakeServerTestCase):
+    ## the fake's articles are a minute apart, ending an hour ago
+    articles = 5000
+    fake_options = {'groups': 1, 'articles': articles}
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.fake.epoch = int(time.time()) - self.articles * self.fake.spacing - 3600
+        self.addCleanup(self._set_tz, os.environ.get('TZ'))
+
+    @staticmethod
+    def _set_tz(tz):
+        if tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
+
+    def _since(self, tz, since, **config):
+        self._set_tz(tz)
+        svc = self.start_service(**config)
+        return svc.get_group_since(self.group, since, fields=['date'])
+
+    def test_since(self):
+        ## the last 10 articles, plus the one posted on the second
+        since = self.fake.epoch + (self.articles - 10) * self.fake.spacing
+        for tz in ('UTC', 'America/New_York', 'Asia/Tokyo'):
+            articles = self._since(tz, since)
+            self.assertEqual([n for n, ovr in articles],
+                             list(range(self.articles - 10, self.articles + 1)), tz)
+
+    def test_retention(self):
+        ## a day back from now, the fake's last article being an hour old
+        for tz in ('America/New_York', 'Asia/Tokyo'):
+            articles = self._since(tz, 0, RETENTION=1)
+            self.assertAlmostEqual(len(articles), 24 * 60 - 60, delta=2, msg=tz)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+# GETHDR, and matching patterns here when XPAT is refused
+import unittest
+
+from base import FakeServerTestCase
+
+
+class XpatTest(FakeServerTestCase):
+    fake_options = {'groups': 1, 'articles': 100}
+
+    def test_pattern(self):
+        svc = self.start_service()
+        values = svc.get_hdr('message-id', (1, 100), self.group, pattern='<1?.*')
+        self.assertEqual([number for number, _ in values], list(range(10, 20)))
+        self.assertNotIn('xpat', svc.pool.shared)
+
+    def test_refused_pattern(self):
+        ## a 501 is about the pattern, the next one still goes by XPAT
+        svc = self.start_service()
+        values = svc.get_hdr('message-id', (1, 100), self.group, pattern='<1?.*,![')
+        self.assertEqual([number for number, _ in values], list(range(10, 20)))
+        self.assertNotIn('xpat', svc.pool.shared)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# GETHEADERS, pipelined down one connection
+import unittest
+
+from pynntpprox import service
+
+from base import FakeServerTestCase
+
+
+class PipelinedHeadersTest(FakeServerTestCase):
+    fake_options = {'groups': 1, 'articles': 100}
+
+    def message_id(self, number):
+        return self.fake.message_id(self.group, number)
+
+    def test_connection_kept(self):
+        svc = self.start_service(CONNECTIONS=1)
+        specs = [self.message_id(n) for n in range(1, 21)] + ['<nope@fake.invalid>']
+        headers = svc.get_headers(specs)
+        self.assertEqual([spec for spec, _ in headers], specs)
+        self.assertEqual(headers[0][1]['message-id'], specs[0])
+        self.assertIsNone(headers[-1][1])
+        ## every answer was read, the connection goes back for reuse
+        self.assertEqual(svc.pool.stats(), {'size': 1, 'open': 1, 'idle': 1})
+
+    def test_stopped_part_way(self):
+        svc = self.start_service(CONNECTIONS=1)
+        headers = svc.iter_headers([self.message_id(n) for n in range(1, 21)])
+        next(headers)
+        headers.close()
+        ## answers were left on the wire, so it's hung up
+        self.assertEqual(svc.pool.stats()['open'], 0)
+
+
+class HeaderFailoverTest(FakeServerTestCase):
+    ## the backup has articles the primary hasn't
+    fake_options = {'groups': 1, 'articles': 10}
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        backup = self.start_fake(groups=1, articles=100)
+        self.svc = service.NNTPService(servers={
+            'primary': self.server_config(CONNECTIONS=1),
+            'backup': self.server_config(backup, CONNECTIONS=1, PRIORITY=1)})
+        self.addCleanup(self.svc.close)
+
+    def message_id(self, number):
+        return self.fake.message_id(self.group, number)
+
+    def test_missing_from_primary(self):
+        primary = self.svc.pool
+        idle = []
+        elsewhere = self.svc._header_elsewhere
+
+        def _header_elsewhere(message_spec, server):
+            idle.append(primary.stats()['idle'])
+            return elsewhere(message_spec, server)
+        self.svc._header_elsewhere = _header_elsewhere
+
+        specs = [self.message_id(n) for n in (5, 50, 6, 60, 7)]
+        headers = self.svc.get_headers(specs)
+        self.assertEqual([spec for spec, _ in headers], specs)
+        self.assertEqual([header['message-id'] for _, header in headers], specs)
+        ## the primary's one connection was back in its pool
+        ## before the backup was asked
+        self.assertEqual(idle, [1, 1])
+
+    def test_checkout_times_requests(self):
+        primary = self.svc.router.primary
+        self.assertIsNone(primary.latency)
+        self.svc.get_headers([self.message_id(5)])
+        self.assertIsNotNone(primary.latency)
+
+
+if __name__ == '__main__':
+    unittest.main()
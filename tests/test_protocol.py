@@ -0,0 +1,19 @@
+# columnar overview encoding
+import unittest
+
+from pynntpprox import protocol
+
+
+class ColumnarTest(unittest.TestCase):
+    def test_wide_numbers_stay_strings(self):
+        ## all digits, but too wide for an int column
+        overviews = [(1, {'bytes': '123', 'id': '99999999999999999999'}),
+                     (2, {'bytes': '9223372036854775807', 'id': '5'})]
+        data = protocol.encode_columnar(overviews)
+        self.assertEqual(data['columns']['bytes'][0], 'int')
+        self.assertEqual(data['columns']['id'][0], 'str')
+        self.assertEqual(protocol.decode_columnar(data), overviews)
+
+
+if __name__ == '__main__':
+    unittest.main()
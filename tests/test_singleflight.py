@@ -0,0 +1,68 @@
+# identical requests in flight together share one fetch
+import threading
+import unittest
+
+from pynntpprox.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def run_together(self, flights, key, func, n=5):
+        ## n callers of key, all waiting on func
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(flights.do(key, func))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_shared(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return ['answer']
+        threads, results, errors = self.run_together(flights, 'k', fetch)
+        while flights.stats()['calls'] < 5:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['answer']] * 5)
+        self.assertEqual(flights.stats(), {'calls': 5, 'shared': 4, 'in_flight': 0})
+
+    def test_error_shared(self):
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise ValueError('nope')
+        threads, results, errors = self.run_together(flights, 'k', fetch, n=3)
+        while flights.stats()['calls'] < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [])
+        self.assertEqual([str(e) for e in errors], ['nope'] * 3)
+
+    def test_nothing_kept(self):
+        ## once it's done the next caller fetches again
+        flights = SingleFlight()
+        self.assertEqual(flights.do('k', lambda: 1), 1)
+        self.assertEqual(flights.do('k', lambda: 2), 2)
+        self.assertEqual(flights.stats()['shared'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# SYNC marks move only once the articles have been handed out
+import os
+import threading
+import unittest
+
+from pynntpprox import settings
+from pynntpprox.client import Client
+from pynntpprox.daemonprox import DaemonProx
+
+from base import FakeServerTestCase
+
+
+class SyncMarksTest(FakeServerTestCase):
+    fake_options = {'groups': 1, 'articles': 1000}
+
+    def numbers(self, articles):
+        return [number for number, _ in articles]
+
+    def test_marks_opened_by_first_sync(self):
+        svc = self.start_service()
+        svc.get_group((1, 10), self.group)
+        self.assertEqual([name for name in os.listdir(settings.CACHE_DIR)
+                          if name.endswith('.sync.db')], [])
+        svc.sync(self.group, initial=10)
+        self.assertEqual(len([name for name in os.listdir(settings.CACHE_DIR)
+                              if name.endswith('.sync.db')]), 1)
+
+    def test_sync(self):
+        svc = self.start_service()
+        info = svc.sync(self.group, initial=10)
+        self.assertEqual(self.numbers(info['articles']), list(range(991, 1001)))
+        self.assertEqual((info['low'], info['high']), (991, 1000))
+        info = svc.sync(self.group, backfill=5)
+        self.assertEqual(self.numbers(info['articles']), list(range(986, 991)))
+        self.assertEqual((info['low'], info['high']), (986, 1000))
+
+    def test_stopped_part_way(self):
+        svc = self.start_service()
+        batches = svc.iter_sync(self.group, initial=100, batch=30)
+        info = next(batches)
+        self.assertEqual((info['low'], info['high']), (901, 1000))
+        self.assertEqual(self.numbers(next(batches)), list(range(901, 931)))
+        self.assertEqual(self.numbers(next(batches)), list(range(931, 961)))
+        ## 931-960 were handed out but never taken in
+        batches.close()
+        self.assertEqual(svc.marks.get('', self.group), (901, 930))
+        info = svc.sync(self.group)
+        self.assertEqual(self.numbers(info['articles']), list(range(931, 1001)))
+
+    def test_backfill_moves_once_done(self):
+        svc = self.start_service()
+        svc.sync(self.group, initial=10)
+        batches = svc.iter_sync(self.group, backfill=20, batch=15)
+        next(batches)
+        self.assertEqual(self.numbers(next(batches)), list(range(971, 986)))
+        self.assertEqual(self.numbers(next(batches)), list(range(986, 991)))
+        self.assertEqual(svc.marks.get('', self.group), (991, 1000))
+        self.assertEqual(list(batches), [])
+        self.assertEqual(svc.marks.get('', self.group), (971, 1000))
+
+
+class DaemonSyncTest(FakeServerTestCase):
+    fake_options = {'groups': 1, 'articles': 1000}
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        daemon = DaemonProx(port=0, service=self.start_service())
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+        self.port = daemon.server.getsockname()[1]
+
+    def test_request(self):
+        with Client('127.0.0.1', self.port, timeout=10) as client:
+            info = client.request('SYNC', {'group_name': self.group, 'initial': 10})
+            self.assertEqual([n for n, _ in info['articles']], list(range(991, 1001)))
+            info = client.request('SYNC', {'group_name': self.group})
+            self.assertEqual(info['articles'], [])
+
+    def test_stream(self):
+        with Client('127.0.0.1', self.port, timeout=10) as client:
+            articles = list(client.stream('SYNC', {'group_name': self.group, 'initial': 25},
+                                          chunk_size=10))
+            self.assertEqual([n for n, _ in articles], list(range(976, 1001)))
+            info = client.request('SYNC', {'group_name': self.group})
+            self.assertEqual((info['low'], info['high'], info['articles']), (976, 1000, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
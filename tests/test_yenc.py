@@ -0,0 +1,109 @@
+# yEnc decoding and BODY saved to a file
+import os
+import zlib
+import random
+import unittest
+
+from pynntpprox import settings, yenc
+
+from base import FakeServerTestCase
+
+
+def _body(data, head, tail):
+    return [head] + yenc.encode_lines(data) + [tail]
+
+
+class DecoderTest(unittest.TestCase):
+    ## every byte value, so each of the escapes turns up
+    data = bytes(range(256)) * 8
+
+    def decode(self, lines):
+        decoder = yenc.Decoder()
+        out = b''.join(decoder.feed(line) for line in lines)
+        return decoder, out
+
+    def single(self, data=None, tail=None):
+        data = self.data if data is None else data
+        return _body(data, b'=ybegin line=128 size=%d name=a file.bin' % len(data),
+                     tail or b'=yend size=%d crc32=%08x' % (len(data), zlib.crc32(data)))
+
+    def test_round_trip(self):
+        decoder, out = self.decode(self.single())
+        decoder.check()
+        self.assertEqual(out, self.data)
+        self.assertEqual(decoder.name, 'a file.bin')
+        self.assertIsNone(decoder.part)
+        self.assertIsNone(decoder.offset)
+        self.assertEqual(decoder.info()['crc32'], '%08x' % zlib.crc32(self.data))
+
+    def test_part(self):
+        lines = _body(self.data, b'=ybegin part=2 total=3 line=128 size=9000 name=x.bin',
+                      b'=yend size=%d part=2 pcrc32=%08x' % (len(self.data), zlib.crc32(self.data)))
+        lines.insert(1, b'=ypart begin=2049 end=4096')
+        decoder, out = self.decode(lines)
+        decoder.check()
+        self.assertEqual(out, self.data)
+        self.assertEqual((decoder.part, decoder.offset), (2, 2048))
+
+    def test_crc_mismatch(self):
+        decoder, _ = self.decode(self.single(tail=b'=yend size=%d crc32=00000000' % len(self.data)))
+        self.assertRaisesRegex(yenc.YencError, 'CRC32', decoder.check)
+
+    def test_size_mismatch(self):
+        decoder, _ = self.decode(self.single(tail=b'=yend size=1'))
+        self.assertRaisesRegex(yenc.YencError, 'size', decoder.check)
+
+    def test_missing_end(self):
+        decoder, _ = self.decode(self.single()[:-1])
+        self.assertRaisesRegex(yenc.YencError, '=yend', decoder.check)
+
+    def test_not_yenc(self):
+        decoder, out = self.decode([b'just some text'])
+        self.assertEqual(out, b'')
+        self.assertRaises(yenc.YencError, decoder.check)
+
+    def test_escape_not_split(self):
+        ## short lines, so plenty of escapes fall at the end of one
+        lines = yenc.encode_lines(self.data, line_length=7)
+        self.assertEqual(b''.join(map(yenc.decode_line, lines)), self.data)
+
+    def test_parse_control(self):
+        fields = yenc.parse_control(b'=ybegin part=1 line=128 size=500 name= a file.bin')
+        self.assertEqual(fields, {'keyword': 'begin', 'part': '1', 'line': '128',
+                                  'size': '500', 'name': ' a file.bin'})
+
+    def test_safe_name(self):
+        self.assertEqual(yenc.safe_name('../../etc/passwd'), 'passwd')
+        self.assertEqual(yenc.safe_name('C:\\dir\\file.bin'), 'file.bin')
+        self.assertIsNone(yenc.safe_name('..'))
+        self.assertIsNone(yenc.safe_name(' '))
+
+
+class GetBodyTest(FakeServerTestCase):
+    fake_options = {'groups': 1, 'articles': 10, 'body_bytes': 5000, 'parts': 1}
+
+    def test_overwrites_larger_file(self):
+        svc = self.start_service()
+        path = os.path.join(settings.CACHE_DIR, 'body.bin')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 20000)
+        info = svc.get_body(3, self.group, path=path)
+        self.assertEqual(info['path'], path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.fake.data(self.group, 3))
+
+    def test_parts_fill_one_file(self):
+        fake = self.start_fake(groups=1, articles=10, body_bytes=5000, parts=3)
+        svc = self.start_service(fake)
+        group = fake.group_names[0]
+        path = os.path.join(settings.CACHE_DIR, 'parts.bin')
+        ## out of order, each part seeks to its own offset
+        for number in random.Random(0).sample([1, 2, 3], 3):
+            info = svc.get_body(number, group, path=path)
+            self.assertEqual(info['part'], number)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(fake.data(group, n) for n in (1, 2, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()